@@ -0,0 +1,156 @@
+"""
+Concurrent payment sends against the WSGI and ASGI apps.
+
+Logs one verified user in, then posts ``--requests`` payments to
+``/payments/send`` all at once, against a fake Authy API that takes
+``--authy-latency`` seconds per call. Reports send latency, how many
+push requests Authy saw in flight at once, and how long until every
+payment had its push sent, as JSON:
+
+    python -m benchmarks.async_send --server asgi --requests 500
+    python -m benchmarks.async_send --server wsgi --requests 500
+
+With either server the pushes are sent by the outbox worker, up to
+``OUTBOX_CONCURRENCY`` at once; ``--server asgi`` needs uvicorn, and
+httpx for the client.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import requests
+from benchmarks.fake_authy_server import FakeAuthyServer
+from benchmarks.load import API_KEY, create_benchmark_app, percentile, start_app
+from payfriend import db
+from payfriend.models import Payment, User
+
+PASSWORD = 'correct horse battery staple'
+
+
+def serve_asgi(app):
+    """
+    Serves ``payfriend.asgi.AsyncPayments`` with uvicorn on a local port.
+
+    :returns: base_url
+    """
+    import uvicorn
+    from payfriend.asgi import AsyncPayments
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        AsyncPayments(app), host='127.0.0.1', port=port,
+        log_level='warning', backlog=4096))
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return 'http://127.0.0.1:{}'.format(port)
+
+
+def log_in(app, base_url):
+    """
+    Creates a verified user and logs them in.
+
+    :returns: the session cookies
+    """
+    with app.app_context():
+        user = User('bench@example.com', PASSWORD, '+15105550000',
+                    1, '5105550000')
+        user.authy_id = 1
+        db.session.add(user)
+        db.session.commit()
+
+    http = requests.Session()
+    resp = http.post(base_url + '/auth/login', allow_redirects=False,
+                     data={'email': 'bench@example.com', 'password': PASSWORD})
+    assert resp.status_code == 302, resp.status_code
+    return http.cookies.get_dict()
+
+
+async def send_all(base_url, cookies, count):
+    import httpx
+
+    latencies = []
+    errors = [0]
+    in_flight = [0, 0]
+
+    async def send_one(client, amount):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight[1], in_flight[0])
+        start = time.perf_counter()
+        try:
+            resp = await client.post('/payments/send', data={
+                'send_to': 'friend@example.com', 'amount': amount})
+            if resp.status_code != 200 or not resp.json().get('success'):
+                errors[0] += 1
+        except httpx.HTTPError:
+            errors[0] += 1
+        latencies.append(time.perf_counter() - start)
+        in_flight[0] -= 1
+
+    async with httpx.AsyncClient(
+            base_url=base_url, cookies=cookies, timeout=120,
+            limits=httpx.Limits(max_connections=count)) as client:
+        await asyncio.gather(*(send_one(client, amount)
+                               for amount in range(1, count + 1)))
+    return (sorted(latencies), errors[0], in_flight[1])
+
+
+def unsent_count(app):
+    with app.app_context():
+        return Payment.query.filter_by(push_id=None, status='pending').count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=('asgi', 'wsgi'), default='asgi')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='payments sent at once')
+    parser.add_argument('--authy-latency', type=float, default=0.5,
+                        help='seconds the fake Authy API takes per call')
+    args = parser.parse_args()
+
+    authy = FakeAuthyServer(API_KEY, latency=args.authy_latency)
+    settings = {'WTF_CSRF_ENABLED': False}
+    if args.server == 'asgi':
+        app = create_benchmark_app(authy.start(), **settings)
+        base_url = serve_asgi(app)
+    else:
+        (app, base_url) = start_app(authy.start(), **settings)
+    cookies = log_in(app, base_url)
+
+    start = time.perf_counter()
+    (latencies, errors, client_in_flight) = asyncio.run(
+        send_all(base_url, cookies, args.requests))
+    sent = time.perf_counter() - start
+    while unsent_count(app):
+        time.sleep(0.05)
+    pushed = time.perf_counter() - start
+    authy.stop()
+
+    config = app.config
+    print(json.dumps({
+        'config': vars(args),
+        'threads': dict({
+            'asgi': {'db': config['ASGI_DB_THREADS'],
+                     'wsgi': config['ASGI_WSGI_THREADS']},
+            'wsgi': {},
+        }[args.server], outbox=config['OUTBOX_CONCURRENCY']),
+        'errors': errors,
+        'sends_in_flight_max': client_in_flight,
+        'authy_requests_in_flight_max': authy.max_in_flight,
+        'all_sends_answered_sec': round(sent, 2),
+        'all_pushes_sent_sec': round(pushed, 2),
+        'send_p50_ms': percentile(latencies, 50),
+        'send_p99_ms': percentile(latencies, 99),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
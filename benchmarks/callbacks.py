@@ -0,0 +1,130 @@
+"""
+Replays signed OneTouch callbacks against payfriend at a fixed rate.
+
+Creates pending payments directly in a fresh database, then posts one
+callback per payment (plus duplicate deliveries, like Authy's retries)
+from a pool of senders at ``--rate`` callbacks per second. Reports how
+fast callbacks were acknowledged, their latency, and how long it took
+until every payment had its final status, as JSON:
+
+    python -m benchmarks.callbacks --payments 10000 --rate 1000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from benchmarks.fake_authy_server import sign_callback
+from benchmarks.load import API_KEY, Recorder, start_app
+from payfriend import db
+from payfriend.models import Payment, User
+
+
+def create_payments(app, count):
+    """
+    Inserts ``count`` pending payments that already have a push_id.
+
+    :returns: the push_ids
+    """
+    push_ids = [str(uuid.uuid4()) for _ in range(count)]
+    with app.app_context():
+        user = User('bench@example.com', 'password', '+15105550000')
+        user.authy_id = '1'
+        db.session.add(user)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Payment, [
+            {'id': str(uuid.uuid4()), 'authy_id': '1',
+             'send_to': 'friend@example.com', 'amount': 1,
+             'push_id': push_id, 'status': 'pending'}
+            for push_id in push_ids])
+        db.session.commit()
+    return push_ids
+
+
+def pending_count(app):
+    with app.app_context():
+        return Payment.query.filter_by(status='pending').count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--payments', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='callbacks sent per second')
+    parser.add_argument('--duplicates', type=float, default=0.2,
+                        help='fraction of callbacks delivered twice')
+    parser.add_argument('--senders', type=int, default=32,
+                        help='concurrent callback connections')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for all statuses to apply')
+    args = parser.parse_args()
+
+    (app, base_url) = start_app('http://127.0.0.1:9')
+    push_ids = create_payments(app, args.payments)
+    deliveries = push_ids + random.sample(
+        push_ids, int(len(push_ids) * args.duplicates))
+    random.shuffle(deliveries)
+
+    recorder = Recorder()
+    callback_url = base_url + '/payments/callback'
+    # one keep-alive connection per sender thread
+    local = threading.local()
+
+    def deliver(push_id):
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = local.http = requests.Session()
+        params = {
+            'callback_action': 'approval_request_status',
+            'uuid': push_id,
+            'status': 'approved',
+        }
+        nonce = str(time.time())
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Authy-Signature-Nonce': nonce,
+            'X-Authy-Signature': sign_callback(
+                API_KEY, nonce, 'POST', callback_url, params),
+        }
+        sent = time.perf_counter()
+        try:
+            ok = http.post(callback_url, data=json.dumps(params),
+                           headers=headers, timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        recorder.record('payments.callback', time.perf_counter() - sent, ok)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.senders) as pool:
+        for (i, push_id) in enumerate(deliveries):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(deliver, push_id)
+    acked = time.perf_counter() - start
+
+    deadline = start + args.timeout
+    pending = pending_count(app)
+    while pending and time.perf_counter() < deadline:
+        time.sleep(0.05)
+        pending = pending_count(app)
+    applied = time.perf_counter() - start
+
+    report = {
+        'config': vars(args),
+        'callbacks_sent': len(deliveries),
+        'ack_sec': round(acked, 2),
+        'ack_throughput_rps': round(len(deliveries) / acked, 2),
+        'all_applied_sec': round(applied, 2),
+        'still_pending': pending,
+        'endpoints': recorder.report(acked),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Measures the streaming payment export on a large account.
+
+Seeds one user with ``--rows`` payments (a million by default) in a
+fresh SQLite database, then downloads ``/payments/export`` in each
+format through the app, reading the response as it streams. Reports,
+as JSON, rows per second, bytes written and the process's peak RSS
+before and after each export: a flat peak means memory doesn't grow
+with the number of rows.
+
+    python -m benchmarks.export --rows 1000000
+
+``--compare-all`` also times loading every row with ``.all()``, as
+``list.json`` does for a page, to show the memory that avoids. It
+runs last, since peak RSS only ever goes up.
+"""
+import argparse
+import json
+import resource
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from benchmarks.load import create_benchmark_app
+from payfriend import db
+from payfriend.models import User
+from payfriend.payment import get_user_payments
+
+EMAIL = 'export@example.com'
+AUTHY_ID = 1
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def seed(app, rows, batch=10000):
+    """
+    Inserts a user and ``rows`` payments spread over the last year,
+    ``batch`` at a time so seeding doesn't inflate the peak RSS.
+    """
+    with app.app_context():
+        user = User(EMAIL, 'password', '+15105550100', 1, '5105550100')
+        user.authy_id = AUTHY_ID
+        db.session.add(user)
+        db.session.commit()
+
+        start = datetime.utcnow() - timedelta(days=365)
+        step = timedelta(days=365) / rows
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            for offset in range(0, rows, batch):
+                cursor.executemany(
+                    'INSERT INTO payments (id, authy_id, send_to, amount,'
+                    ' push_id, status, created_at)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((str(uuid.uuid4()), AUTHY_ID,
+                      'friend{}@example.com'.format(i % 1000), i % 5000 + 1,
+                      str(uuid.uuid4()), i % 3,
+                      (start + step * i).strftime('%Y-%m-%d %H:%M:%S.%f'))
+                     for i in range(offset, min(offset + batch, rows))))
+                conn.commit()
+        finally:
+            conn.close()
+
+
+def login(client):
+    with client.session_transaction() as session:
+        with client.application.app_context():
+            session['user_id'] = User.query.filter_by(email=EMAIL).one().id
+
+
+def export(client, query):
+    """
+    Downloads an export chunk by chunk, as a client would.
+    """
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    resp = client.get('/payments/export?' + query, buffered=False)
+    rows = 0
+    size = 0
+    try:
+        for chunk in resp.response:
+            size += len(chunk)
+            rows += chunk.count(b'\n')
+    finally:
+        resp.close()
+    elapsed = time.perf_counter() - start
+
+    # the CSV header is a line too
+    if 'format=ndjson' not in query:
+        rows -= 1
+    return {
+        'status': resp.status_code,
+        'rows': rows,
+        'megabytes': round(size / 1e6, 1),
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed),
+        'peak_rss_before_mb': before,
+        'peak_rss_after_mb': peak_rss_mb(),
+    }
+
+
+def load_all(app):
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    with app.app_context():
+        rows = len(get_user_payments(EMAIL).all())
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed),
+        'peak_rss_before_mb': before,
+        'peak_rss_after_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='payments to seed and export')
+    parser.add_argument('--compare-all', action='store_true',
+                        help='also load every row at once with .all()')
+    args = parser.parse_args()
+
+    # the export never calls Authy
+    app = create_benchmark_app('http://127.0.0.1:9')
+    start = time.perf_counter()
+    seed(app, args.rows)
+    seed_seconds = round(time.perf_counter() - start, 1)
+
+    client = app.test_client()
+    login(client)
+    report = {
+        'rows': args.rows,
+        'seed_seconds': seed_seconds,
+        'exports': {
+            'csv': export(client, 'format=csv'),
+            'ndjson': export(client, 'format=ndjson'),
+            'csv_approved_last_90_days': export(client, 'status=approved&since={}'.format(
+                (datetime.utcnow() - timedelta(days=90)).strftime('%Y-%m-%d'))),
+        },
+    }
+    if args.compare_all:
+        report['load_all'] = load_all(app)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+A local HTTP stand-in for the Authy API, for benchmarks.
+
+Serves the endpoints payfriend calls with a configurable latency, and
+approves (or denies) every OneTouch request after a delay by posting a
+signed callback to the app, like Authy does. Point the app at it with
+``AUTHY_API_URI``:
+
+    python -m benchmarks.fake_authy_server --port 9000 --api-key secret \
+        --callback-url http://127.0.0.1:5000/payments/callback
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from payfriend.fake_authy import FAKE_CODE
+from payfriend.onetouch import OneTouchVerifier
+
+
+def sign_callback(api_key, nonce, method, url, params):
+    """
+    Computes the X-Authy-Signature header for a OneTouch callback.
+    """
+    return OneTouchVerifier(api_key).sign(nonce, method, url, params)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeAuthyServer:
+    """
+    :param api_key: key used to sign callbacks; must match the app's
+        ``AUTHY_API_KEY``
+    :param callback_url: the app's ``/payments/callback`` URL, or None
+        to never send callbacks
+    :param latency: seconds to wait before answering each API call
+    :param approve_after: seconds between a push request and its callback
+    :param deny_ratio: fraction of push requests to deny
+    :param on_callback: called with (seconds, status_code) after each
+        callback is delivered
+
+    ``max_in_flight`` records the most API calls it was answering at
+    once.
+    """
+    def __init__(self, api_key, callback_url=None, latency=0.0,
+                 approve_after=0.5, deny_ratio=0.0, on_callback=None,
+                 host='127.0.0.1', port=0):
+        self.api_key = api_key
+        self._signer = OneTouchVerifier(api_key)
+        self.callback_url = callback_url
+        self.latency = latency
+        self.approve_after = approve_after
+        self.deny_ratio = deny_ratio
+        self.on_callback = on_callback
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._callbacks = requests.Session()
+        self._server = _ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        (host, port) = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def send_callback(self, push_id, status, retries=5):
+        """
+        Posts a signed OneTouch callback to the app, retrying while the
+        app doesn't know the push_id yet.
+        """
+        params = {
+            'callback_action': 'approval_request_status',
+            'uuid': push_id,
+            'status': status,
+        }
+        nonce = str(time.time())
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Authy-Signature-Nonce': nonce,
+            'X-Authy-Signature': self._signer.sign(
+                nonce, 'POST', self.callback_url, params),
+        }
+        for attempt in range(retries):
+            start = time.perf_counter()
+            try:
+                resp = self._callbacks.post(
+                    self.callback_url, data=json.dumps(params),
+                    headers=headers, timeout=30)
+                status_code = resp.status_code
+            except requests.RequestException:
+                status_code = 0
+            if self.on_callback is not None:
+                self.on_callback(time.perf_counter() - start, status_code)
+            if status_code != 404 and status_code != 0:
+                return status_code
+            time.sleep(0.1 * (attempt + 1))
+        return status_code
+
+    def _approve_later(self, push_id):
+        if not self.callback_url:
+            return
+        status = 'denied' if random.random() < self.deny_ratio else 'approved'
+        timer = threading.Timer(
+            self.approve_after, self.send_callback, (push_id, status))
+        timer.daemon = True
+        timer.start()
+
+    def _route(self, method, path, query, body):
+        if path == '/protected/json/phones/verification/start':
+            return (200, {
+                'success': True,
+                'message': 'Text message sent to +{} {}.'.format(
+                    body.get('country_code'), body.get('phone_number')),
+                'seconds_to_expire': 599
+            })
+        if path == '/protected/json/phones/verification/check':
+            if query.get('verification_code') != FAKE_CODE:
+                message = 'Verification code is incorrect'
+                return (401, {'success': False, 'message': message,
+                              'errors': {'message': message}})
+            return (200, {'success': True,
+                          'message': 'Verification code is correct.'})
+        if path == '/protected/json/users/new':
+            return (200, {'success': True, 'message': 'User created successfully.',
+                          'user': {'id': next(self._ids)}})
+        if path.startswith('/protected/json/sms/'):
+            return (200, {'success': True, 'message': 'SMS token was sent'})
+        if path.startswith('/protected/json/verify/'):
+            if path.split('/')[4] != FAKE_CODE:
+                message = 'Token is invalid'
+                return (401, {'success': False, 'message': message,
+                              'errors': {'message': message}})
+            return (200, {'success': 'true', 'token': 'is valid',
+                          'message': 'Token is valid.'})
+        if re.match(r'^/onetouch/json/users/\d+/approval_requests$', path):
+            push_id = str(uuid.uuid4())
+            self._approve_later(push_id)
+            return (200, {'success': True,
+                          'approval_request': {'uuid': push_id}})
+        return (404, {'success': False, 'message': 'Not found',
+                      'errors': {'message': 'Not found'}})
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                parts = urlsplit(self.path)
+                query = {k: v[0] for (k, v) in parse_qs(parts.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = {}
+                if length:
+                    body = json.loads(self.rfile.read(length).decode() or '{}')
+
+                with fake._lock:
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                try:
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    (status, content) = fake._route(
+                        self.command, parts.path, query, body)
+                finally:
+                    with fake._lock:
+                        fake.in_flight -= 1
+
+                # compact, because the authy library string-matches
+                # '"token":"is valid"'
+                out = json.dumps(content, separators=(',', ':')).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--callback-url')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--approve-after', type=float, default=0.5)
+    parser.add_argument('--deny-ratio', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeAuthyServer(
+        args.api_key, args.callback_url, args.latency, args.approve_after,
+        args.deny_ratio, host=args.host, port=args.port)
+    print('Fake Authy API listening on {}'.format(server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
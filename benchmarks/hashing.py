@@ -0,0 +1,61 @@
+"""
+Password verification throughput for a range of hash settings.
+
+Reports how many logins per second one core can verify with each
+method, to help choose ``PASSWORD_HASH_METHOD``:
+
+    python -m benchmarks.hashing
+    python -m benchmarks.hashing --method pbkdf2:sha256:260000
+"""
+import argparse
+import json
+import time
+from payfriend.hashing import PasswordHasher
+
+
+DEFAULT_METHODS = (
+    'pbkdf2:sha256:50000',
+    'pbkdf2:sha256:150000',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha512:150000',
+)
+
+
+def logins_per_second(method, salt_length, duration):
+    """
+    Verifies one password repeatedly for ``duration`` seconds in the
+    current thread, which is one core's worth of login throughput.
+    """
+    hasher = PasswordHasher(method, salt_length)
+    pwhash = hasher.hash('correct horse battery staple')
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        hasher.verify(pwhash, 'correct horse battery staple')
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'method': method,
+        'salt_length': salt_length,
+        'logins_per_sec_per_core': round(count / elapsed, 1),
+        'ms_per_login': round(1000 * elapsed / count, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--method', action='append',
+                        help='hash method to measure (repeatable)')
+    parser.add_argument('--salt-length', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds to measure each method for')
+    args = parser.parse_args()
+
+    results = [logins_per_second(method, args.salt_length, args.duration)
+               for method in args.method or DEFAULT_METHODS]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
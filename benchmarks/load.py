@@ -0,0 +1,245 @@
+"""
+Load test for payfriend's payment flows.
+
+Runs the real ``create_app()`` on a local port against a fake Authy
+HTTP server, then has concurrent virtual users register, verify their
+phone, log in, send payments, wait for the OneTouch callback and list
+their payments. Reports throughput and p50/p95/p99 latency per endpoint
+as JSON, so runs can be compared between versions:
+
+    python -m benchmarks.load --users 100 --concurrency 20 > after.json
+    python -m benchmarks.load --baseline before.json
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+from benchmarks.fake_authy_server import FakeAuthyServer
+from payfriend import create_app, schema
+from payfriend.fake_authy import FAKE_CODE
+
+
+API_KEY = 'benchmark-api-key'
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Recorder:
+    """
+    Collects request latencies per endpoint from many threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok=True):
+        with self._lock:
+            self.samples[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for (name, samples) in sorted(self.samples.items()):
+            samples = sorted(samples)
+            endpoints[name] = {
+                'requests': len(samples),
+                'errors': self.errors[name],
+                'throughput_rps': round(len(samples) / elapsed, 2),
+                'mean_ms': round(1000 * sum(samples) / len(samples), 2),
+                'p50_ms': percentile(samples, 50),
+                'p95_ms': percentile(samples, 95),
+                'p99_ms': percentile(samples, 99),
+            }
+        return endpoints
+
+
+def percentile(sorted_samples, pct):
+    index = int(round(pct / 100.0 * (len(sorted_samples) - 1)))
+    return round(1000 * sorted_samples[index], 2)
+
+
+class VirtualUser:
+    """
+    One user's browser session, timing every request it makes.
+    """
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.http = requests.Session()
+
+    def request(self, name, method, path, expect=(200, 302), **kwargs):
+        start = time.perf_counter()
+        try:
+            resp = self.http.request(
+                method, self.base_url + path, allow_redirects=False,
+                timeout=60, **kwargs)
+            ok = resp.status_code in expect
+        except requests.RequestException:
+            resp = None
+            ok = False
+        self.recorder.record(name, time.perf_counter() - start, ok)
+        if not ok:
+            raise RuntimeError('{} {} failed'.format(method, path))
+        return resp
+
+    def form(self, name, path, data):
+        """
+        Loads a form page for its CSRF token, then submits it.
+        """
+        page = self.request(name + ' (GET)', 'GET', path)
+        match = CSRF_TOKEN.search(page.text)
+        if match:
+            data = dict(data, csrf_token=match.group(1))
+        return self.request(name, 'POST', path, data=data)
+
+    def run(self, index, payments, poll_interval, status_timeout):
+        email = 'bench-{}@example.com'.format(index)
+        self.form('auth.register', '/auth/register', {
+            'email': email,
+            'password': 'correct horse battery staple',
+            'phone_number': '510555{:04d}'.format(index % 10000),
+            'full_phone': '+1510555{:04d}'.format(index % 10000),
+            'channel': 'sms',
+        })
+        self.form('auth.verify', '/auth/verify', {'verification_code': FAKE_CODE})
+        self.request('auth.logout', 'GET', '/auth/logout')
+        self.form('auth.login', '/auth/login', {
+            'email': email,
+            'password': 'correct horse battery staple',
+        })
+
+        for amount in range(1, payments + 1):
+            resp = self.form('payments.send', '/payments/send', {
+                'send_to': 'friend@example.com',
+                'amount': amount,
+            })
+            payment_id = resp.json()['payment_id']
+            self.wait_for_status(payment_id, poll_interval, status_timeout)
+
+        self.request('payments.list_payments', 'GET', '/payments/')
+
+    def wait_for_status(self, payment_id, poll_interval, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            resp = self.request('payments.status', 'GET',
+                                '/payments/status?payment_id=' + payment_id)
+            if resp.text != 'pending':
+                return resp.text
+            time.sleep(poll_interval)
+        raise RuntimeError('payment {} still pending'.format(payment_id))
+
+
+def create_benchmark_app(authy_url, **settings):
+    """
+    Creates a production ``create_app()`` with its own fresh database,
+    talking to the Authy API at ``authy_url``.
+    """
+    db_file = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+    os.environ['FLASK_ENV'] = 'production'
+    app = create_app(dict({
+        'SECRET_KEY': 'benchmark',
+        'AUTHY_API_KEY': API_KEY,
+        'AUTHY_BACKEND': 'authy',
+        'AUTHY_API_URI': authy_url,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file.name,
+    }, **settings))
+    with app.app_context():
+        schema.upgrade()
+    return app
+
+
+def start_app(authy_url, **settings):
+    """
+    Serves a fresh ``create_benchmark_app()`` on a local port.
+
+    :returns: (app, base_url)
+    """
+    app = create_benchmark_app(authy_url, **settings)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (app, 'http://127.0.0.1:{}'.format(server.socket.getsockname()[1]))
+
+
+def compare(report, baseline):
+    """
+    Adds the change in p95 latency and throughput against a previous
+    report to each endpoint.
+    """
+    for (name, stats) in report['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if not before:
+            continue
+        stats['vs_baseline'] = {
+            'p95_ms': round(stats['p95_ms'] - before['p95_ms'], 2),
+            'throughput_rps': round(
+                stats['throughput_rps'] - before['throughput_rps'], 2),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50,
+                        help='virtual users to run through the flow')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='virtual users running at once')
+    parser.add_argument('--payments', type=int, default=3,
+                        help='payments sent by each user')
+    parser.add_argument('--authy-latency', type=float, default=0.05,
+                        help='seconds the fake Authy API takes per call')
+    parser.add_argument('--approve-after', type=float, default=0.5,
+                        help='seconds before each push is approved')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--status-timeout', type=float, default=30)
+    parser.add_argument('--baseline', help='earlier report to compare with')
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    authy = FakeAuthyServer(
+        API_KEY, latency=args.authy_latency, approve_after=args.approve_after,
+        on_callback=lambda seconds, status: recorder.record(
+            'payments.callback', seconds, status == 200))
+    (_, base_url) = start_app(authy.start())
+    authy.callback_url = base_url + '/payments/callback'
+
+    failures = []
+
+    def run_user(index):
+        try:
+            VirtualUser(base_url, recorder).run(
+                index, args.payments, args.poll_interval, args.status_timeout)
+        except RuntimeError as e:
+            failures.append(str(e))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(run_user, range(args.users)))
+    elapsed = time.perf_counter() - start
+    authy.stop()
+
+    report = {
+        'config': vars(args),
+        'elapsed_sec': round(elapsed, 2),
+        'failed_users': len(failures),
+        'endpoints': recorder.report(elapsed),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Microbenchmark for OneTouch callback signature checks.
+
+Compares the authy library's ``validate_one_touch_signature`` with
+payfriend's ``OneTouchVerifier``, for new callbacks and for repeated
+deliveries, on a callback body shaped like the ones Authy sends. First
+checks that both agree on a set of varied bodies. Prints verifications
+per second as JSON:
+
+    python -m benchmarks.onetouch --iterations 20000
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from authy.api.resources import OneTouch
+from payfriend.onetouch import DUPLICATE, VALID, OneTouchVerifier
+
+
+API_KEY = 'benchmark-api-key'
+URL = 'https://payfriend.example.com/payments/callback'
+
+
+def callback_body():
+    return {
+        'authy_id': 1234567,
+        'device_uuid': str(uuid.uuid4()),
+        'callback_action': 'approval_request_status',
+        'uuid': str(uuid.uuid4()),
+        'status': 'approved',
+        'approval_request': {
+            'transaction': {
+                'details': {
+                    'Amount': '$12.50',
+                    'Recipient': 'friend@example.com',
+                    'Payment ID': str(uuid.uuid4()),
+                },
+                'device_details': {'ip': '10.0.0.1', 'os': 'iOS 12/3'},
+                'hidden_details': {'transaction_id': 'TXN 123'},
+                'message': 'Request to send money to friend@example.com',
+                'reason': None,
+                'created_at': '2019-03-06T10:00:00Z',
+                'flags': [True, False, {'nested': 'x y'}],
+            },
+            'expiration_timestamp': 1551866400,
+        },
+        'signature': 'a+b/c=',
+    }
+
+
+def check_agreement(library, verifier, count=200):
+    """
+    Raises AssertionError unless both accept each other's signatures.
+    """
+    for _ in range(count):
+        body = callback_body()
+        body['approval_request']['transaction']['details']['Note'] = ''.join(
+            random.choice('ab /+&=%[]0N') for _ in range(12))
+        nonce = str(time.time())
+        signature = verifier.sign(nonce, 'POST', URL, body)
+        assert library.validate_one_touch_signature(
+            signature, nonce, 'POST', URL, body)
+        assert OneTouchVerifier(API_KEY).check(
+            signature, nonce, 'POST', URL, body) == VALID
+
+
+def rate(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return round(iterations / (time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    library = OneTouch('', API_KEY)
+    verifier = OneTouchVerifier(API_KEY, replay_size=args.iterations * 2)
+    check_agreement(library, verifier)
+
+    body = callback_body()
+    # a distinct nonce, and so signature, for each callback
+    signed = []
+    for i in range(args.iterations):
+        nonce = '{:.6f}'.format(time.time() + i * 1e-6)
+        signed.append((nonce, verifier.sign(nonce, 'POST', URL, body)))
+
+    def authy_library(i):
+        (nonce, signature) = signed[i]
+        assert library.validate_one_touch_signature(
+            signature, nonce, 'POST', URL, body)
+
+    def new_callback(i):
+        (nonce, signature) = signed[i]
+        assert verifier.check(signature, nonce, 'POST', URL, body) == VALID
+
+    def repeated_callback(i):
+        (nonce, signature) = signed[i]
+        assert verifier.check(signature, nonce, 'POST', URL, body) == DUPLICATE
+
+    print(json.dumps({
+        'iterations': args.iterations,
+        'verifications_per_sec': {
+            'authy_library': rate(authy_library, args.iterations),
+            'verifier_new': rate(new_callback, args.iterations),
+            'verifier_duplicate': rate(repeated_callback, args.iterations),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Measures anonymous page views and error pages, with and without the
+page cache, and what the asset build saves.
+
+Calls the WSGI app directly, so the numbers are the app's own cost
+per request, without a server or HTTP client. Reports, as JSON,
+requests per second for each page with ``PAGE_CACHE_SIZE=0`` and with
+the default cache, best of ``--runs``; and the size of each static
+file as it is, minified, and precompressed by ``flask build-assets``
+(built in a temporary copy of ``static/``).
+
+    python -m benchmarks.pages --requests 5000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from werkzeug.test import EnvironBuilder
+
+from benchmarks.load import create_benchmark_app
+from payfriend.assets import build
+
+PAGES = ('/', '/auth/login', '/auth/register', '/no-such-page')
+
+
+def requests_per_second(app, path, requests, runs):
+    environ = EnvironBuilder(path=path).get_environ()
+
+    def start_response(status, headers):
+        pass
+
+    best = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = app(dict(environ), start_response)
+            for _ in response:
+                pass
+            response.close()
+        best = max(best, requests / (time.perf_counter() - start))
+    return round(best)
+
+
+def asset_sizes(static_folder):
+    """
+    Builds a copy of ``static_folder`` and reports each text file's
+    size in bytes before and after.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        copy = os.path.join(folder, 'static')
+        shutil.copytree(static_folder, copy)
+        manifest = build(copy)
+        sizes = {}
+        for (source, entry) in sorted(manifest.items()):
+            if not entry['encodings']:
+                continue
+            built = os.path.join(copy, entry['path'])
+            sizes[source] = {
+                'original': os.path.getsize(os.path.join(copy, source)),
+                'minified': os.path.getsize(built),
+            }
+            for (encoding, ext) in (('gzip', '.gz'), ('br', '.br')):
+                if encoding in entry['encodings']:
+                    sizes[source][encoding] = os.path.getsize(built + ext)
+        return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='requests per page per run')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs per page, the best is reported')
+    args = parser.parse_args()
+
+    # these pages never call Authy
+    uncached = create_benchmark_app('http://127.0.0.1:9', PAGE_CACHE_SIZE=0)
+    cached = create_benchmark_app('http://127.0.0.1:9')
+    report = {'requests_per_sec': {}}
+    for path in PAGES:
+        report['requests_per_sec'][path] = {
+            'uncached': requests_per_second(
+                uncached, path, args.requests, args.runs),
+            'cached': requests_per_second(
+                cached, path, args.requests, args.runs),
+        }
+    report['asset_bytes'] = asset_sizes(cached.static_folder)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
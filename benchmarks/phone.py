@@ -0,0 +1,83 @@
+"""
+Measures what phone number parsing costs payfriend.
+
+Reports, as JSON:
+
+- the import time of ``payfriend.utils`` in a fresh interpreter, which
+  no longer loads ``phonenumbers``, and of ``phonenumbers`` itself,
+  which is now paid on the first parse instead of at startup
+- per-call time of ``phonenumbers.parse`` (what every register, verify
+  and verification redirect used to cost), of the cached
+  ``utils.parse_phone_number``, and of ``utils.user_phone`` reading the
+  parts stored on the user
+
+    python -m benchmarks.phone --iterations 100000
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+PHONES = ['+1510555{:04d}'.format(i) for i in range(100)]
+
+
+def import_seconds(module, runs=5):
+    """
+    Best-of-``runs`` time to import ``module`` in a fresh interpreter.
+    """
+    code = ('import time; start = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - start)').format(module)
+    return min(float(subprocess.check_output([sys.executable, '-c', code]))
+               for _ in range(runs))
+
+
+def per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(PHONES[i % len(PHONES)])
+    return round(1e6 * (time.perf_counter() - start) / iterations, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    cold_start = {
+        'payfriend_utils_ms': round(1000 * import_seconds('payfriend.utils'), 1),
+        'phonenumbers_ms': round(1000 * import_seconds('phonenumbers'), 1),
+    }
+
+    import phonenumbers
+    from payfriend import utils
+    from payfriend.models import UserSnapshot
+
+    class Stored:
+        def __init__(self, phone):
+            (self.country_code, self.national_number) = \
+                utils.parse_phone_number(phone)
+            self.phone_number = phone
+            self.id = self.email = self.authy_id = None
+
+    users = {phone: UserSnapshot(Stored(phone)) for phone in PHONES}
+
+    def uncached(phone):
+        pn = phonenumbers.parse(phone)
+        return (pn.country_code, pn.national_number)
+
+    print(json.dumps({
+        'iterations': args.iterations,
+        'cold_start': cold_start,
+        'per_call_us': {
+            'phonenumbers_parse': per_call_us(uncached, args.iterations),
+            'parse_phone_number_cached': per_call_us(
+                utils.parse_phone_number, args.iterations),
+            'user_phone_stored': per_call_us(
+                lambda phone: utils.user_phone(users[phone]), args.iterations),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Measures how long a payfriend worker takes to start.
+
+Reports, as JSON:
+
+- time from spawning a fresh interpreter until a local server running
+  ``create_app()`` answers its first request, best of ``--runs``
+- time spent importing ``payfriend`` and in ``create_app()``
+- import time per top-level package during startup, from
+  ``python -X importtime``
+- whether the heavy optional modules (authy, requests, wtforms,
+  phonenumbers) were loaded before the first request
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+
+# run in the child interpreter; prints timings as JSON once serving
+SERVE = '''
+import json, logging, sys, time
+start = time.perf_counter()
+import payfriend
+imported = time.perf_counter()
+app = payfriend.create_app({{'SQLALCHEMY_DATABASE_URI': {db!r}}})
+created = time.perf_counter()
+from werkzeug.serving import make_server
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+server = make_server('127.0.0.1', {port}, app)
+print(json.dumps({{
+    'import_ms': round(1000 * (imported - start), 1),
+    'create_app_ms': round(1000 * (created - imported), 1),
+    'heavy_modules': [m for m in {heavy!r} if m in sys.modules],
+}}), flush=True)
+server.handle_request()
+'''
+
+HEAVY_MODULES = ('authy', 'requests', 'wtforms', 'phonenumbers')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def child_env():
+    env = dict(os.environ, FLASK_ENV='production', FLASK_SKIP_DOTENV='1')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (
+        os.getcwd(), env.get('PYTHONPATH'))))
+    return env
+
+
+def first_response(db):
+    """
+    Spawns a server and times it until it answers ``GET /``.
+    """
+    port = free_port()
+    code = SERVE.format(db=db, port=port, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    child = subprocess.Popen([sys.executable, '-c', code],
+                             stdout=subprocess.PIPE, env=child_env())
+    timings = json.loads(child.stdout.readline())
+    while True:
+        try:
+            urllib.request.urlopen(
+                'http://127.0.0.1:{}/'.format(port), timeout=10).read()
+            break
+        except OSError:
+            time.sleep(0.001)
+    timings['first_response_ms'] = round(
+        1000 * (time.perf_counter() - start), 1)
+    child.wait()
+    return timings
+
+
+def import_breakdown(db, top):
+    """
+    Parses ``-X importtime`` output for a ``create_app()`` call.
+
+    :returns: the ``top`` top-level packages that took longest to
+        import, counting each module's own time towards its package
+    """
+    code = ('import payfriend; '
+            'payfriend.create_app({{"SQLALCHEMY_DATABASE_URI": {!r}}})'
+            ).format(db)
+    err = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, env=child_env(),
+        universal_newlines=True).stderr
+    packages = defaultdict(int)
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (own, _, name) = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(own)
+    slowest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return [{'package': name, 'ms': round(us / 1000.0, 1)}
+            for (name, us) in slowest]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15,
+                        help='slowest packages to list')
+    args = parser.parse_args()
+
+    db = 'sqlite:///' + tempfile.NamedTemporaryFile(
+        suffix='.sqlite', delete=False).name
+    runs = [first_response(db) for _ in range(args.runs)]
+    best = min(runs, key=lambda run: run['first_response_ms'])
+
+    print(json.dumps({
+        'runs': args.runs,
+        'best': best,
+        'imports': import_breakdown(db, args.top),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
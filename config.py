@@ -1,21 +1,161 @@
 import os
-from dotenv import load_dotenv, find_dotenv
+
+
+def optional_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def database_url(default):
+    url = os.environ.get('DATABASE_URL', default)
+    # SQLAlchemy only accepts the postgresql:// spelling
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
 
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'not-so-secret')
     AUTHY_API_KEY = os.environ.get('AUTHY_API_KEY')
+    # 'authy' for the real API, 'fake' for payfriend.fake_authy
+    AUTHY_BACKEND = os.environ.get('AUTHY_BACKEND', 'authy')
+    AUTHY_API_URI = os.environ.get('AUTHY_API_URI', 'https://api.authy.com')
+    # keep-alive connections held open to the Authy API
+    AUTHY_POOL_SIZE = int(os.environ.get('AUTHY_POOL_SIZE', 10))
+    AUTHY_HTTP_TIMEOUT = float(os.environ.get('AUTHY_HTTP_TIMEOUT', 5))
+    # calls that fail to connect are retried AUTHY_RETRIES times, as
+    # long as the retry starts within AUTHY_TIMEOUT seconds
+    AUTHY_TIMEOUT = float(os.environ.get('AUTHY_TIMEOUT', 10))
+    AUTHY_RETRIES = int(os.environ.get('AUTHY_RETRIES', 2))
+    AUTHY_RETRY_BACKOFF = float(os.environ.get('AUTHY_RETRY_BACKOFF', 0.5))
     db_path = os.path.join(os.path.dirname(__file__), 'payfriend.sqlite')
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(db_path)
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_DATABASE_URI = database_url('sqlite:///{}'.format(db_path))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # connection pool settings, for server databases such as Postgres;
+    # left unset, SQLAlchemy's defaults for the database are used
+    SQLALCHEMY_POOL_SIZE = optional_int('DATABASE_POOL_SIZE')
+    SQLALCHEMY_MAX_OVERFLOW = optional_int('DATABASE_MAX_OVERFLOW')
+    SQLALCHEMY_POOL_TIMEOUT = optional_int('DATABASE_POOL_TIMEOUT')
+    SQLALCHEMY_POOL_RECYCLE = optional_int('DATABASE_POOL_RECYCLE')
+    # SQLite only: WAL lets readers run alongside a writer, and writers
+    # wait up to SQLITE_BUSY_TIMEOUT ms for a lock instead of failing
+    SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') == '1'
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 10000))
+    # create or migrate the schema in create_app, instead of with
+    # `flask init-db`
+    DATABASE_AUTO_UPGRADE = False
+    # werkzeug hash method, including the pbkdf2 iteration count;
+    # existing hashes are upgraded when their owner next logs in
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+    # processes to verify passwords in, 0 to verify in the request thread
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))
+    # logged in users are cached for USER_CACHE_TTL seconds; changes
+    # made by other worker processes show up once their entry expires
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+    USERS_PAGE_SIZE = int(os.environ.get('USERS_PAGE_SIZE', 50))
+    COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 300))
+    PAYMENTS_PAGE_SIZE = int(os.environ.get('PAYMENTS_PAGE_SIZE', 50))
+    PAYMENTS_MAX_PAGE_SIZE = int(os.environ.get('PAYMENTS_MAX_PAGE_SIZE', 500))
+    # verification codes: at most one per phone every
+    # VERIFICATION_DEDUP_WINDOW seconds (how long a code stays valid),
+    # and bursts of VERIFICATION_BURST refilled at VERIFICATION_PER_HOUR.
+    # 'memory' throttles per process, 'database' across all of them
+    VERIFICATION_THROTTLE_BACKEND = os.environ.get('VERIFICATION_THROTTLE_BACKEND', 'memory')
+    VERIFICATION_DEDUP_WINDOW = int(os.environ.get('VERIFICATION_DEDUP_WINDOW', 600))
+    VERIFICATION_BURST = int(os.environ.get('VERIFICATION_BURST', 3))
+    VERIFICATION_PER_HOUR = float(os.environ.get('VERIFICATION_PER_HOUR', 4))
+    # 'cookie' keeps sessions in Flask's signed cookie; 'database' and
+    # 'memory' (per process, for tests) keep them on the server with
+    # only an ID in the cookie. SESSION_CACHE_SIZE bounds 'memory'
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'cookie')
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+    # OneTouch callbacks are acknowledged immediately and written in
+    # batches of up to CALLBACK_BATCH_SIZE, at most CALLBACK_FLUSH_INTERVAL
+    # seconds apart
+    CALLBACK_BATCH_SIZE = int(os.environ.get('CALLBACK_BATCH_SIZE', 200))
+    CALLBACK_FLUSH_INTERVAL = float(os.environ.get('CALLBACK_FLUSH_INTERVAL', 0.05))
+    CALLBACK_QUEUE_SIZE = int(os.environ.get('CALLBACK_QUEUE_SIZE', 10000))
+    # recent callback uuids remembered to drop duplicate deliveries
+    CALLBACK_DEDUP_SIZE = int(os.environ.get('CALLBACK_DEDUP_SIZE', 100000))
+    # OneTouch callbacks signed longer ago than this, in seconds, are
+    # rejected; repeats of newer ones are caught by a replay cache
+    ONETOUCH_NONCE_MAX_AGE = int(os.environ.get('ONETOUCH_NONCE_MAX_AGE', 300))
+    ONETOUCH_REPLAY_CACHE_SIZE = int(os.environ.get('ONETOUCH_REPLAY_CACHE_SIZE', 100000))
+    # the callback URL configured in the Authy dashboard, if it differs
+    # from the URL the app sees (e.g. behind a proxy)
+    ONETOUCH_CALLBACK_URL = os.environ.get('ONETOUCH_CALLBACK_URL')
+    # payfriend.asgi: threads for database work and for requests
+    # passed through to Flask
+    ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS', 8))
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+    # request timers and SQL query counts, exported at /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+    # the /metrics endpoints only answer requests with the header
+    # "Authorization: Bearer METRICS_TOKEN", and aren't added without it
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # sample request stacks for flame graphs at /metrics/profile;
+    # needs METRICS_ENABLED
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') == '1'
+    PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.005))
+    # payments per /payments/bulk batch
+    BULK_MAX_PAYMENTS = int(os.environ.get('BULK_MAX_PAYMENTS', 1000))
+    # Authy requests queued in the outbox are claimed OUTBOX_BATCH_SIZE
+    # at a time and sent OUTBOX_CONCURRENCY at once per worker; a worker
+    # that holds a claim longer than OUTBOX_LEASE seconds is presumed
+    # dead. Sends that couldn't connect are tried OUTBOX_MAX_ATTEMPTS
+    # times, backing off from OUTBOX_RETRY_BACKOFF seconds. With OUTBOX_INLINE_DRAIN each
+    # server process runs a worker too; turn it off to only send from
+    # `flask outbox-worker`
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+    OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 8))
+    OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))
+    OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', 60))
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+    OUTBOX_RETRY_BACKOFF = float(os.environ.get('OUTBOX_RETRY_BACKOFF', 2))
+    OUTBOX_INLINE_DRAIN = os.environ.get('OUTBOX_INLINE_DRAIN', '1') == '1'
+    # overdue pending payments are expired every PAYMENT_SWEEP_INTERVAL
+    # seconds (0 to only expire them with `flask expire-payments`),
+    # PAYMENT_SWEEP_BATCH_SIZE per transaction
+    PAYMENT_SWEEP_INTERVAL = float(os.environ.get('PAYMENT_SWEEP_INTERVAL', 60))
+    PAYMENT_SWEEP_BATCH_SIZE = int(os.environ.get('PAYMENT_SWEEP_BATCH_SIZE', 500))
+    # final payment statuses remembered so status checks skip the database
+    STATUS_CACHE_SIZE = int(os.environ.get('STATUS_CACHE_SIZE', 10000))
+    # anonymous pages and error pages are rendered once per process and
+    # kept, PAGE_CACHE_SIZE of them; 0 renders every request
+    PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 64))
+    # compiled templates are kept here, shared by every worker;
+    # defaults to the instance folder
+    JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR')
+    # serve the fingerprinted, precompressed files made by
+    # `flask build-assets`, which browsers keep for ASSETS_MAX_AGE seconds
+    USE_BUILT_ASSETS = os.environ.get('USE_BUILT_ASSETS', '1') == '1'
+    ASSETS_MAX_AGE = int(os.environ.get('ASSETS_MAX_AGE', 365 * 24 * 3600))
+    # long-poll hold time for /payments/status/wait, in seconds. Under a
+    # sync WSGI server each waiting send page holds a worker thread for
+    # up to STATUS_WAIT_TIMEOUT; serve with payfriend.asgi, or size the
+    # thread pool for it
+    STATUS_WAIT_TIMEOUT = int(os.environ.get('STATUS_WAIT_TIMEOUT', 25))
+    STATUS_WAIT_POLL_INTERVAL = int(os.environ.get('STATUS_WAIT_POLL_INTERVAL', 5))
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    # show template and static file changes straight away
+    PAGE_CACHE_SIZE = 0
+    USE_BUILT_ASSETS = False
 
 class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    AUTHY_BACKEND = 'fake'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    DATABASE_AUTO_UPGRADE = True
+    PAYMENT_SWEEP_INTERVAL = 0
+    # tests drain the outbox themselves; the in-memory database is one
+    # connection, which threads can't share
+    OUTBOX_INLINE_DRAIN = False
+    OUTBOX_CONCURRENCY = 1
 
 class ProductionConfig(Config):
     DEBUG = False
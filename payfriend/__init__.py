@@ -1,35 +1,181 @@
+import click
 import os
-from config import config
-from dotenv import load_dotenv, find_dotenv
-from flask import Flask, render_template, g
+from flask import Flask, render_template, g, request
+from flask.helpers import get_load_dotenv
 from flask_sqlalchemy import SQLAlchemy
 
 
 db = SQLAlchemy()
 
 
-def create_app():
-    """Create and configure an instance of the Flask application."""
-    app = Flask(__name__)
+def load_env():
+    """
+    Loads a .env file into the environment, if there is one.
 
+    Set ``FLASK_SKIP_DOTENV=1`` when the environment is provided some
+    other way, e.g. by a process manager, to skip searching for it.
+    """
+    if not get_load_dotenv():
+        return
+    from dotenv import load_dotenv, find_dotenv
     load_dotenv(find_dotenv())
+
+
+def create_app(test_config=None):
+    """
+    Create and configure an instance of the Flask application.
+
+    :param test_config: settings that override the configuration
+        selected by ``FLASK_ENV``
+    """
+    app = Flask(__name__)
+
+    # config reads the environment when it's imported, so the .env
+    # file has to be loaded first
+    load_env()
+    from config import config
     config_name = os.environ.get('FLASK_ENV', 'default')
     app.config.from_object(config[config_name])
+    if test_config is not None:
+        app.config.update(test_config)
 
     # register the database
-    from payfriend import models
+    from payfriend import models, schema
+    from payfriend.hashing import hashing
     db.init_app(app)
-    db.create_all(app=app)
+    hashing.init_app(app)
+    with app.app_context():
+        schema.configure_engine(app)
+        if app.config['DATABASE_AUTO_UPGRADE']:
+            schema.upgrade()
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the database, or migrate it to the latest schema."""
+        (old, new) = schema.upgrade()
+        click.echo('Database schema at version {} (was {}).'.format(new, old))
+
+    @app.cli.command('rebuild-aggregates')
+    @click.option('--chunk-size', default=500,
+                  help='Users recomputed per transaction.')
+    def rebuild_aggregates(chunk_size):
+        """Recompute the payment aggregates from the payments table."""
+        from payfriend.aggregates import rebuild
+        click.echo('Rebuilt aggregates for {} users.'.format(
+            rebuild(chunk_size)))
+
+    @app.cli.command('check-indexes')
+    def check_indexes():
+        """Fail if hot-path payment queries stop using their indexes."""
+        problems = schema.check_query_plans()
+        for problem in problems:
+            click.echo(problem, err=True)
+        if problems:
+            raise SystemExit(1)
+        click.echo('All query plans use their indexes.')
+
+    # logged in user snapshots, see auth.load_logged_in_user
+    from payfriend.cache import LRUCache
+    app.extensions['user_cache'] = LRUCache(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'])
+
+    # cached row counts, see auth.count_users
+    app.extensions['count_cache'] = LRUCache(
+        maxsize=64, ttl=app.config['COUNT_CACHE_TTL'])
+
+    # server-side sessions, if configured
+    from payfriend.sessions import sessions
+    sessions.init_app(app)
+
+    # final payment statuses, see payment.payment_status
+    app.extensions['status_cache'] = LRUCache(
+        maxsize=app.config['STATUS_CACHE_SIZE'])
+
+    # outbound Authy calls
+    from payfriend.clients import authy_clients
+    from payfriend.throttle import throttle
+    authy_clients.init_app(app)
+    throttle.init_app(app)
+
+    # inbound OneTouch callbacks
+    from payfriend.callbacks import callbacks
+    from payfriend.onetouch import onetouch
+    callbacks.init_app(app)
+    onetouch.init_app(app)
+
+    # expiring payments nobody answered
+    from payfriend.expiry import expiry
+    expiry.init_app(app)
+
+    @app.cli.command('expire-payments')
+    def expire_payments():
+        """Mark overdue pending payments expired."""
+        click.echo('Expired {} payments.'.format(expiry.sweep()))
+
+    # Authy requests saved with the changes that call for them
+    from payfriend.outbox import outbox
+    outbox.init_app(app)
+
+    @app.cli.command('outbox-worker')
+    @click.option('--once', is_flag=True,
+                  help='Send what is ready, then exit.')
+    def outbox_worker(once):
+        """Send the Authy requests queued in the outbox."""
+        if once:
+            click.echo('Handled {} messages.'.format(outbox.worker.drain()))
+            return
+        outbox.worker.run()
+
+    # templates compiled once for every worker, pages rendered once
+    # per process for anonymous visitors, and built static files
+    from payfriend.assets import assets
+    from payfriend.pages import page_cache, use_bytecode_cache
+    use_bytecode_cache(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
+
+    @app.cli.command('build-assets')
+    def build_assets():
+        """Fingerprint, minify and compress static files; compile templates."""
+        from payfriend import assets
+        for (module, step) in ((assets.rjsmin, 'minifying JavaScript'),
+                               (assets.brotli, 'writing brotli copies')):
+            if module is None:
+                click.secho('Not {}: pip install -r requirements-assets.txt'
+                            .format(step), fg='yellow', err=True)
+        manifest = assets.build(app.static_folder)
+        click.echo('Built {} static files.'.format(len(manifest)))
+        templates = app.jinja_env.list_templates()
+        for name in templates:
+            app.jinja_env.get_template(name)
+        click.echo('Compiled {} templates.'.format(len(templates)))
 
     @app.route('/')
+    @page_cache.cached
     def index():
         return render_template('index.html')
 
     @app.route('/users')
     def list_users():
-        from payfriend.models import User
-        users = User.query.all()
-        return render_template('users.html', users=users)
+        from payfriend.auth import count_users, get_users_page
+        prefix = request.args.get('q', '').strip()
+        after = request.args.get('after')
+        limit = app.config['USERS_PAGE_SIZE']
+
+        # fetch one extra row to find out whether there's a next page
+        users = get_users_page(prefix, after, limit + 1).all()
+        next_after = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_after = users[-1].email
+
+        return render_template('users.html', users=users, prefix=prefix,
+                               next_after=next_after, total=count_users())
+
+    # opt-in instrumentation, see payfriend.metrics
+    from payfriend.metrics import metrics
+    metrics.init_app(app)
 
     # apply the blueprints to the app
     from payfriend import auth, payment
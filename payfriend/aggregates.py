@@ -0,0 +1,125 @@
+from collections import defaultdict
+from sqlalchemy import bindparam, text
+from payfriend import db
+from payfriend.models import Payment, PaymentAggregate, PaymentStatus, User
+
+
+# adds to an aggregate row, creating it if need be (SQLite 3.24+ and
+# Postgres both support ON CONFLICT)
+_UPSERT = text(
+    'INSERT INTO payment_aggregates'
+    ' (authy_id, status, payment_count, amount_total)'
+    ' VALUES (:authy_id, :status, :payment_count, :amount_total)'
+    ' ON CONFLICT (authy_id, status) DO UPDATE SET'
+    ' payment_count = payment_aggregates.payment_count'
+    ' + excluded.payment_count,'
+    ' amount_total = payment_aggregates.amount_total'
+    ' + excluded.amount_total'
+).bindparams(bindparam('status', type_=PaymentStatus()))
+
+
+class Tally:
+    """
+    Collects changes to the payment aggregates, to write them in the
+    same transaction as the payments they describe.
+    """
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, 0])
+
+    def add(self, authy_id, status, amount, count=1):
+        """
+        Counts ``count`` payments totalling ``amount`` in ``status``;
+        negative to take them away.
+        """
+        delta = self._deltas[(authy_id, status)]
+        delta[0] += count
+        delta[1] += amount or 0
+
+    def move(self, authy_id, amount, old_status, new_status):
+        """
+        Counts a payment's change from ``old_status`` to ``new_status``.
+        """
+        self.add(authy_id, old_status, -(amount or 0), count=-1)
+        self.add(authy_id, new_status, amount)
+
+    def save(self):
+        """
+        Writes the changes in the session's current transaction. The
+        caller commits.
+        """
+        params = [{
+            'authy_id': authy_id,
+            'status': status,
+            'payment_count': count,
+            'amount_total': total,
+        } for ((authy_id, status), (count, total)) in self._deltas.items()
+            if count or total]
+        if params:
+            db.session.execute(_UPSERT, params)
+        self._deltas.clear()
+
+
+def user_summary(authy_id):
+    """
+    A user's payment count and total amount per status, read from at
+    most one aggregate row per status.
+
+    :returns: dict of status to ``{'count': ..., 'total': ...}``, with
+        every status present
+    """
+    summary = {status: {'count': 0, 'total': 0}
+               for status in Payment.AUTHY_STATUSES}
+    rows = db.session.query(PaymentAggregate) \
+        .filter(PaymentAggregate.authy_id == authy_id)
+    for row in rows:
+        summary[row.status] = {
+            'count': row.payment_count,
+            'total': row.amount_total,
+        }
+    return summary
+
+
+def rebuild(chunk_size=500):
+    """
+    Recomputes every aggregate from the payments table, ``chunk_size``
+    users per transaction, so writers are only held up briefly.
+
+    :returns: the number of users whose aggregates were rebuilt
+    """
+    aggregates = PaymentAggregate.__table__
+    payments = Payment.__table__
+    rebuilt = 0
+    after = None
+    while True:
+        query = db.session.query(User.authy_id) \
+            .filter(User.authy_id.isnot(None))
+        if after is not None:
+            query = query.filter(User.authy_id > after)
+        authy_ids = [row.authy_id for row in
+                     query.order_by(User.authy_id).limit(chunk_size)]
+        if not authy_ids:
+            break
+
+        db.session.execute(aggregates.delete().where(
+            aggregates.c.authy_id.in_(authy_ids)))
+        db.session.execute(aggregates.insert().from_select(
+            ['authy_id', 'status', 'payment_count', 'amount_total'],
+            db.select([
+                payments.c.authy_id,
+                payments.c.status,
+                db.func.count(),
+                db.func.coalesce(db.func.sum(payments.c.amount), 0),
+            ])
+            .where(payments.c.authy_id.in_(authy_ids))
+            .group_by(payments.c.authy_id, payments.c.status)))
+        db.session.commit()
+
+        rebuilt += len(authy_ids)
+        after = authy_ids[-1]
+
+    # users deleted since their aggregates were written
+    db.session.execute(aggregates.delete().where(
+        ~aggregates.c.authy_id.in_(
+            db.select([User.authy_id]).where(User.authy_id.isnot(None)))))
+    db.session.commit()
+    return rebuilt
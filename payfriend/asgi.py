@@ -0,0 +1,434 @@
+"""
+An ASGI front end for payfriend.
+
+Sending a payment, checking its status and receiving OneTouch
+callbacks are handled on an asyncio event loop, so a request waiting
+on a status change doesn't hold a thread. Every other request, and
+any request these can't complete on their own (an unverified user, an
+invalid form), is passed to the Flask app on a thread pool, so
+behaviour matches the WSGI app.
+
+Needs ``uvicorn``, listed in ``requirements-asgi.txt``::
+
+    pip install -r requirements-asgi.txt
+    uvicorn --factory payfriend.asgi:create_asgi_app
+
+The WSGI app (``flask run``, or ``payfriend:create_app()`` under any
+WSGI server) keeps working without them.
+"""
+import asyncio
+import hmac
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_decode
+from werkzeug.http import parse_cookie
+from payfriend import create_app
+
+
+class Request:
+    """
+    The parts of an HTTP request the async handlers need, read in full.
+    """
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.headers = {}
+        for (name, value) in scope['headers']:
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+            if name in self.headers:
+                value = self.headers[name] + ',' + value
+            self.headers[name] = value
+        self.args = MultiDict(url_decode(scope['query_string']))
+        self.cookies = parse_cookie(self.headers.get('cookie', ''))
+
+    @classmethod
+    async def read(cls, scope, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return cls(scope, b''.join(chunks))
+
+    @property
+    def form(self):
+        return MultiDict(url_decode(self.body))
+
+    @property
+    def json(self):
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+    @property
+    def url(self):
+        scheme = self.scope.get('scheme', 'http')
+        host = self.headers.get('host')
+        if host is None:
+            (server, port) = self.scope['server']
+            host = '{}:{}'.format(server, port)
+        url = '{}://{}{}{}'.format(scheme, host, self.scope.get('root_path', ''),
+                                   quote(self.path))
+        if self.scope['query_string']:
+            url += '?' + self.scope['query_string'].decode('latin-1')
+        return url
+
+
+async def respond(send, status, body=b'', content_type='text/html; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class LoopEvent:
+    """
+    An ``asyncio.Event`` that ``PaymentEvents.publish`` can set from
+    any thread.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class Abandoned(Exception):
+    """Raised in a WSGI thread whose response nobody is reading."""
+
+
+class WSGIBridge:
+    """
+    Runs requests through the Flask app on a thread pool, streaming
+    the response back.
+
+    At most ``BUFFER`` chunks of a response are held waiting for the
+    client; past that the Flask thread waits, so a streamed response,
+    such as an export, is produced only as fast as it's read.
+    """
+    BUFFER = 16
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def __call__(self, request, send):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(self.BUFFER)
+        abandoned = threading.Event()
+        self.executor.submit(
+            self._run, self._environ(request), loop, queue, abandoned)
+
+        finished = False
+        try:
+            (status, headers) = await queue.get()
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'),
+                             v.encode('latin-1'))
+                            for (k, v) in headers],
+            })
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            finished = True
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if not finished:
+                # the client went away: stop the Flask thread, which
+                # may be waiting for room in the queue
+                abandoned.set()
+                while not queue.empty():
+                    queue.get_nowait()
+
+    def _run(self, environ, loop, queue, abandoned):
+        # the whole response is produced in this thread, as streamed
+        # templates keep the request context pushed between chunks
+        def put(item):
+            if abandoned.is_set():
+                raise Abandoned()
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started.append(True)
+            put((status, headers))
+
+        body = ()
+        try:
+            body = self.app(environ, start_response)
+            for chunk in body:
+                if chunk:
+                    put(chunk)
+            put(None)
+        except Abandoned:
+            pass
+        except Exception:
+            self.app.logger.exception('Error serving %s', environ['PATH_INFO'])
+            try:
+                if not started:
+                    put(('500 Internal Server Error',
+                         [('Content-Type', 'text/plain')]))
+                put(None)
+            except Abandoned:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _environ(self, request):
+        scope = request.scope
+        (server, port) = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for (name, value) in request.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        return environ
+
+
+class AsyncPayments:
+    """
+    ASGI application serving the payment hot paths asynchronously and
+    passing everything else to the Flask app ``app``.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WSGIBridge(app, app.config['ASGI_WSGI_THREADS'])
+        self.executor = ThreadPoolExecutor(app.config['ASGI_DB_THREADS'])
+        self.routes = {
+            ('POST', '/payments/send'): self.send,
+            ('GET', '/payments/status'): self.status,
+            ('GET', '/payments/status/wait'): self.wait_for_status,
+            ('POST', '/payments/callback'): self.callback,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        request = await Request.read(scope, receive)
+        handler = self.routes.get((request.method, request.path))
+        if handler is None or not await handler(request, send):
+            await self.wsgi(request, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.app.config['OUTBOX_INLINE_DRAIN']:
+                    # Flask starts it with its first request, which may
+                    # never come if every request is handled here
+                    self.app.extensions['outbox_worker'].start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_sync(self, fn, *args):
+        """
+        Runs blocking work, such as database queries, on the thread
+        pool inside an app context.
+        """
+        def call():
+            with self.app.app_context():
+                return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, call)
+
+    def _load_session(self, request):
+        from payfriend.auth import load_user
+        session = self.app.session_interface.open_session(self.app, request)
+        user_id = session.get('user_id') if session is not None else None
+        user = load_user(user_id) if user_id is not None else None
+        return (session, user)
+
+    def _csrf_valid(self, session, request):
+        """
+        The check ``FlaskForm.validate_on_submit`` makes, for requests
+        that don't go through Flask.
+        """
+        config = self.app.config
+        if not config.get('WTF_CSRF_ENABLED', True):
+            return True
+        from itsdangerous import BadData, URLSafeTimedSerializer
+        token = request.form.get('csrf_token') or \
+            request.headers.get('x-csrftoken')
+        if not token or 'csrf_token' not in session:
+            return False
+        serializer = URLSafeTimedSerializer(
+            config.get('WTF_CSRF_SECRET_KEY') or config['SECRET_KEY'],
+            salt='wtf-csrf-token')
+        try:
+            value = serializer.loads(
+                token, max_age=config.get('WTF_CSRF_TIME_LIMIT', 3600))
+        except BadData:
+            return False
+        return hmac.compare_digest(session['csrf_token'], value)
+
+    def _create_payment(self, request):
+        from payfriend.forms import PaymentForm
+        from payfriend.payment import create_payment
+
+        (session, user) = self._load_session(request)
+        if user is None or not user.authy_id:
+            return None
+        if not self._csrf_valid(session, request):
+            return None
+        form = PaymentForm(request.form, meta={'csrf': False})
+        if not form.validate():
+            return None
+        # queued in the outbox with the payment, as payments.send does
+        hidden_details = {
+            'user_ip_address': (request.scope.get('client') or ('',))[0],
+            'requester_user_id': str(user.id),
+        }
+        payment = create_payment(user.authy_id, form.send_to.data,
+                                 form.amount.data, hidden_details)
+        return payment.id
+
+    async def send(self, request, send):
+        """
+        Async ``payments.send``. The push request is queued in the
+        outbox with the payment, and the client polls its status.
+        Requests carrying a message to flash go to Flask, which keeps
+        it in the session.
+        """
+        if request.form.get('flash_message'):
+            # Flask shows it with the next page, see display_flash_messages
+            return False
+
+        payment_id = await self.run_sync(self._create_payment, request)
+        if payment_id is None:
+            # not logged in, unverified or invalid: let Flask answer
+            return False
+
+        await respond(send, 200, json.dumps({
+            'success': True,
+            'payment_id': payment_id,
+        }), 'application/json')
+        return True
+
+    def _payment_status(self, request):
+        from payfriend.payment import payment_status
+        (_, user) = self._load_session(request)
+        if user is None:
+            return (None, None)
+        return (user, payment_status(request.args.get('payment_id'),
+                                     user.authy_id))
+
+    async def status(self, request, send):
+        (user, status) = await self.run_sync(self._payment_status, request)
+        if user is None:
+            return False
+        if status is None:
+            await respond(send, 404, 'Payment not found')
+        else:
+            await respond(send, 200, status)
+        return True
+
+    async def wait_for_status(self, request, send):
+        """
+        Async ``payments.wait_for_status``: waiting requests hold no
+        thread or database connection.
+        """
+        from payfriend.events import payment_events
+        timeout = self.app.config['STATUS_WAIT_TIMEOUT']
+        interval = self.app.config['STATUS_WAIT_POLL_INTERVAL']
+
+        changed = LoopEvent(asyncio.get_event_loop())
+        with payment_events.subscribe(request.args.get('payment_id'), changed):
+            (user, status) = await self.run_sync(self._payment_status, request)
+            if user is None:
+                return False
+            deadline = time.monotonic() + timeout
+            remaining = timeout
+            while status == 'pending' and remaining > 0:
+                try:
+                    await asyncio.wait_for(changed.event.wait(),
+                                           min(interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                changed.event.clear()
+                (_, status) = await self.run_sync(self._payment_status, request)
+                remaining = deadline - time.monotonic()
+
+        if status is None:
+            await respond(send, 404, 'Payment not found')
+        else:
+            await respond(send, 200, status)
+        return True
+
+    async def callback(self, request, send):
+        """
+        Async ``payments.callback``. Checking the signature and queueing
+        the status change don't block, so this runs on the event loop.
+        """
+        from payfriend.onetouch import DUPLICATE, VALID, onetouch
+        from payfriend.payment import accept_push_status
+
+        params = request.json
+        with self.app.app_context():
+            result = onetouch.check(
+                request.headers.get('x-authy-signature'),
+                request.headers.get('x-authy-signature-nonce'),
+                request.method,
+                self.app.config['ONETOUCH_CALLBACK_URL'] or request.url,
+                params)
+            if result == VALID:
+                code = accept_push_status(
+                    params.get('uuid'), params.get('status'))
+            elif result == DUPLICATE:
+                code = 200
+            else:
+                code = 400
+        await respond(send, code)
+        return True
+
+
+def create_asgi_app(test_config=None):
+    """
+    Creates the Flask app and wraps it in ``AsyncPayments``.
+    """
+    return AsyncPayments(create_app(test_config))
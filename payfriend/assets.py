@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+# built files go here, under the static folder
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+
+# file types worth compressing
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt', '.html')
+
+# (Accept-Encoding name, file extension), in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def minify_css(css):
+    """
+    Drops comments and the whitespace around braces, semicolons,
+    commas and child combinators. Whitespace around colons is kept,
+    as it separates a descendant selector from a pseudo-class.
+    """
+    css = _CSS_COMMENT.sub('', css)
+    css = _CSS_SPACE.sub(' ', css)
+    css = _CSS_PUNCTUATION.sub(r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    """
+    Minifies JavaScript with ``rjsmin``, if it's installed; otherwise
+    leaves it alone, as it's still compressed.
+    """
+    if rjsmin is None:
+        return js
+    return rjsmin.jsmin(js)
+
+
+def _rewrite_css_urls(css, source, manifest):
+    # point url(...) references at the fingerprinted files, relative
+    # to where the built stylesheet ends up
+    def replace(match):
+        (quote, url) = match.groups()
+        if ':' in url or url.startswith(('/', '#')):
+            return match.group(0)
+        (path, suffix) = re.match(r'([^?#]*)(.*)', url).groups()
+        target = posixpath.normpath(
+            posixpath.join(posixpath.dirname(source), path))
+        if target not in manifest:
+            return match.group(0)
+        built = posixpath.relpath(
+            manifest[target]['path'],
+            posixpath.dirname(_built_path(source)))
+        return 'url({0}{1}{2}{0})'.format(quote, built, suffix)
+    return _CSS_URL.sub(replace, css)
+
+
+def _built_path(source):
+    return posixpath.join(BUILD_DIR, source)
+
+
+def _fingerprinted(source, data):
+    (stem, ext) = posixpath.splitext(source)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return _built_path('{}.{}{}'.format(stem, digest, ext))
+
+
+def _compress(path, data):
+    """
+    Writes gzip and, if ``brotli`` is installed, brotli copies of
+    ``data`` next to ``path``, keeping only those that are smaller.
+
+    :returns: list of the encodings written
+    """
+    encodings = []
+    for (encoding, ext) in ENCODINGS:
+        if encoding == 'br':
+            if brotli is None:
+                continue
+            compressed = brotli.compress(data, quality=11)
+        else:
+            # no timestamp, so rebuilding the same file changes nothing
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            with open(path + ext, 'wb') as f:
+                f.write(compressed)
+            encodings.append(encoding)
+    return encodings
+
+
+def build(static_folder):
+    """
+    Copies every file in ``static_folder`` to ``static/build``, minified
+    and under a name that includes a hash of its contents, with
+    precompressed copies, and writes a manifest mapping each file to
+    its build. Stylesheets are built last, so their ``url()``
+    references can point at the fingerprinted files.
+
+    :returns: the manifest, a dict of source path to ``{'path': ...,
+        'encodings': [...]}``, paths relative to ``static_folder``
+    """
+    out = os.path.join(static_folder, BUILD_DIR)
+    if os.path.isdir(out):
+        shutil.rmtree(out)
+
+    sources = []
+    for (root, dirs, files) in os.walk(static_folder):
+        if root == static_folder:
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            sources.append(path.replace(os.sep, '/'))
+    sources.sort(key=lambda source: (source.endswith('.css'), source))
+
+    manifest = {}
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as f:
+            data = f.read()
+        if source.endswith('.css'):
+            css = _rewrite_css_urls(data.decode('utf-8'), source, manifest)
+            data = minify_css(css).encode('utf-8')
+        elif source.endswith('.js'):
+            data = minify_js(data.decode('utf-8')).encode('utf-8')
+
+        built = _fingerprinted(source, data)
+        path = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        encodings = []
+        if source.endswith(COMPRESSIBLE):
+            encodings = _compress(path, data)
+        manifest[source] = {'path': built, 'encodings': encodings}
+
+    with open(os.path.join(out, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    """
+    Serves the files made by ``flask build-assets`` in place of the
+    originals: ``url_for('static', ...)`` links to the fingerprinted
+    copy, which is sent precompressed when the client accepts it, and
+    with ``Cache-Control`` letting browsers keep it for
+    ``ASSETS_MAX_AGE`` seconds without revalidating, as its name
+    changes whenever its contents do.
+
+    Nothing changes until the assets are built, or if
+    ``USE_BUILT_ASSETS`` is off. Rebuild after changing ``static/``.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        manifest = {}
+        path = os.path.join(app.static_folder, BUILD_DIR, MANIFEST)
+        if app.config['USE_BUILT_ASSETS'] and os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        app.extensions['assets'] = manifest
+        if not manifest:
+            return
+
+        # built path: encodings available for it
+        built = {entry['path']: entry['encodings']
+                 for entry in manifest.values()}
+        send_original = app.view_functions['static']
+
+        @app.url_defaults
+        def fingerprint(endpoint, values):
+            if endpoint == 'static':
+                entry = manifest.get(values.get('filename'))
+                if entry is not None:
+                    values['filename'] = entry['path']
+
+        def send_static_file(filename):
+            if filename not in built:
+                return send_original(filename)
+            return self._send_built(filename, built[filename])
+
+        app.view_functions['static'] = send_static_file
+
+    def _send_built(self, filename, encodings):
+        accepted = request.accept_encodings
+        (encoding, ext) = next(
+            ((encoding, ext) for (encoding, ext) in ENCODINGS
+             if encoding in encodings and accepted[encoding]),
+            (None, ''))
+
+        max_age = current_app.config['ASSETS_MAX_AGE']
+        response = send_from_directory(
+            current_app.static_folder, filename + ext,
+            mimetype=mimetypes.guess_type(filename)[0],
+            cache_timeout=max_age)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = \
+            'public, max-age={}, immutable'.format(max_age)
+        return response
+
+
+assets = Assets()
@@ -11,8 +11,10 @@ from flask import (
 from flask import current_app as app
 from . import utils
 from payfriend import db
-from payfriend.forms import RegisterForm, LoginForm, VerifyForm
-from payfriend.models import User
+from payfriend.metrics import metrics
+from payfriend.models import User, UserSnapshot
+from payfriend.outbox import outbox
+from payfriend.pages import page_cache
 from payfriend.payment import check_sms_auth
 
 
@@ -22,18 +24,84 @@ bp = Blueprint('auth', __name__, url_prefix='/auth')
 @bp.before_app_request
 def load_logged_in_user():
     """
-    If a user id is stored in the session, load the user object from
-    the database into ``g.user``.
+    If a user id is stored in the session, load a snapshot of the user
+    into ``g.user``. Snapshots are cached for ``USER_CACHE_TTL``
+    seconds, so most requests don't touch the database.
+
+    Static files are sent without looking at the session, so they
+    don't vary by cookie and shared caches can keep them.
     """
+    if request.endpoint == 'static':
+        g.user = None
+        return
+
     user_id = session.get('user_id')
 
     if user_id is None:
         g.user = None
-    else:
-        g.user = User.query.filter_by(id=user_id).first()
+        return
+
+    g.user = load_user(user_id)
+
+
+def load_user(user_id):
+    """
+    Returns a ``UserSnapshot`` of the user, from the cache if possible,
+    or None if there is no such user.
+    """
+    cache = app.extensions['user_cache']
+    user = cache.get(user_id)
+    if user is None:
+        with metrics.timer('user_load_seconds'):
+            row = User.query.filter_by(id=user_id).first()
+        if row is not None:
+            user = UserSnapshot(row)
+            cache.set(user_id, user)
+    return user
+
+
+def get_users_page(prefix=None, after=None, limit=50):
+    """
+    Queries a page of users ordered by email, selecting only the
+    columns shown on the users page. Uses the email index for both
+    ordering and prefix search.
+
+    :param prefix: only return users whose email starts with this
+    :param after: email of the last user on the previous page
+    :param limit: maximum number of rows to return
+    """
+    query = db.session.query(
+            User.id,
+            User.email,
+            User.phone_number,
+            User.authy_id) \
+        .order_by(User.email)
+
+    if prefix:
+        # a range rather than LIKE, so the index can be used
+        query = query.filter(User.email >= prefix,
+                             User.email < prefix + '\uffff')
+    if after:
+        query = query.filter(User.email > after)
+
+    return query.limit(limit)
+
+
+def count_users():
+    """
+    Returns the total number of users. Cached until a user is added
+    or removed, or for ``COUNT_CACHE_TTL`` seconds.
+    """
+    cache = app.extensions['count_cache']
+    total = cache.get('users')
+    if total is None:
+        total = db.session.query(db.func.count(User.id)).scalar()
+        cache.set('users', total)
+    return total
 
 
 @bp.route('/register', methods=('GET', 'POST'))
+@page_cache.cached
 def register():
     """
     Register a new user.
@@ -41,6 +109,7 @@ def register():
     Validates that the email is not already taken. Hashes the
     password for security.
     """
+    from payfriend.forms import RegisterForm
     form = RegisterForm(request.form)
 
     if form.validate_on_submit():
@@ -52,15 +121,19 @@ def register():
         # Authy API requires separate country code
         (country_code, phone) = utils.parse_phone_number(full_phone)
 
+        # the user and their verification request are saved together,
+        # and the code is sent by the outbox worker
         try:
-            utils.start_verification(country_code, phone, channel)
-            user = User(email, password, full_phone)
+            user = User(email, password, full_phone, country_code, phone)
             db.session.add(user)
+            utils.start_verification(country_code, phone, channel)
             db.session.commit()
+            outbox.notify()
             session.clear()
             session['user_id'] = user.id
             return redirect(url_for('auth.verify'))
         except Exception as e:
+            db.session.rollback()
             flash('Error sending phone verification. {}'.format(e))
 
     return render_template('auth/register.html', form=form)
@@ -86,12 +159,13 @@ def verify():
     """
     Generic endpoint to verify a code entered by the user.
     """
+    from payfriend.forms import VerifyForm
     form = VerifyForm(request.form)
     validated = form.validate_on_submit()
 
     if form.validate_on_submit():
         email = g.user.email
-        (country_code, phone) = utils.parse_phone_number(g.user.phone_number)
+        (country_code, phone) = utils.user_phone(g.user)
         code = form.verification_code.data
 
         # route based on the type of verification
@@ -106,10 +180,12 @@ def verify():
 
 
 @bp.route('/login', methods=('GET', 'POST'))
+@page_cache.cached
 def login():
     """
     Log in a registered user by adding the user id to the session.
     """
+    from payfriend.forms import LoginForm
     form = LoginForm(request.form)
 
     if form.validate_on_submit():
@@ -124,6 +200,12 @@ def login():
             error = 'Incorrect password.'
 
         if error is None:
+            # upgrade hashes made with older settings while we
+            # have the plaintext password
+            if user.password_needs_rehash():
+                user.password = password
+                db.session.commit()
+
             # store the user id in a new session
             # redirect to payments
             session.clear()
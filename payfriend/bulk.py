@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+
+
+# the length of Payment.send_to
+MAX_SEND_TO = 128
+
+
+class BatchError(Exception):
+    """
+    Raised when a batch of payments can't be read, or has items that
+    aren't valid payments.
+
+    :param message: what's wrong with the batch as a whole
+    :param items: list of ``{'index': ..., 'errors': ...}`` for the
+        invalid items, where ``errors`` maps field names to messages
+    """
+    def __init__(self, message, items=()):
+        super(BatchError, self).__init__(message)
+        self.message = message
+        self.items = list(items)
+
+
+def read_batch(body, mimetype):
+    """
+    Reads the items of a batch of payments sent as CSV, with a header
+    row naming the ``send_to`` and ``amount`` columns, or as JSON, a
+    list of ``{"send_to": ..., "amount": ...}`` objects, optionally
+    under a ``payments`` key.
+
+    :param body: the request body, as text
+    :param mimetype: ``text/csv`` or ``application/json``
+    :returns: list of dicts
+    :raises BatchError: if the body can't be read
+    """
+    if mimetype == 'text/csv':
+        reader = csv.DictReader(io.StringIO(body))
+        if not reader.fieldnames or \
+                not {'send_to', 'amount'} <= set(reader.fieldnames):
+            raise BatchError('The CSV header must name send_to and amount.')
+        try:
+            return list(reader)
+        except csv.Error as e:
+            raise BatchError('Invalid CSV: {}'.format(e))
+
+    if mimetype == 'application/json':
+        try:
+            items = json.loads(body)
+        except ValueError:
+            raise BatchError('Invalid JSON.')
+        if isinstance(items, dict):
+            items = items.get('payments')
+        if not isinstance(items, list) or \
+                not all(isinstance(item, dict) for item in items):
+            raise BatchError('Expected a list of payments.')
+        return items
+
+    raise BatchError('Send the batch as text/csv or application/json.')
+
+
+def validate_batch(items, max_size):
+    """
+    Checks every item of a batch against the same rules as
+    ``PaymentForm``, in one pass, reporting all invalid items at once.
+
+    :returns: list of (send_to, amount) tuples
+    :raises BatchError: if the batch is empty, too big, or has
+        invalid items
+    """
+    if not items:
+        raise BatchError('The batch has no payments.')
+    if len(items) > max_size:
+        raise BatchError(
+            'Batches are limited to {} payments.'.format(max_size))
+
+    payments = []
+    invalid = []
+    for (index, item) in enumerate(items):
+        errors = {}
+
+        send_to = item.get('send_to')
+        if isinstance(send_to, str):
+            send_to = send_to.strip()
+        if not send_to or not isinstance(send_to, str):
+            errors['send_to'] = 'This field is required.'
+        elif len(send_to) > MAX_SEND_TO:
+            errors['send_to'] = 'Must be at most {} characters.'.format(
+                MAX_SEND_TO)
+
+        amount = item.get('amount')
+        if isinstance(amount, str):
+            amount = amount.strip()
+        try:
+            if isinstance(amount, (bool, float)):
+                raise ValueError(amount)
+            amount = int(amount)
+        except (TypeError, ValueError):
+            errors['amount'] = 'Not a valid integer value'
+
+        if errors:
+            invalid.append({'index': index, 'errors': errors})
+        else:
+            payments.append((send_to, amount))
+
+    if invalid:
+        raise BatchError('Some payments are invalid.', invalid)
+    return payments
@@ -0,0 +1,202 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from flask import current_app
+from payfriend.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackQueueFull(Exception):
+    """Raised when callbacks arrive faster than they can be applied."""
+
+
+class CallbackBatcher:
+    """
+    Applies OneTouch callback status changes in batches.
+
+    ``submit`` drops deliveries whose ``uuid`` was already seen and
+    queues the rest, so the callback view can answer Authy straight
+    away. A background thread collects up to ``batch_size`` updates, or
+    whatever arrives within ``flush_interval`` seconds, and writes them
+    in one transaction with ``payment.apply_push_statuses``.
+
+    A batch that can't be written, e.g. because the database is
+    locked, is queued again with backoff, and its push_ids are
+    forgotten so Authy's redeliveries aren't dropped as duplicates.
+
+    Queued updates live in memory until flushed. They're written when
+    the process exits normally, but ones acknowledged just before it's
+    killed, or waiting to be retried, are lost, and the payment stays
+    pending until it expires.
+    """
+    # tries per update, whether its payment row isn't committed yet or
+    # the batch failed to write
+    MAX_ATTEMPTS = 5
+    # seconds before the first retry, doubled for each one after
+    RETRY_BACKOFF = 0.2
+    # seconds the idle thread waits before checking whether to stop
+    IDLE_POLL = 1
+    # seconds to wait at shutdown for the batch being written
+    STOP_TIMEOUT = 5
+
+    def __init__(self, app, batch_size, flush_interval, queue_size, dedup_size):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(queue_size)
+        self._seen = LRUCache(maxsize=dedup_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def submit(self, push_id, status):
+        """
+        Queues a status change.
+
+        :returns: False if this push_id was already delivered
+        :raises CallbackQueueFull: if the queue is full
+        """
+        if self._seen.get(push_id) is not None:
+            return False
+        self._seen.set(push_id, status)
+
+        try:
+            self._queue.put_nowait((push_id, status, 1))
+        except queue.Full:
+            # let Authy's retry get through
+            self._seen.delete(push_id)
+            raise CallbackQueueFull()
+
+        self._ensure_started()
+        return True
+
+    def flush(self):
+        """
+        Applies everything queued so far in the calling thread.
+        """
+        while not self._queue.empty():
+            self._apply_or_retry(self._take(block=False))
+
+    def stop(self):
+        """
+        Stops the background thread once it has written the batch it
+        holds, then applies whatever is still queued. Called when the
+        process exits, once the thread has started.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.STOP_TIMEOUT)
+        self.flush()
+
+    def _ensure_started(self):
+        # started on first use, so each worker process gets its own
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='payfriend-callbacks')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def _take(self, block=True):
+        """
+        Collects the next batch, waiting up to ``flush_interval`` after
+        the first update for more to arrive.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if not block:
+                    item = self._queue.get_nowait()
+                elif deadline is None:
+                    item = self._queue.get(timeout=self.IDLE_POLL)
+                    deadline = time.monotonic() + self.flush_interval
+                else:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._apply_or_retry(self._take())
+
+    def _apply_or_retry(self, batch):
+        try:
+            self._apply(batch)
+        except Exception:
+            logger.exception('Error applying %d callbacks, retrying',
+                             len(batch))
+            for (push_id, status, attempt) in batch:
+                # a redelivery from Authy may get through first, which
+                # is harmless: only the first change applies
+                self._seen.delete(push_id)
+                self._retry(push_id, status, attempt)
+
+    def _retry(self, push_id, status, attempt):
+        if attempt >= self.MAX_ATTEMPTS:
+            logger.warning('Giving up on OneTouch callback %s', push_id)
+            return
+        retry = threading.Timer(
+            self.RETRY_BACKOFF * 2 ** (attempt - 1), self._queue.put,
+            ((push_id, status, attempt + 1),))
+        retry.daemon = True
+        retry.start()
+
+    def _apply(self, batch):
+        if not batch:
+            return
+
+        # the first delivery for a push_id wins: statuses never change
+        # once they leave pending
+        updates = {}
+        attempts = {}
+        for (push_id, status, attempt) in batch:
+            updates.setdefault(push_id, status)
+            attempts[push_id] = attempt
+
+        from payfriend.payment import apply_push_statuses
+        with self.app.app_context():
+            missing = apply_push_statuses(updates)
+
+        # the payment may not have its push_id recorded yet
+        for push_id in missing:
+            self._retry(push_id, updates[push_id], attempts[push_id])
+
+
+class Callbacks:
+    """
+    Gives each app its ``CallbackBatcher``.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['callback_batcher'] = CallbackBatcher(
+            app,
+            batch_size=app.config['CALLBACK_BATCH_SIZE'],
+            flush_interval=app.config['CALLBACK_FLUSH_INTERVAL'],
+            queue_size=app.config['CALLBACK_QUEUE_SIZE'],
+            dedup_size=app.config['CALLBACK_DEDUP_SIZE'])
+
+    @property
+    def batcher(self):
+        return current_app.extensions['callback_batcher']
+
+    def submit(self, push_id, status):
+        return self.batcher.submit(push_id, status)
+
+    def flush(self):
+        self.batcher.flush()
+
+
+callbacks = Callbacks()
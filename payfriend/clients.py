@@ -0,0 +1,106 @@
+import json
+import threading
+from flask import current_app
+
+
+class PooledAuthyClients:
+    """
+    App-scoped registry of Authy API clients.
+
+    The stock ``AuthyApiClient`` opens a fresh connection (and TLS
+    handshake) for every call. Clients handed out here are built once
+    per app and share a ``requests.Session`` whose connection pool is
+    capped at ``AUTHY_POOL_SIZE`` keep-alive connections, so
+    verifications, pushes and token checks reuse warm connections.
+    """
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['authy_clients'] = {}
+
+    def get(self):
+        """
+        Returns the shared client for the current app, creating it on
+        first use.
+        """
+        app = current_app._get_current_object()
+        clients = app.extensions['authy_clients']
+        client = clients.get('client')
+        if client is None:
+            with self._lock:
+                client = clients.get('client')
+                if client is None:
+                    client = clients['client'] = self._create(app, clients)
+        return client
+
+    def _create(self, app, clients):
+        if app.config['AUTHY_BACKEND'] == 'fake':
+            from payfriend.fake_authy import FakeAuthyApiClient
+            return FakeAuthyApiClient(app.config['AUTHY_API_KEY'])
+
+        # imported here, as they pull in most of requests and urllib3
+        from authy.api import AuthyApiClient
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+
+        session = Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config['AUTHY_POOL_SIZE'],
+            pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        clients['adapter'] = adapter
+
+        client = AuthyApiClient(
+            app.config['AUTHY_API_KEY'], app.config['AUTHY_API_URI'])
+        for resource in (client.users, client.tokens, client.apps,
+                         client.stats, client.phones, client.one_touch):
+            resource.request = _pooled_request(
+                resource, session, app.config['AUTHY_HTTP_TIMEOUT'])
+        return client
+
+    def stats(self):
+        """
+        Connection pool counters for the current app.
+
+        :returns: dict with ``requests`` made, pool ``hits`` (requests
+            served on a reused connection) and ``misses`` (new
+            connections opened)
+        """
+        adapter = current_app.extensions['authy_clients'].get('adapter')
+        requests = misses = 0
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests += pool.num_requests
+                misses += pool.num_connections
+        return {
+            'requests': requests,
+            'hits': max(requests - misses, 0),
+            'misses': misses
+        }
+
+
+def _pooled_request(resource, session, timeout):
+    """
+    Replacement for ``authy.api.resources.Resource.request`` that goes
+    through ``session`` with a timeout instead of ``requests.request``.
+    """
+    def request(method, path, data={}, headers={}):
+        url = resource.api_uri + path
+        headers = dict(resource.def_headers, **headers)
+        headers['X-Authy-API-Key'] = resource.api_key
+        if method == "GET":
+            return session.request(method, url, headers=headers,
+                                   params=data, timeout=timeout)
+        return session.request(method, url, headers=headers,
+                               data=json.dumps(data), timeout=timeout)
+    return request
+
+
+authy_clients = PooledAuthyClients()
@@ -1,6 +1,9 @@
-from flask import abort, flash, g, redirect, request, session, url_for
+from flask import abort, current_app, flash, g, redirect, request, session, url_for
 from functools import wraps
 from . import utils
+from payfriend import db
+from .outbox import outbox
+from .onetouch import DUPLICATE, VALID, onetouch
 
 
 def login_required(view):
@@ -25,8 +28,10 @@ def verification_required(view):
     def wrapped_view(**kwargs):
         if g.user and not g.user.authy_id:
             flash("Please verify your phone number before continuing.")
-            (country_code, phone) = utils.parse_phone_number(g.user.phone_number)
-            utils.start_verification(country_code, phone)
+            (country_code, phone) = utils.user_phone(g.user)
+            if utils.start_verification(country_code, phone):
+                db.session.commit()
+                outbox.notify()
             return redirect(url_for('auth.verify'))
 
         return view(**kwargs)
@@ -54,20 +59,24 @@ def verify_authy_request(f):
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Get the request URL without the parameters
-        client = utils.get_authy_client()
+        # Authy signs the callback URL it was configured with, which
+        # differs from request.url behind a proxy
+        url = current_app.config['ONETOUCH_CALLBACK_URL'] or request.url
 
-        response = client.one_touch.validate_one_touch_signature(
-            request.headers['X-Authy-Signature'],
-            request.headers['X-Authy-Signature-Nonce'],
+        result = onetouch.check(
+            request.headers.get('X-Authy-Signature'),
+            request.headers.get('X-Authy-Signature-Nonce'),
             request.method,
-            request.url,
-            request.json
+            url,
+            request.get_json(silent=True)
         )
-        if response:
+        if result == VALID:
             # The two signatures match - this request is authentic
             return f(*args, **kwargs)
+        if result == DUPLICATE:
+            # Already accepted this exact delivery
+            return ('', 200)
 
         # The signatures didn't match - abort this request
         return abort(400)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
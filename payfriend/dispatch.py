@@ -0,0 +1,42 @@
+import logging
+import time
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+
+def call(fn, *args, **kwargs):
+    """
+    Makes an Authy API call in the calling thread, retrying with
+    exponential backoff, up to ``AUTHY_RETRIES`` times, if it couldn't
+    connect. No retry starts after ``AUTHY_TIMEOUT`` seconds.
+
+    Other errors aren't retried: the request may have reached Authy,
+    and calls such as sending an SMS aren't safe to repeat.
+    """
+    config = current_app.config
+    deadline = time.monotonic() + config['AUTHY_TIMEOUT']
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            delay = config['AUTHY_RETRY_BACKOFF'] * (2 ** attempt)
+            if attempt >= config['AUTHY_RETRIES'] or not not_sent(e) or \
+                    time.monotonic() + delay >= deadline:
+                logger.exception('Authy call %r failed', fn)
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def not_sent(error):
+    """
+    Whether ``error`` means the request never reached the server, so
+    it's safe to send again.
+    """
+    # requests is slow to import, and only needed once a call fails
+    from requests.exceptions import ConnectionError, ReadTimeout
+    return isinstance(error, ConnectionError) and \
+        not isinstance(error, ReadTimeout)
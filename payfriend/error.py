@@ -1,17 +1,21 @@
-from flask import render_template
+from payfriend.pages import page_cache
+
+
+# error pages are the same for every URL, so each is rendered once per
+# process for anonymous visitors: floods of bad URLs cost little
 
 
 def unauthorized(e):
-    return render_template('error.html', message='401 unauthorized'), 401
+    return page_cache.render(401, 'error.html', message='401 unauthorized'), 401
 
 
 def forbidden(e):
-    return render_template('error.html', message='403 forbidden'), 403
+    return page_cache.render(403, 'error.html', message='403 forbidden'), 403
 
 
 def page_not_found(e):
-    return render_template('error.html', message='404 not found'), 404
+    return page_cache.render(404, 'error.html', message='404 not found'), 404
 
 
 def internal_error(e):
-    return render_template('error.html', message='500 internal error'), 500
+    return page_cache.render(500, 'error.html', message='500 internal error'), 500
@@ -0,0 +1,54 @@
+import threading
+from contextlib import contextmanager
+
+
+class PaymentEvents:
+    """
+    In-process notifications for payment status changes.
+
+    Requests waiting on a pending payment subscribe to its ID and are
+    woken as soon as ``publish`` is called for it, instead of polling
+    the database.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    @contextmanager
+    def subscribe(self, payment_id, event=None):
+        """
+        Registers interest in a payment's status.
+
+        Subscribe *before* reading the current status so a change that
+        lands in between is not missed.
+
+        :param payment_id: ID of the payment to watch
+        :param event: object with a thread-safe ``set()`` method to use
+            instead of a new ``threading.Event``
+        :returns: the event, set when the status changes
+        """
+        if event is None:
+            event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(payment_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(payment_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[payment_id]
+
+    def publish(self, payment_id):
+        """
+        Wakes every request waiting on ``payment_id``.
+        """
+        with self._lock:
+            waiters = list(self._waiters.get(payment_id, ()))
+        for event in waiters:
+            event.set()
+
+
+payment_events = PaymentEvents()
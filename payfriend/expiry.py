@@ -0,0 +1,101 @@
+import atexit
+import logging
+import threading
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    """
+    Marks overdue pending payments expired every ``interval`` seconds,
+    in a background thread, with ``payment.expire_payments``.
+
+    Every worker process runs its own sweeper. Expiring a payment is a
+    conditional update, so sweepers racing each other, or a OneTouch
+    callback, do no harm.
+    """
+    # seconds to wait at shutdown for a sweep in progress
+    STOP_TIMEOUT = 5
+
+    def __init__(self, app, interval, batch_size):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def sweep(self):
+        """
+        Expires everything overdue now, in the calling thread.
+
+        :returns: the number of payments expired
+        """
+        from payfriend.payment import expire_payments
+        with self.app.app_context():
+            return expire_payments(batch_size=self.batch_size)
+
+    def start(self):
+        """
+        Runs the sweeper in a background thread of this process,
+        stopped when the process exits.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='payfriend-expiry')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops the background thread, letting a sweep in progress commit
+        rather than dying with the interpreter mid-transaction.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.STOP_TIMEOUT)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                expired = self.sweep()
+            except Exception:
+                logger.exception('Error expiring payments')
+                continue
+            if expired:
+                logger.info('Expired %d payments', expired)
+
+
+class Expiry:
+    """
+    Gives each app its ``ExpirySweeper``, started with the first
+    request unless ``PAYMENT_SWEEP_INTERVAL`` is 0.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        sweeper = ExpirySweeper(
+            app,
+            interval=app.config['PAYMENT_SWEEP_INTERVAL'],
+            batch_size=app.config['PAYMENT_SWEEP_BATCH_SIZE'])
+        app.extensions['expiry_sweeper'] = sweeper
+        if sweeper.interval > 0:
+            # not on import or for CLI commands: only serving processes
+            app.before_first_request(sweeper.start)
+
+    @property
+    def sweeper(self):
+        return current_app.extensions['expiry_sweeper']
+
+    def sweep(self):
+        return self.sweeper.sweep()
+
+
+expiry = Expiry()
@@ -0,0 +1,62 @@
+import csv
+import io
+import json
+
+
+COLUMNS = ('email', 'id', 'send_to', 'amount', 'status', 'created_at')
+
+# rows written per chunk sent to the client
+CHUNK_ROWS = 1000
+
+
+def csv_chunks(rows, chunk_rows=CHUNK_ROWS):
+    """
+    Writes payment rows from ``get_user_payments`` as CSV, with a
+    header row, ``chunk_rows`` rows at a time.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    count = 0
+    for (email, payment_id, send_to, amount, status, created_at) in rows:
+        writer.writerow((email, payment_id, send_to, amount, status,
+                         created_at.isoformat()))
+        count += 1
+        if count == chunk_rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, chunk_rows=CHUNK_ROWS):
+    """
+    Writes payment rows from ``get_user_payments`` as newline-delimited
+    JSON objects, ``chunk_rows`` rows at a time.
+    """
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    lines = []
+    for (email, payment_id, send_to, amount, status, created_at) in rows:
+        lines.append(encode({
+            'email': email,
+            'id': payment_id,
+            'send_to': send_to,
+            'amount': amount,
+            'status': status,
+            'created_at': created_at.isoformat(),
+        }))
+        if len(lines) == chunk_rows:
+            lines.append('')
+            yield '\n'.join(lines)
+            lines = []
+    if lines:
+        lines.append('')
+        yield '\n'.join(lines)
+
+
+# format name: (mimetype, file extension, writer)
+FORMATS = {
+    'csv': ('text/csv', 'csv', csv_chunks),
+    'ndjson': ('application/x-ndjson', 'ndjson', ndjson_chunks),
+}
@@ -0,0 +1,130 @@
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+
+
+FAKE_CODE = '0000000'
+
+
+class FakeResponse:
+    """Mimics ``authy.api.resources.Instance``."""
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def ok(self):
+        return self.status_code == 200
+
+    def errors(self):
+        if self.ok():
+            return {}
+        return self.content
+
+    def __getitem__(self, key):
+        return self.content[key]
+
+
+class FakeUser(FakeResponse):
+    @property
+    def id(self):
+        return self.content['user']['id']
+
+
+def _error(message):
+    return FakeResponse({'success': False, 'message': message}, 400)
+
+
+class _Resource:
+    def __init__(self, client):
+        self.client = client
+
+    def _record(self, name, *args):
+        self.client.record(name, args)
+
+
+class FakePhones(_Resource):
+    def verification_start(self, phone_number, country_code, via='sms',
+                           locale=None, code_length=4):
+        self._record('phones.verification_start', phone_number, country_code, via)
+        return FakeResponse({
+            'success': True,
+            'message': '{} sent to +{} {}.'.format(
+                'Text message' if via == 'sms' else 'Call',
+                country_code, phone_number)
+        })
+
+    def verification_check(self, phone_number, country_code, verification_code):
+        self._record('phones.verification_check', phone_number, country_code)
+        if verification_code != FAKE_CODE:
+            return _error('Verification code is incorrect')
+        return FakeResponse({'success': True, 'message': 'Verification code is correct.'})
+
+
+class FakeUsers(_Resource):
+    _ids = itertools.count(1)
+
+    def create(self, email, phone, country_code=1, send_install_link_via_sms=False):
+        self._record('users.create', email, phone, country_code)
+        return FakeUser({'success': True, 'user': {'id': next(self._ids)}})
+
+    def request_sms(self, user_id, options={}):
+        self._record('users.request_sms', user_id, options)
+        return FakeResponse({'success': True, 'message': 'SMS token was sent'})
+
+
+class FakeTokens(_Resource):
+    def verify(self, device_id, token, options={}):
+        self._record('tokens.verify', device_id, options)
+        if token != FAKE_CODE:
+            return _error('Token is invalid')
+        return FakeResponse({'success': 'true', 'token': 'is valid'})
+
+
+class FakeOneTouch(_Resource):
+    def send_request(self, user_id, message, seconds_to_expire=None,
+                     details={}, hidden_details={}, logos=[]):
+        self._record('one_touch.send_request', user_id, message)
+        return FakeResponse({
+            'success': True,
+            'approval_request': {'uuid': str(uuid.uuid4())}
+        })
+
+    def validate_one_touch_signature(self, signature, nonce, method, url, params):
+        self._record('one_touch.validate_one_touch_signature', nonce)
+        return True
+
+
+class FakeAuthyApiClient:
+    """
+    In-process stand-in for ``AuthyApiClient``, enabled with
+    ``AUTHY_BACKEND = 'fake'``.
+
+    Makes no network calls, accepts ``FAKE_CODE`` as the only valid
+    verification code and approves every OneTouch signature, so flows
+    can be exercised without an Authy account.
+
+    ``calls`` holds the most recent ``MAX_CALLS`` calls as
+    (name, args) tuples, for tests to inspect.
+
+    :param delay: seconds to sleep before every call, to simulate a
+        slow upstream
+    """
+    MAX_CALLS = 1000
+
+    def __init__(self, api_key=None, delay=0):
+        self.api_key = api_key
+        self.delay = delay
+        self.calls = deque(maxlen=self.MAX_CALLS)
+        self._lock = threading.Lock()
+        self.phones = FakePhones(self)
+        self.users = FakeUsers(self)
+        self.tokens = FakeTokens(self)
+        self.one_touch = FakeOneTouch(self)
+
+    def record(self, name, args):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.calls.append((name, args))
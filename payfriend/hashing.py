@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from payfriend.metrics import metrics
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with the parameters from ``Config``.
+
+    Hashes are in werkzeug's ``method$salt$hash`` format, so each one
+    records the method (and for pbkdf2 the iteration count) it was made
+    with. ``needs_rehash`` compares those against the current settings,
+    so stored hashes can be upgraded when the user next logs in.
+
+    If ``workers`` is non-zero, verification runs in a process pool so
+    concurrent logins aren't serialized by the GIL.
+    """
+    def __init__(self, method, salt_length, workers=0):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        with metrics.timer('password_hash_seconds', op='hash'):
+            return generate_password_hash(
+                password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        with metrics.timer('password_hash_seconds', op='verify'):
+            if not self.workers:
+                return check_password_hash(pwhash, password)
+            return self._pool().submit(
+                check_password_hash, pwhash, password).result()
+
+    def needs_rehash(self, pwhash):
+        """
+        Whether ``pwhash`` was made with different parameters than the
+        current ones.
+        """
+        if pwhash.count('$') < 2:
+            return True
+        (method, salt, _) = pwhash.split('$', 2)
+        return method != self.method or len(salt) != self.salt_length
+
+    def _pool(self):
+        # created on first use, so pre-forking servers start one pool
+        # per worker process rather than sharing the master's
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+
+class Hashing:
+    """
+    Makes the app's ``PasswordHasher`` available to the models.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['password_hasher'] = PasswordHasher(
+            method=app.config['PASSWORD_HASH_METHOD'],
+            salt_length=app.config['PASSWORD_SALT_LENGTH'],
+            workers=app.config['PASSWORD_HASH_WORKERS'])
+
+    @property
+    def hasher(self):
+        return current_app.extensions['password_hasher']
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, pwhash, password):
+        return self.hasher.verify(pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return self.hasher.needs_rehash(pwhash)
+
+
+hashing = Hashing()
@@ -0,0 +1,359 @@
+import atexit
+import hmac
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from flask import (
+    Response,
+    abort,
+    current_app,
+    g,
+    has_app_context,
+    request
+)
+from jinja2 import Template
+
+
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, Prometheus style.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ('state', 'name', 'labels', 'start')
+
+    def __init__(self, state, name, labels):
+        self.state = state
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.state.observe(self.name, time.perf_counter() - self.start,
+                           TIME_BUCKETS, self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class AppMetrics:
+    """
+    One app's histograms, per-thread query counts and profiler.
+    """
+    def __init__(self, profiler=None):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.queries = threading.local()
+        self.profiler = profiler
+
+    def observe(self, name, value, buckets, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+
+class Metrics:
+    """
+    Request-level timers and histograms, exported at ``/metrics`` in
+    the Prometheus text format.
+
+    Disabled unless ``METRICS_ENABLED`` is set; each app keeps its own
+    ``AppMetrics`` in ``app.extensions['metrics']``. When disabled,
+    ``timer`` and ``timed`` cost one dict lookup and nothing is
+    registered on the app. The export endpoints are only added if
+    ``METRICS_TOKEN`` is set, and answer only requests that send it as
+    a bearer token.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        profiler = None
+        if app.config['PROFILER_ENABLED']:
+            profiler = SamplingProfiler(app.config['PROFILER_INTERVAL'])
+            # not on import or for CLI commands: only serving processes
+            app.before_first_request(profiler.start)
+        app.extensions['metrics'] = AppMetrics(profiler)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.jinja_env.template_class = TimedTemplate
+
+        from sqlalchemy import event
+        from payfriend import db
+        state = app.extensions['metrics']
+
+        def count_query(*args):
+            state.queries.count = getattr(state.queries, 'count', 0) + 1
+
+        with app.app_context():
+            event.listen(db.get_engine(app), 'before_cursor_execute',
+                         count_query)
+
+        if not app.config['METRICS_TOKEN']:
+            app.logger.warning('METRICS_TOKEN is not set: metrics are '
+                               'collected but not exported.')
+            return
+        app.add_url_rule('/metrics', 'metrics',
+                         self._protected(self.export))
+        if profiler is not None:
+            app.add_url_rule('/metrics/profile', 'profile',
+                             self._protected(self.export_profile))
+
+    @property
+    def _state(self):
+        if not has_app_context():
+            return None
+        return current_app.extensions.get('metrics')
+
+    @property
+    def enabled(self):
+        return self._state is not None
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        state = self._state
+        if state is not None:
+            state.observe(name, value, buckets, labels)
+
+    def timer(self, name, **labels):
+        """
+        Context manager that records how long its block takes.
+        """
+        state = self._state
+        if state is None:
+            return _null_timer
+        return _Timer(state, name, labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator that records how long each call takes, labelled with
+        the function name.
+        """
+        def decorator(f):
+            call_labels = dict(labels, call=f.__name__)
+
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                state = self._state
+                if state is None:
+                    return f(*args, **kwargs)
+                with _Timer(state, name, call_labels):
+                    return f(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def _protected(self, view):
+        @wraps(view)
+        def wrapped():
+            expected = 'Bearer ' + current_app.config['METRICS_TOKEN']
+            given = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(expected.encode(), given.encode()):
+                abort(401)
+            return view()
+        return wrapped
+
+    def _start_request(self):
+        state = self._state
+        g.metrics_start = time.perf_counter()
+        state.queries.count = 0
+        if state.profiler is not None:
+            state.profiler.enter(request.endpoint)
+
+    def _finish_request(self, response):
+        state = self._state
+        if state.profiler is not None:
+            state.profiler.leave()
+        start = g.get('metrics_start')
+        if start is not None:
+            endpoint = request.endpoint or 'unknown'
+            state.observe('request_seconds', time.perf_counter() - start,
+                          TIME_BUCKETS, {'endpoint': endpoint})
+            state.observe('sql_queries_per_request', state.queries.count,
+                          COUNT_BUCKETS, {'endpoint': endpoint})
+        return response
+
+    def export(self):
+        """
+        Renders all histograms, cache counters and Authy connection
+        pool counters in the Prometheus text format.
+        """
+        state = self._state
+        lines = []
+        with state.lock:
+            histograms = sorted(state.histograms.items())
+            typed = set()
+            for ((name, labels), histogram) in histograms:
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                cumulative = 0
+                for (bound, count) in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels, le=bound), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels, le='+Inf'), histogram.count))
+                lines.append('{}_sum{} {}'.format(
+                    name, _labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(
+                    name, _labels(labels), histogram.count))
+
+        lines.extend(self._cache_counters())
+        lines.extend(self._authy_pool_counters())
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
+
+    def _cache_counters(self):
+        from payfriend.cache import LRUCache
+        caches = sorted((name, cache) for (name, cache)
+                        in current_app.extensions.items()
+                        if isinstance(cache, LRUCache))
+        lines = ['# TYPE cache_hits_total counter']
+        lines.extend('cache_hits_total{} {}'.format(
+            _labels((), cache=name), cache.hits) for (name, cache) in caches)
+        lines.append('# TYPE cache_misses_total counter')
+        lines.extend('cache_misses_total{} {}'.format(
+            _labels((), cache=name), cache.misses) for (name, cache) in caches)
+        return lines
+
+    def _authy_pool_counters(self):
+        from payfriend.clients import authy_clients
+        lines = []
+        for (key, value) in sorted(authy_clients.stats().items()):
+            name = 'authy_pool_{}_total'.format(key)
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+        return lines
+
+    def export_profile(self):
+        """
+        Sampled stacks per endpoint in the collapsed format read by
+        flamegraph.pl and speedscope. Filter with ``?endpoint=``.
+        """
+        endpoint = request.args.get('endpoint')
+        return Response(self._state.profiler.collapsed(endpoint),
+                        mimetype='text/plain')
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for (k, v) in pairs) + '}'
+
+
+class TimedTemplate(Template):
+    """
+    Template that records its render time, installed as the app's
+    ``jinja_env.template_class`` when metrics are enabled.
+    """
+    def render(self, *args, **kwargs):
+        with metrics.timer('template_render_seconds', template=self.name):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of threads serving requests every ``interval``
+    seconds and counts them per endpoint.
+    """
+    MAX_STACKS = 10000
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._endpoints = {}
+        self._stacks = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Samples in a background thread until ``stop`` is called or the
+        process exits.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='payfriend-profiler')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def enter(self, endpoint):
+        self._endpoints[threading.get_ident()] = endpoint or 'unknown'
+
+    def leave(self):
+        self._endpoints.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for (thread_id, endpoint) in list(self._endpoints.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self._record(endpoint, frame)
+
+    def _record(self, endpoint, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(code.co_filename, code.co_name))
+            frame = frame.f_back
+        stack = ';'.join(reversed(stack))
+        with self._lock:
+            stacks = self._stacks[endpoint]
+            if stack in stacks or len(stacks) < self.MAX_STACKS:
+                stacks[stack] += 1
+
+    def collapsed(self, endpoint=None):
+        with self._lock:
+            lines = ['{};{} {}'.format(name, stack, count)
+                     for (name, stacks) in sorted(self._stacks.items())
+                     if endpoint is None or name == endpoint
+                     for (stack, count) in stacks.items()]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -1,5 +1,8 @@
+from datetime import datetime
+from flask import current_app
 from payfriend import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from payfriend.hashing import hashing
+from sqlalchemy import event
 
 
 class User(db.Model):
@@ -10,14 +13,20 @@ class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(64), unique=True, index=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(255))
     phone_number = db.Column(db.String(30), unique=True)
-    authy_id = db.Column(db.Integer)
+    # phone_number split up for the Authy API, parsed at registration
+    country_code = db.Column(db.Integer)
+    national_number = db.Column(db.String(20))
+    authy_id = db.Column(db.Integer, unique=True, index=True)
 
-    def __init__(self, email, password, phone_number):
+    def __init__(self, email, password, phone_number,
+                 country_code=None, national_number=None):
         self.email = email
         self.password = password
         self.phone_number = phone_number
+        self.country_code = country_code
+        self.national_number = national_number
 
     def __repr__(self):
         return '<User %r>' % self.email
@@ -28,10 +37,146 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hashing.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return hashing.needs_rehash(self.password_hash)
+
+
+class UserSnapshot:
+    """
+    A compact, read-only copy of the ``User`` fields needed to serve a
+    request. Cached per user so ``g.user`` can be loaded without a
+    database round trip.
+    """
+    __slots__ = ('id', 'email', 'phone_number', 'country_code',
+                 'national_number', 'authy_id')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+        self.phone_number = user.phone_number
+        self.country_code = user.country_code
+        self.national_number = user.national_number
+        self.authy_id = user.authy_id
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<UserSnapshot %r>' % self.email
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, user):
+    """
+    Drops a changed user from the identity cache, e.g. once
+    ``handle_verified_user`` sets their Authy ID.
+    """
+    cache = current_app.extensions.get('user_cache')
+    if cache is not None:
+        cache.delete(user.id)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_count(mapper, connection, user):
+    cache = current_app.extensions.get('count_cache')
+    if cache is not None:
+        cache.delete('users')
+
+
+class VerificationStart(db.Model):
+    """
+    When a verification code was last sent to a phone, for the shared
+    verification throttle.
+    """
+    __tablename__ = 'verification_starts'
+
+    phone = db.Column(db.String(32), primary_key=True)
+    # token bucket state; times are Unix timestamps
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+    last_start = db.Column(db.Float, nullable=False)
+
+
+class SessionRecord(db.Model):
+    """
+    A server-side session, see ``payfriend.sessions``.
+    """
+    __tablename__ = 'sessions'
+
+    id = db.Column(db.String(32), primary_key=True)
+    # the session as tagged JSON
+    data = db.Column(db.Text, nullable=False)
+    # Unix timestamp
+    expires_at = db.Column(db.Float, nullable=False)
+
+
+class OutboxMessage(db.Model):
+    """
+    An Authy request waiting to be sent, saved in the same transaction
+    as the change that calls for it. See ``payfriend.outbox``.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        # the next messages to claim, see OutboxWorker
+        db.Index('ix_outbox_priority_id', 'priority', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    # the handler's keyword arguments as JSON
+    payload = db.Column(db.Text, nullable=False)
+    priority = db.Column(db.SmallInteger, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Unix timestamps: when the message may next be sent, and when the
+    # worker that claimed it is presumed dead
+    available_at = db.Column(db.Float, nullable=False)
+    claimed_by = db.Column(db.String(32))
+    claimed_until = db.Column(db.Float)
+    last_error = db.Column(db.String(255))
+
+    def __init__(self, kind, payload, priority, available_at):
+        self.kind = kind
+        self.payload = payload
+        self.priority = priority
+        self.attempts = 0
+        self.available_at = available_at
+
+
+AUTHY_STATUSES = (
+    'pending',
+    'approved',
+    'denied',
+    'expired'
+)
+
+
+class PaymentStatus(db.TypeDecorator):
+    """
+    Stores a payment status as its index in ``AUTHY_STATUSES``.
+    Only append to ``AUTHY_STATUSES``: reordering it changes the
+    meaning of stored rows.
+    """
+    impl = db.SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return AUTHY_STATUSES.index(value)
+        except ValueError:
+            raise ValueError('Unknown payment status {!r}'.format(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return AUTHY_STATUSES[value]
 
 
 class Payment(db.Model):
@@ -39,28 +184,56 @@ class Payment(db.Model):
     Represents a single payment in the system.
     """
     __tablename__ = 'payments'
-
-    AUTHY_STATUSES = (
-        'pending',
-        'approved',
-        'denied'
+    __table_args__ = (
+        # payments for a user, optionally by status
+        db.Index('ix_payments_authy_id_status', 'authy_id', 'status'),
+        # keyset pagination of a user's payments, newest first
+        db.Index('ix_payments_authy_id_created_at',
+                 'authy_id', 'created_at', 'id'),
+        # overdue pending payments, for the expiry sweeper
+        db.Index('ix_payments_status_expires_at', 'status', 'expires_at'),
+        # status counts for a bulk batch, see payment.batch_summary
+        db.Index('ix_payments_batch_id', 'batch_id', 'authy_id', 'status'),
     )
 
+    AUTHY_STATUSES = AUTHY_STATUSES
+
     id = db.Column(db.String(128), primary_key=True)
     authy_id = db.Column(db.Integer, db.ForeignKey('users.authy_id'))
     send_to = db.Column(db.String(128))
     amount = db.Column(db.Integer)
-    push_id = db.Column(db.String(128))
-    status = db.Column(db.Enum(*AUTHY_STATUSES, name='authy_statuses'))
+    push_id = db.Column(db.String(128), unique=True, index=True)
+    status = db.Column(PaymentStatus(), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # when a pending payment's push request expires
+    expires_at = db.Column(db.DateTime)
+    # set for payments submitted together through /payments/bulk
+    batch_id = db.Column(db.String(36))
 
     def __init__(self, id, authy_id, send_to, amount, push_id, 
-                 status='pending'):
+                 status='pending', expires_at=None, batch_id=None):
         self.id = id
         self.authy_id = authy_id
         self.send_to = send_to
         self.amount = amount
         self.push_id = push_id
         self.status = status
+        self.expires_at = expires_at
+        self.batch_id = batch_id
     
     def __repr__(self):
-        return '<Payment %r>' % self.id
\ No newline at end of file
+        return '<Payment %r>' % self.id
+
+
+class PaymentAggregate(db.Model):
+    """
+    The number and total amount of a user's payments with one status,
+    kept up to date as payments are created and change status. See
+    ``payfriend.aggregates``.
+    """
+    __tablename__ = 'payment_aggregates'
+
+    authy_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    status = db.Column(PaymentStatus(), primary_key=True)
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+    amount_total = db.Column(db.BigInteger, nullable=False, default=0)
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import hmac
+import re
+import time
+from functools import lru_cache
+from urllib.parse import quote
+from flask import current_app
+from payfriend.cache import LRUCache
+
+
+VALID = 'valid'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+
+_LIST_INDEX = re.compile('\\%5B([0-9])*\\%5D')
+_NONE = re.compile('\\=None')
+# characters quote() leaves alone, apart from '/'
+_UNRESERVED = re.compile('[A-Za-z0-9_.~-]*')
+
+
+def canonical_params(params):
+    """
+    The sorted, URL-encoded form of a callback body that Authy signs.
+
+    Matches ``authy.api.resources.OneTouch.validate_one_touch_signature``
+    exactly, quirks included, but builds each ``key=value`` pair once
+    instead of formatting and re-splitting the whole query string.
+    """
+    pairs = []
+    _add_pairs(params, '', pairs)
+    pairs = sorted(pair.replace('/', '%2F').replace('%20', '+')
+                   for pair in pairs)
+    return '&'.join(_normalize(pair) for pair in pairs)
+
+
+def _normalize(pair):
+    if '%5B' in pair:
+        pair = _LIST_INDEX.sub('%5B%5D', pair)
+    if '=None' in pair:
+        pair = _NONE.sub('=', pair)
+    return pair
+
+
+def _quote(value):
+    if _UNRESERVED.fullmatch(value):
+        return value
+    return quote(value)
+
+
+@lru_cache(maxsize=1024)
+def _quote_name(prefix, key):
+    # callbacks all share the same few keys
+    if prefix:
+        return prefix + quote('[' + key + ']')
+    return quote(key)
+
+
+def _add_pairs(params, prefix, pairs):
+    for (key, value) in params.items():
+        name = _quote_name(prefix, key)
+        if type(value) is dict:
+            _add_pairs(value, name, pairs)
+        elif type(value) is list:
+            for (i, item) in enumerate(value):
+                item_name = name + '%5B' + str(i) + '%5D'
+                if type(item) is dict:
+                    _add_pairs(item, item_name, pairs)
+                else:
+                    pairs.append(item_name + '=' + _quote(str(item)))
+        elif type(value) is bool:
+            pairs.append(name + '=' + str(value).lower())
+        else:
+            pairs.append(name + '=' + _quote(str(value)))
+
+
+class OneTouchVerifier:
+    """
+    Checks the signatures on OneTouch callbacks.
+
+    The HMAC is keyed once and copied for each callback. Authy's nonce
+    is the time the callback was signed, so callbacks signed more than
+    ``max_age`` seconds away from now are rejected, and the signatures
+    of accepted ones are remembered for twice that long: a repeat of
+    one is reported as a duplicate without being checked again.
+
+    :param api_key: the Authy API key; without one every callback is
+        rejected
+    :param max_age: seconds a callback's nonce stays valid
+    :param replay_size: signatures remembered to catch repeats
+    :param verify: False to accept any signature, for the fake Authy
+        backend only
+    """
+    def __init__(self, api_key, max_age=300, replay_size=100000,
+                 verify=True):
+        self._mac = None
+        if api_key:
+            self._mac = hmac.new(api_key.encode(), digestmod=hashlib.sha256)
+        self.verify = verify
+        self.max_age = max_age
+        self._seen = LRUCache(maxsize=replay_size, ttl=2 * max_age)
+
+    def sign(self, nonce, method, url, params):
+        """
+        Computes the ``X-Authy-Signature`` header for a callback.
+        """
+        mac = self._mac.copy()
+        mac.update('|'.join(
+            (nonce, method, url, canonical_params(params))).encode())
+        return base64.b64encode(mac.digest()).decode()
+
+    def check(self, signature, nonce, method, url, params):
+        """
+        :returns: ``VALID``, ``DUPLICATE`` if this exact callback was
+            already accepted, or ``INVALID``
+        """
+        if not signature or not nonce or not isinstance(params, dict):
+            return INVALID
+        if self._seen.get(signature) is not None:
+            return DUPLICATE
+
+        if self.verify:
+            if self._mac is None:
+                return INVALID
+            try:
+                age = abs(time.time() - float(nonce))
+            except ValueError:
+                return INVALID
+            # also rejects nan
+            if not age <= self.max_age:
+                return INVALID
+            # as bytes: compare_digest refuses non-ASCII strings
+            expected = self.sign(nonce, method, url, params).encode()
+            if not hmac.compare_digest(expected, signature.encode()):
+                return INVALID
+
+        self._seen.set(signature, True)
+        return VALID
+
+
+class OneTouch:
+    """
+    Gives each app a ``OneTouchVerifier`` for its Authy API key.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        api_key = app.config['AUTHY_API_KEY']
+        verify = app.config['AUTHY_BACKEND'] != 'fake'
+        if verify and not api_key:
+            app.logger.warning('AUTHY_API_KEY is not set: every OneTouch '
+                               'callback will be rejected.')
+        app.extensions['onetouch_verifier'] = OneTouchVerifier(
+            api_key,
+            max_age=app.config['ONETOUCH_NONCE_MAX_AGE'],
+            replay_size=app.config['ONETOUCH_REPLAY_CACHE_SIZE'],
+            verify=verify)
+
+    @property
+    def verifier(self):
+        return current_app.extensions['onetouch_verifier']
+
+    def check(self, signature, nonce, method, url, params):
+        return self.verifier.check(signature, nonce, method, url, params)
+
+
+onetouch = OneTouch()
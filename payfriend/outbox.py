@@ -0,0 +1,276 @@
+import atexit
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from payfriend import db
+from payfriend.dispatch import not_sent
+from payfriend.models import OutboxMessage
+
+
+logger = logging.getLogger(__name__)
+
+# message priorities, lowest first
+INTERACTIVE = 0
+BULK = 1
+
+
+def enqueue(kind, payload, priority=INTERACTIVE):
+    """
+    Adds a message to the outbox in the session's transaction, so it's
+    only sent if the caller's changes commit. Call ``outbox.notify()``
+    after committing to have it sent straight away.
+
+    :param kind: a key of ``handlers()``
+    :param payload: keyword arguments for the handler, as JSON
+    """
+    db.session.add(OutboxMessage(kind, json.dumps(payload), priority,
+                                 time.time()))
+
+
+def enqueue_many(kind, payloads, priority=BULK):
+    """
+    Like ``enqueue``, for many messages at once with one bulk insert.
+    """
+    now = time.time()
+    db.session.bulk_insert_mappings(OutboxMessage, [{
+        'kind': kind,
+        'payload': json.dumps(payload),
+        'priority': priority,
+        'available_at': now,
+        'attempts': 0,
+    } for payload in payloads])
+
+
+def handlers():
+    """
+    The function that sends each kind of message, and the one called
+    with the same arguments once it has failed too often (or None).
+
+    Messages are sent at least once: a worker that dies mid-send
+    leaves its claim to expire and the message is sent again, so
+    handlers check whether their work was already done.
+    """
+    from payfriend import payment, utils
+    return {
+        'push_auth': (payment.request_push_auth, payment.push_auth_failed),
+        'start_verification': (utils.request_verification, None),
+    }
+
+
+class OutboxWorker:
+    """
+    Sends outbox messages, ``batch_size`` at a time, ``concurrency`` at
+    once.
+
+    A batch is claimed by stamping it with a token and a lease that
+    ends ``lease`` seconds later; the claim is a conditional UPDATE, so
+    any number of workers, in any number of processes, never claim the
+    same message at once. A sent message is deleted. One that failed
+    to reach Authy is retried with exponential backoff, up to
+    ``max_attempts`` times; any other failure may have reached it, and
+    sending an SMS or push twice is worse than not at all, so the
+    message is given up on and deleted straight away, as is one that
+    can't be read. Claims left by a worker that died run out after the
+    lease and the messages are claimed again.
+    """
+    # seconds to wait at shutdown for the batch being sent
+    STOP_TIMEOUT = 10
+
+    def __init__(self, app, batch_size, concurrency, poll_interval, lease,
+                 max_attempts, backoff):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='payfriend-outbox')
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def notify(self):
+        """
+        Wakes the worker, e.g. after committing new messages.
+        """
+        self._wake.set()
+
+    def start(self):
+        """
+        Runs the worker in a background thread of this process,
+        stopped when the process exits.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self.run, name='payfriend-outbox-drain')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stops ``run`` after the batch it's sending, which is finished
+        so its messages are deleted or released for retry. If that
+        takes more than ``STOP_TIMEOUT`` seconds, the rest are left to
+        be claimed again when their lease runs out.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.STOP_TIMEOUT)
+
+    def run(self):
+        """
+        Sends messages until ``stop`` is called, waiting up to
+        ``poll_interval`` seconds for new ones whenever it runs out.
+        """
+        while not self._stopped.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception:
+                logger.exception('Error draining the outbox')
+                sent = 0
+            if not sent:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def drain(self):
+        """
+        Sends everything that's ready, in the calling thread.
+
+        :returns: the number of messages handled
+        """
+        total = 0
+        while True:
+            handled = self.drain_once()
+            if not handled:
+                return total
+            total += handled
+
+    def drain_once(self):
+        """
+        Claims one batch and handles it.
+
+        :returns: the number of messages handled
+        """
+        with self.app.app_context():
+            (token, messages) = self._claim()
+        if not messages:
+            return 0
+        results = list(self._executor.map(
+            lambda message: self._handle(token, message), messages))
+        return len(results)
+
+    def _claim(self):
+        outbox = OutboxMessage.__table__
+        now = time.time()
+        token = uuid.uuid4().hex
+        free = db.or_(outbox.c.claimed_until.is_(None),
+                      outbox.c.claimed_until < now)
+        with db.engine.begin() as conn:
+            ids = [row.id for row in conn.execute(
+                db.select([outbox.c.id])
+                .where(outbox.c.available_at <= now)
+                .where(free)
+                .order_by(outbox.c.priority, outbox.c.id)
+                .limit(self.batch_size))]
+            if not ids:
+                return (token, [])
+            # re-checked, in case another worker claimed them meanwhile
+            conn.execute(
+                outbox.update()
+                .where(outbox.c.id.in_(ids))
+                .where(free)
+                .values(claimed_by=token, claimed_until=now + self.lease))
+            messages = conn.execute(
+                outbox.select().where(outbox.c.claimed_by == token)).fetchall()
+        return (token, messages)
+
+    def _handle(self, token, message):
+        outbox = OutboxMessage.__table__
+        mine = db.and_(outbox.c.id == message.id,
+                       outbox.c.claimed_by == token)
+
+        with self.app.app_context():
+            try:
+                (send, give_up) = handlers()[message.kind]
+                payload = json.loads(message.payload)
+            except (KeyError, ValueError):
+                # retrying can't help, and it would come back forever
+                logger.exception('Dropping outbox message %d (%s): unknown '
+                                 'kind or bad payload', message.id,
+                                 message.kind)
+                db.engine.execute(outbox.delete().where(mine))
+                return
+
+            try:
+                send(**payload)
+            except Exception as e:
+                db.session.rollback()
+                attempts = message.attempts + 1
+                if attempts < self.max_attempts and not_sent(e):
+                    logger.warning('Outbox message %d (%s) failed, retrying: %s',
+                                   message.id, message.kind, e)
+                    db.engine.execute(outbox.update().where(mine).values(
+                        attempts=attempts,
+                        available_at=time.time() +
+                            self.backoff * 2 ** message.attempts,
+                        claimed_by=None,
+                        claimed_until=None,
+                        last_error=str(e)[:255]))
+                    return
+                logger.exception('Outbox message %d (%s) failed after %d '
+                                 'attempts, giving up', message.id,
+                                 message.kind, attempts)
+                if give_up is not None:
+                    try:
+                        give_up(**payload)
+                    except Exception:
+                        db.session.rollback()
+                        logger.exception('Error giving up on outbox '
+                                         'message %d (%s)', message.id,
+                                         message.kind)
+            db.engine.execute(outbox.delete().where(mine))
+
+
+class Outbox:
+    """
+    Gives each app its ``OutboxWorker``. Unless ``OUTBOX_INLINE_DRAIN``
+    is off, each server process also drains the outbox in a background
+    thread, started with the first request; either way, ``flask
+    outbox-worker`` runs a worker on its own.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        worker = OutboxWorker(
+            app,
+            batch_size=app.config['OUTBOX_BATCH_SIZE'],
+            concurrency=app.config['OUTBOX_CONCURRENCY'],
+            poll_interval=app.config['OUTBOX_POLL_INTERVAL'],
+            lease=app.config['OUTBOX_LEASE'],
+            max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'],
+            backoff=app.config['OUTBOX_RETRY_BACKOFF'])
+        app.extensions['outbox_worker'] = worker
+        if app.config['OUTBOX_INLINE_DRAIN']:
+            app.before_first_request(worker.start)
+
+    @property
+    def worker(self):
+        return current_app.extensions['outbox_worker']
+
+    def notify(self):
+        self.worker.notify()
+
+
+outbox = Outbox()
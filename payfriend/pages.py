@@ -0,0 +1,142 @@
+import logging
+import os
+from functools import wraps
+from flask import (
+    _request_ctx_stack,
+    current_app,
+    g,
+    make_response,
+    render_template,
+    request,
+    session
+)
+from jinja2 import FileSystemBytecodeCache
+from payfriend.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+# stands in for the CSRF token in cached pages; can't occur in a token
+CSRF_PLACEHOLDER = '\x00csrf\x00'
+
+
+def use_bytecode_cache(app):
+    """
+    Keeps compiled templates in ``JINJA_CACHE_DIR`` (by default under
+    the instance folder), so a new worker loads them instead of
+    compiling every template again. ``flask build-assets`` fills it.
+    """
+    directory = app.config['JINJA_CACHE_DIR'] or \
+        os.path.join(app.instance_path, 'jinja')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logger.warning('Not caching compiled templates: %s', e)
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+class PageCache:
+    """
+    Caches the HTML of pages that look the same to every anonymous
+    visitor, so they're rendered once per process instead of on every
+    request. Only GET and HEAD requests from visitors who aren't logged
+    in and have no flashed messages waiting are served from the cache.
+
+    Forms on these pages carry a per-session CSRF token, so the token
+    is stored as a placeholder and the visitor's own is put back in on
+    every hit. Flask-WTF keeps the token it made in ``g``, which lives
+    on the app context and is shared by every request when one is
+    already pushed (e.g. in tests), so it's dropped before rendering or
+    filling in a cached page and always made from this visitor's
+    session.
+
+    ``PAGE_CACHE_SIZE`` pages are kept, 0 to turn the cache off.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        size = app.config['PAGE_CACHE_SIZE']
+        app.extensions['page_cache'] = LRUCache(maxsize=size) if size else None
+
+    def cached(self, view):
+        """
+        View decorator that caches the page the view renders, by path.
+        The view must not depend on the query string.
+        """
+        @wraps(view)
+        def wrapped_view(**kwargs):
+            if not self._cacheable():
+                return view(**kwargs)
+
+            key = ('view', request.path)
+            body = self._get(key)
+            if body is not None:
+                return body
+
+            self._forget_token()
+            response = make_response(view(**kwargs))
+            if response.status_code == 200 and \
+                    response.mimetype == 'text/html' and \
+                    not response.is_streamed:
+                self._set(key, response.get_data(as_text=True))
+            return response
+
+        return wrapped_view
+
+    def render(self, key, template_name, **context):
+        """
+        Like ``render_template``, but cached under ``key`` for anonymous
+        visitors, e.g. for error pages that are the same for every URL.
+        """
+        if not self._cacheable():
+            return render_template(template_name, **context)
+
+        key = ('render', key)
+        body = self._get(key)
+        if body is None:
+            self._forget_token()
+            body = render_template(template_name, **context)
+            self._set(key, body)
+        return body
+
+    @property
+    def _cache(self):
+        return current_app.extensions['page_cache']
+
+    def _cacheable(self):
+        return self._cache is not None and \
+            request.method in ('GET', 'HEAD') and \
+            g.get('user') is None and \
+            '_flashes' not in session
+
+    def _get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        (body, has_token) = entry
+        if has_token:
+            from flask_wtf.csrf import generate_csrf
+            self._forget_token()
+            body = body.replace(CSRF_PLACEHOLDER, generate_csrf())
+        return body
+
+    def _token_name(self):
+        return current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+
+    def _forget_token(self):
+        g.pop(self._token_name(), None)
+
+    def _set(self, key, body):
+        if _request_ctx_stack.top.flashes:
+            # the view flashed a message, which the page shows
+            return
+        token = g.get(self._token_name())
+        if token:
+            body = body.replace(token, CSRF_PLACEHOLDER)
+        self._cache.set(key, (body, bool(token)))
+
+
+page_cache = PageCache()
@@ -1,5 +1,7 @@
+import base64
+import time
 import uuid
-from authy.api import AuthyApiClient
+from datetime import datetime, timedelta
 from flask import (
     abort,
     Blueprint,
@@ -9,66 +11,319 @@ from flask import (
     render_template,
     redirect,
     request,
+    Response,
     session,
+    stream_with_context,
     url_for
 )
 from flask import current_app as app
-from . import utils
+from . import aggregates, bulk, export, utils
 from payfriend import db
+from payfriend.callbacks import CallbackQueueFull, callbacks
+from payfriend.events import payment_events
+from payfriend.metrics import metrics
+from payfriend.outbox import BULK, enqueue, enqueue_many, outbox
 from payfriend.decorators import (
     display_flash_messages,
     login_required, 
     verification_required,
     verify_authy_request
 )
-from payfriend.forms import PaymentForm
 from payfriend.models import Payment, User
 
 
 bp = Blueprint('payments', __name__, url_prefix='/payments')
 
 
-@bp.before_app_request
-def load_logged_in_user():
+# the status changes a payment can make; statuses with none are final
+TRANSITIONS = {
+    'pending': ('approved', 'denied', 'expired'),
+}
+
+TERMINAL_STATUSES = tuple(
+    status for status in Payment.AUTHY_STATUSES if status not in TRANSITIONS)
+
+
+def can_become(status, now=None):
+    """
+    The condition a payment row must meet to move to ``status``: its
+    current status must allow the change.
+
+    Every status change is an UPDATE filtered on this, so of two
+    concurrent writers only the first succeeds.
+
+    :param now: also check ``expires_at`` against this time: only an
+        overdue payment can expire, and an overdue one can't be
+        approved or denied. Left out for changes Authy reports, as it
+        keeps its own time.
     """
-    If a user id is stored in the session, load the user object from
-    the database into ``g.user``.
+    payments = Payment.__table__
+    sources = [source for (source, targets) in TRANSITIONS.items()
+               if status in targets]
+    condition = payments.c.status.in_(sources)
+    if now is None:
+        return condition
+    if status == 'expired':
+        return db.and_(condition, payments.c.expires_at <= now)
+    return db.and_(condition, db.or_(payments.c.expires_at.is_(None),
+                                     payments.c.expires_at > now))
+
+
+def change_statuses(column, changes, now=None):
+    """
+    Moves payments to new statuses in the session's transaction, and
+    their counts and amounts between the owners' aggregates. The
+    caller commits, then calls ``status_changed`` for each change.
+
+    Each payment gets its own conditional UPDATE, so exactly the ones
+    that changed are known and the aggregates stay exact.
+
+    :param column: the ``payments`` column ``changes`` is keyed by,
+        ``id`` or ``push_id``
+    :param changes: dict of key to new status
+    :param now: see ``can_become``
+    :returns: (id, authy_id, status) rows of the payments that changed
     """
-    user_id = session.get('user_id')
+    payments = Payment.__table__
+    statements = {}
+    changed = []
+    for (key, status) in changes.items():
+        statement = statements.get(status)
+        if statement is None:
+            statement = statements[status] = payments.update() \
+                .where(column == db.bindparam('b_key')) \
+                .where(can_become(status, now)) \
+                .values(status=status)
+        if db.session.execute(statement, {'b_key': key}).rowcount:
+            changed.append(key)
+    if not changed:
+        return []
 
-    if user_id is None:
-        g.user = None
+    rows = db.session.query(
+            Payment.id, Payment.authy_id, Payment.amount, Payment.status) \
+        .filter(column.in_(changed)) \
+        .all()
+    tally = aggregates.Tally()
+    for row in rows:
+        # every transition starts from pending
+        tally.move(row.authy_id, row.amount, 'pending', row.status)
+    tally.save()
+    return rows
 
 
 def update_payment_status(payment, status):
     # once a payment status has been set, don't allow that to change
-    # this requires a new transaction in order to be PSD2 compliant
-    if payment.status != 'pending':
+    # this requires a new transaction in order to be PSD2 compliant.
+    changed = change_statuses(
+        Payment.__table__.c.id, {payment.id: status}, datetime.utcnow())
+    db.session.commit()
+
+    if not changed:
+        db.session.refresh(payment)
+        if payment.status == 'pending':
+            # overdue, and not swept yet
+            expire_payments([payment.id])
+            db.session.refresh(payment)
         flash("Error: payment request was already {}. Please start a new transaction.".format(
             payment.status))
         return redirect(url_for('payments.list_payments'))
 
-    payment.status = status
+    status_changed(payment.id, payment.authy_id, status)
+
+
+def status_changed(payment_id, authy_id, status):
+    """
+    Remembers a payment's new status if it's final, and wakes the
+    requests waiting on it.
+    """
+    if status in TERMINAL_STATUSES:
+        app.extensions['status_cache'].set(payment_id, (authy_id, status))
+    payment_events.publish(payment_id)
+
+
+def payment_status(payment_id, authy_id):
+    """
+    Returns the status of one of a user's payments, or None if they
+    have no such payment.
+
+    Final statuses never change, so they're answered from a cache
+    without touching the database once seen. Entries remember the
+    payment's owner, so users only see their own.
+
+    :param authy_id: Authy ID of the user asking
+    """
+    cache = app.extensions['status_cache']
+    with metrics.timer('payment_status_seconds', source='cache'):
+        entry = cache.get(payment_id)
+    if entry is not None:
+        (owner, status) = entry
+        return status if owner == authy_id else None
+
+    with metrics.timer('payment_status_seconds', source='database'):
+        status = db.session.query(Payment.status) \
+            .filter(Payment.id == payment_id) \
+            .filter(Payment.authy_id == authy_id) \
+            .scalar()
+    if status in TERMINAL_STATUSES:
+        cache.set(payment_id, (authy_id, status))
+    return status
+
+
+def overdue_payments(now, limit):
+    """
+    Queries the IDs of pending payments that expired before ``now``,
+    oldest first.
+    """
+    return db.session.query(Payment.id) \
+        .filter(Payment.status == 'pending') \
+        .filter(Payment.expires_at <= now) \
+        .order_by(Payment.expires_at) \
+        .limit(limit)
+
+
+def expire_payments(payment_ids=None, now=None, batch_size=500):
+    """
+    Marks overdue pending payments expired, ``batch_size`` per
+    transaction.
+
+    :param payment_ids: only consider these payments, instead of
+        every overdue one
+    :returns: the number of payments expired
+    """
+    if now is None:
+        now = datetime.utcnow()
+    expired = 0
+    while True:
+        if payment_ids is None:
+            batch = [row.id for row in overdue_payments(now, batch_size)]
+        else:
+            (batch, payment_ids) = (payment_ids[:batch_size],
+                                    payment_ids[batch_size:])
+        if not batch:
+            break
+
+        changed = change_statuses(
+            Payment.__table__.c.id, dict.fromkeys(batch, 'expired'), now)
+        db.session.commit()
+
+        for row in changed:
+            status_changed(row.id, row.authy_id, 'expired')
+        expired += len(changed)
+        if payment_ids is None and len(batch) < batch_size:
+            break
+    return expired
+
+
+def apply_push_statuses(updates):
+    """
+    Sets the status of many pending payments, identified by push_id,
+    in one transaction. Payments that already left pending are left
+    alone.
+
+    :param updates: dict of push_id to new status
+    :returns: the push_ids that matched no payment
+    """
+    change_statuses(Payment.__table__.c.push_id, updates)
+    found = db.session.query(
+            Payment.id, Payment.push_id, Payment.authy_id, Payment.status) \
+        .filter(Payment.push_id.in_(list(updates))) \
+        .all()
     db.session.commit()
 
+    for row in found:
+        status_changed(row.id, row.authy_id, row.status)
+    return set(updates) - set(row.push_id for row in found)
 
-def get_user_payments(email):
-    user_payments = db.session.query(Payment, User) \
+
+def get_user_payments(email, cursor=None, limit=None, since=None,
+                      until=None, status=None):
+    """
+    Queries a user's payments, newest first.
+
+    Selects plain columns rather than ORM entities; iterate the result
+    to stream rows with ``email``, ``id``, ``send_to``, ``amount``,
+    ``status`` and ``created_at`` attributes.
+
+    :param email: email of the user whose payments to list
+    :param cursor: from ``decode_cursor``: only return payments that
+        sort after this one
+    :param limit: maximum number of rows to return
+    :param since: only return payments created at or after this time
+    :param until: only return payments created before this time
+    :param status: only return payments with this status
+    """
+    query = db.session.query(
+            User.email,
+            Payment.id,
+            Payment.send_to,
+            Payment.amount,
+            Payment.status,
+            Payment.created_at) \
         .join(User) \
         .filter((User.email == email)) \
-        .all()
+        .order_by(Payment.created_at.desc(), Payment.id.desc())
+
+    if cursor is not None:
+        (created_at, payment_id) = cursor
+        query = query.filter(db.or_(
+            Payment.created_at < created_at,
+            db.and_(Payment.created_at == created_at,
+                    Payment.id < payment_id)))
+
+    if since is not None:
+        query = query.filter(Payment.created_at >= since)
+    if until is not None:
+        query = query.filter(Payment.created_at < until)
+    if status is not None:
+        query = query.filter(Payment.status == status)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.yield_per(100)
+
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(payment):
+    """
+    Encodes the position of a payment row as an opaque page cursor.
+    """
+    position = '{}|{}'.format(
+        payment.created_at.strftime(CURSOR_TIME_FORMAT), payment.id)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor from ``encode_cursor``. Aborts with a 400 if
+    it's malformed.
+
+    :returns: tuple (created_at, payment_id), or None for no cursor
+    """
+    if not cursor:
+        return None
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        (created_at, payment_id) = position.split('|', 1)
+        return (datetime.strptime(created_at, CURSOR_TIME_FORMAT), payment_id)
+    except ValueError:
+        abort(400)
 
-    payments = []
-    for (payment, user) in user_payments:
-        payments.append({
-            "email": user.email,
-            "id": payment.id,
-            "send_to": payment.send_to,
-            "amount": payment.amount,
-            "status": payment.status
-        })
-    
-    return payments
+
+def page_args():
+    """
+    Reads the ``cursor`` and ``limit`` query parameters of a
+    paginated listing.
+
+    :returns: tuple (cursor, limit)
+    """
+    cursor = decode_cursor(request.args.get('cursor'))
+    limit = request.args.get(
+        'limit', app.config['PAYMENTS_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['PAYMENTS_MAX_PAGE_SIZE']))
+    return (cursor, limit)
 
 
 @bp.route('/callback', methods=["POST"])
@@ -78,23 +333,73 @@ def callback():
     Used by Twilio to send a notification when the user 
     approves or denies a push authorization in the Authy app
     """
-    push_id = request.json.get('uuid')
-    status = request.json.get('status')
-    payment = Payment.query.filter_by(push_id=push_id).first()
+    return ('', accept_push_status(
+        request.json.get('uuid'), request.json.get('status')))
 
-    update_payment_status(payment, status)
-    return ('', 200)
+
+def accept_push_status(push_id, status):
+    """
+    Queues the status change from a OneTouch callback, to be written
+    in the next batch.
+
+    :returns: the HTTP status code to answer Authy with
+    """
+    if not push_id or status not in TRANSITIONS['pending']:
+        # nothing we can act on; don't make Authy retry it
+        return 200
+
+    try:
+        callbacks.submit(push_id, status)
+    except CallbackQueueFull:
+        return 503
+    return 200
 
 
 @bp.route('/status', methods=["GET", "POST"])
 @login_required
 def status():
     """
-    Used by AJAX requests to check the OneTouch verification status of a payment
+    Used by AJAX requests to check the OneTouch verification status of a payment.
+    Answers 404 unless the payment is the logged in user's.
+    """
+    status = payment_status(request.args.get('payment_id'), g.user.authy_id)
+    if status is None:
+        abort(404)
+    return status
+
+
+@bp.route('/status/wait', methods=["GET"])
+@login_required
+def wait_for_status():
+    """
+    Long-poll variant of ``status``. Holds the request open until the
+    payment leaves ``pending`` or ``STATUS_WAIT_TIMEOUT`` seconds pass,
+    then returns the current status. Clients re-issue the request while
+    the payment is still pending.
+
+    Status changes made in this process wake the request immediately;
+    the database is re-checked every ``STATUS_WAIT_POLL_INTERVAL``
+    seconds to pick up changes written by other workers.
     """
     payment_id = request.args.get('payment_id')
-    payment = Payment.query.get(payment_id)
-    return payment.status
+    timeout = app.config['STATUS_WAIT_TIMEOUT']
+    interval = app.config['STATUS_WAIT_POLL_INTERVAL']
+
+    with payment_events.subscribe(payment_id) as changed:
+        status = payment_status(payment_id, g.user.authy_id)
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while status == 'pending' and remaining > 0:
+            # don't hold a database connection while we wait
+            db.session.close()
+            changed.wait(min(interval, remaining))
+            changed.clear()
+            status = payment_status(payment_id, g.user.authy_id)
+            remaining = deadline - time.monotonic()
+
+    if status is None:
+        abort(404)
+    return status
 
 
 @bp.route('/send', methods=["GET", "POST"])
@@ -102,37 +407,351 @@ def status():
 @verification_required
 @display_flash_messages
 def send():
+    from payfriend.forms import PaymentForm
     form = PaymentForm(request.form)
     if form.validate_on_submit():
         send_to = form.send_to.data
         amount = form.amount.data
         authy_id = g.user.authy_id
 
-        # create a unique ID we can use to track payment status
-        payment_id = str(uuid.uuid4())
-
-        (push_id, errors) = utils.send_push_auth(authy_id, send_to, amount)
-        if push_id:
-            payment = Payment(payment_id, authy_id, send_to, amount, push_id)
-            db.session.add(payment)
-            db.session.commit()
-            return jsonify({
-                "success": True,
-                "payment_id": payment_id
-            })
-        else:
-            flash("Error sending authorization. {}".format(errors))
-            return jsonify({"success": False})
+        # the push request is sent by the outbox worker once the payment
+        # is saved, and its push_id filled in once Authy answers, which
+        # the client doesn't have to wait for: it polls the status by
+        # payment_id
+        payment = create_payment(authy_id, send_to, amount,
+                                 utils.push_hidden_details())
+
+        return jsonify({
+            "success": True,
+            "payment_id": payment.id
+        })
     
     return render_template("payments/send.html", form=form)
 
 
+def create_payment(authy_id, send_to, amount, hidden_details=None):
+    """
+    Saves a new pending payment, with a unique ID we can use to track
+    its status.
+
+    :param hidden_details: if given, the payment's push request is
+        queued in the outbox in the same transaction, so it's sent
+        exactly when the payment is saved; otherwise the caller sends it
+    """
+    payment = Payment(str(uuid.uuid4()), authy_id, send_to, amount, None,
+                      expires_at=push_expiry(datetime.utcnow()))
+    db.session.add(payment)
+    tally = aggregates.Tally()
+    tally.add(authy_id, 'pending', amount)
+    tally.save()
+    if hidden_details is not None:
+        enqueue('push_auth', {
+            'payment_id': payment.id,
+            'authy_id': authy_id,
+            'send_to': send_to,
+            'amount': amount,
+            'hidden_details': hidden_details,
+        })
+    db.session.commit()
+    if hidden_details is not None:
+        outbox.notify()
+    return payment
+
+
+def push_expiry(created_at):
+    """
+    When a payment created at ``created_at`` expires: when Authy
+    expires its push request.
+    """
+    return created_at + timedelta(seconds=utils.PUSH_SECONDS_TO_EXPIRE)
+
+
+def create_payments(authy_id, payments, hidden_details):
+    """
+    Saves a batch of new pending payments with a single bulk insert,
+    and queues their push requests in the outbox in the same
+    transaction, behind those of single payments.
+
+    :param payments: list of (send_to, amount) tuples
+    :returns: tuple (batch_id, list of payment IDs in the same order)
+    """
+    batch_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    rows = [{
+        'id': str(uuid.uuid4()),
+        'authy_id': authy_id,
+        'send_to': send_to,
+        'amount': amount,
+        'status': 'pending',
+        'created_at': now,
+        'expires_at': push_expiry(now),
+        'batch_id': batch_id,
+    } for (send_to, amount) in payments]
+    db.session.bulk_insert_mappings(Payment, rows)
+    tally = aggregates.Tally()
+    tally.add(authy_id, 'pending', sum(amount for (_, amount) in payments),
+              count=len(rows))
+    tally.save()
+    enqueue_many('push_auth', [{
+        'payment_id': row['id'],
+        'authy_id': authy_id,
+        'send_to': row['send_to'],
+        'amount': row['amount'],
+        'hidden_details': hidden_details,
+    } for row in rows], priority=BULK)
+    db.session.commit()
+    outbox.notify()
+    return (batch_id, [row['id'] for row in rows])
+
+
+@bp.route('/bulk', methods=["POST"])
+@login_required
+@verification_required
+def send_bulk():
+    """
+    Submits a batch of payments, as CSV or JSON (see ``bulk.read_batch``)
+    with the CSRF token in an ``X-CSRFToken`` header, and requests a
+    OneTouch approval for each.
+
+    The batch is checked as a whole: if any payment is invalid none are
+    saved, and the errors for each invalid one are returned. Otherwise
+    the push requests are sent by the outbox worker, and the batch's
+    progress can be followed at ``batch_status``.
+    """
+    check_csrf_header()
+    try:
+        items = bulk.read_batch(request.get_data(as_text=True),
+                                request.mimetype)
+        payments = bulk.validate_batch(items, app.config['BULK_MAX_PAYMENTS'])
+    except bulk.BatchError as e:
+        return jsonify({
+            "success": False,
+            "error": e.message,
+            "payments": e.items
+        }), 400
+
+    (batch_id, payment_ids) = create_payments(
+        g.user.authy_id, payments, utils.push_hidden_details())
+
+    return jsonify({
+        "success": True,
+        "batch_id": batch_id,
+        "payments": [{
+            "id": payment_id,
+            "send_to": send_to,
+            "amount": amount,
+            "status": "pending"
+        } for (payment_id, (send_to, amount)) in zip(payment_ids, payments)]
+    })
+
+
+def check_csrf_header():
+    """
+    Aborts with a 400 unless the ``X-CSRFToken`` header holds a valid
+    CSRF token, for views that don't take a form.
+    """
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return
+    from flask_wtf.csrf import validate_csrf
+    from wtforms import ValidationError
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError:
+        abort(400)
+
+
+def batch_summary(batch_id, authy_id):
+    """
+    Queries the number of a user's payments in a batch with each
+    status, as (status, count) rows. Answered from the
+    ``ix_payments_batch_id`` index alone.
+    """
+    return db.session.query(Payment.status, db.func.count()) \
+        .filter(Payment.batch_id == batch_id) \
+        .filter(Payment.authy_id == authy_id) \
+        .group_by(Payment.status)
+
+
+@bp.route('/bulk/<batch_id>', methods=["GET"])
+@login_required
+def batch_status(batch_id):
+    """
+    Counts the payments of one of the user's batches by status.
+    """
+    counts = dict(batch_summary(batch_id, g.user.authy_id).all())
+    if not counts:
+        abort(404)
+    return jsonify({
+        "batch_id": batch_id,
+        "total": sum(counts.values()),
+        "statuses": counts,
+        "done": 'pending' not in counts
+    })
+
+
+def request_push_auth(payment_id, authy_id, send_to, amount, hidden_details):
+    """
+    Outbox handler that sends the OneTouch push for a payment and
+    records its push_id. If Authy rejects the request the payment is
+    marked denied so a waiting client stops polling; if it can't be
+    reached the outbox retries.
+    """
+    payment = Payment.query.get(payment_id)
+    if payment is None or payment.push_id:
+        # deleted, or already sent by an earlier attempt
+        return
+
+    (push_id, errors) = utils.send_push_auth(
+        authy_id, send_to, amount, hidden_details)
+    record_push(payment, push_id, errors)
+
+
+def push_auth_failed(payment_id, authy_id, send_to, amount, hidden_details):
+    """
+    Called by the outbox once it has given up on a payment's push
+    request: the payment is denied, as nobody can approve it.
+    """
+    payment = Payment.query.get(payment_id)
+    if payment is not None and not payment.push_id:
+        record_push(payment, None, {'message': 'Authy could not be reached.'})
+
+
+def record_push(payment, push_id, errors):
+    """
+    Records the outcome of a payment's push request: its push_id, or
+    denied if Authy rejected it so a waiting client stops polling.
+    """
+    if push_id:
+        payment.push_id = push_id
+        db.session.commit()
+        payment_events.publish(payment.id)
+        return
+
+    app.logger.warning('Error sending authorization: %s', errors)
+    changed = change_statuses(Payment.__table__.c.id, {payment.id: 'denied'})
+    db.session.commit()
+    if changed:
+        status_changed(payment.id, payment.authy_id, 'denied')
+
+
 @bp.route('/', methods=["GET", "POST"])
 @login_required
 @display_flash_messages
 def list_payments():
-    payments = get_user_payments(g.user.email)
-    return render_template('payments/list.html', payments=payments)
+    """
+    Lists a page of the user's payments. The page is rendered as the
+    rows are read, so memory use doesn't grow with the page size.
+    """
+    (cursor, limit) = page_args()
+    # fetch one extra row to find out whether there's a next page
+    payments = get_user_payments(g.user.email, cursor, limit + 1)
+    return utils.stream_template(
+        'payments/list.html',
+        payments=payments,
+        page_size=limit,
+        encode_cursor=encode_cursor,
+        summary=aggregates.user_summary(g.user.authy_id))
+
+
+@bp.route('/list.json', methods=["GET"])
+@login_required
+def list_payments_json():
+    """
+    JSON variant of ``list_payments``. Pass ``next_cursor`` back as
+    ``cursor`` to fetch the next page.
+    """
+    (cursor, limit) = page_args()
+    rows = get_user_payments(g.user.email, cursor, limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+
+    return jsonify({
+        "payments": [{
+            "email": row.email,
+            "id": row.id,
+            "send_to": row.send_to,
+            "amount": row.amount,
+            "status": row.status,
+            "created_at": row.created_at.isoformat()
+        } for row in rows],
+        "next_cursor": next_cursor
+    })
+
+
+@bp.route('/summary.json', methods=["GET"])
+@login_required
+def summary():
+    """
+    The number and total amount of the user's payments in each status,
+    from the precomputed aggregates rather than the payments.
+    """
+    statuses = aggregates.user_summary(g.user.authy_id)
+    return jsonify({
+        "statuses": statuses,
+        "count": sum(s['count'] for s in statuses.values()),
+        "total": sum(s['total'] for s in statuses.values())
+    })
+
+
+EXPORT_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
+
+
+def export_filters():
+    """
+    Reads the ``since``, ``until`` and ``status`` query parameters of
+    an export. Dates are ``YYYY-MM-DD`` or ``YYYY-MM-DDTHH:MM:SS``, in
+    UTC. Aborts with a 400 if any is malformed.
+
+    :returns: dict of ``get_user_payments`` keyword arguments
+    """
+    filters = {}
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        if not value:
+            continue
+        for date_format in EXPORT_DATE_FORMATS:
+            try:
+                filters[name] = datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                pass
+        else:
+            abort(400)
+
+    status = request.args.get('status')
+    if status:
+        if status not in Payment.AUTHY_STATUSES:
+            abort(400)
+        filters['status'] = status
+    return filters
+
+
+@bp.route('/export', methods=["GET"])
+@login_required
+def export_payments():
+    """
+    Downloads all the user's payments, newest first, as CSV or, with
+    ``format=ndjson``, one JSON object per line. Filter with ``since``,
+    ``until`` and ``status``, see ``export_filters``.
+
+    Rows are written out as they are read, so memory use stays flat
+    however many payments there are.
+    """
+    format_name = request.args.get('format', 'csv')
+    if format_name not in export.FORMATS:
+        abort(400)
+    (mimetype, extension, write_chunks) = export.FORMATS[format_name]
+
+    rows = get_user_payments(g.user.email, **export_filters()) \
+        .yield_per(export.CHUNK_ROWS)
+    return Response(
+        stream_with_context(write_chunks(rows)),
+        mimetype=mimetype,
+        headers={'Content-Disposition':
+                 'attachment; filename=payments.{}'.format(extension)})
 
 
 def check_sms_auth(authy_id, payment_id, action, code):
@@ -140,7 +759,9 @@ def check_sms_auth(authy_id, payment_id, action, code):
     Validates an SMS OTP.
     """
     if utils.check_sms_auth(g.user.authy_id, action, code):
-        payment = Payment.query.get(payment_id)
+        payment = Payment.query \
+            .filter_by(id=payment_id, authy_id=authy_id) \
+            .first_or_404()
         update_payment_status(payment, 'approved')
         return redirect(url_for('payments.list_payments'))
     else:
@@ -155,7 +776,9 @@ def sms_auth():
 
     payment_id = request.form['payment_id']
     session['payment_id'] = payment_id
-    payment = Payment.query.get(payment_id)
+    payment = Payment.query \
+        .filter_by(id=payment_id, authy_id=g.user.authy_id) \
+        .first_or_404()
     
     if utils.send_sms_auth(payment):
         return redirect(url_for('auth.verify'))
@@ -0,0 +1,338 @@
+from datetime import datetime
+from payfriend import db
+from sqlalchemy import bindparam, event, inspect, text
+
+
+def configure_engine(app):
+    """
+    Applies per-connection settings to the app's database engine.
+    Must be called inside an app context, before the first query.
+    """
+    engine = db.get_engine(app)
+    if engine.dialect.name != 'sqlite':
+        return
+
+    wal = app.config['SQLITE_WAL']
+    busy_timeout = app.config['SQLITE_BUSY_TIMEOUT']
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA busy_timeout = {:d}'.format(busy_timeout))
+        if wal:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.close()
+
+
+def _index_payment_lookups(conn):
+    """
+    Indexes payments by push_id and authy_id, makes users.authy_id
+    unique so the payments foreign key targets a unique column, and
+    stores payment status as a small integer.
+    """
+    conn.execute(text(
+        'CREATE UNIQUE INDEX ix_users_authy_id ON users (authy_id)'))
+
+    # SQLite can't change a column's type in place, so rebuild the table
+    conn.execute(text('ALTER TABLE payments RENAME TO payments_old'))
+    conn.execute(text(
+        'CREATE TABLE payments ('
+        ' id VARCHAR(128) NOT NULL,'
+        ' authy_id INTEGER,'
+        ' send_to VARCHAR(128),'
+        ' amount INTEGER,'
+        ' push_id VARCHAR(128),'
+        ' status SMALLINT NOT NULL,'
+        ' PRIMARY KEY (id),'
+        ' FOREIGN KEY(authy_id) REFERENCES users (authy_id))'))
+    conn.execute(text(
+        'INSERT INTO payments (id, authy_id, send_to, amount, push_id, status)'
+        ' SELECT id, authy_id, send_to, amount, push_id,'
+        " CASE status WHEN 'approved' THEN 1 WHEN 'denied' THEN 2 ELSE 0 END"
+        ' FROM payments_old'))
+    conn.execute(text('DROP TABLE payments_old'))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX ix_payments_push_id ON payments (push_id)'))
+    conn.execute(text(
+        'CREATE INDEX ix_payments_authy_id_status'
+        ' ON payments (authy_id, status)'))
+
+
+def _add_payment_created_at(conn):
+    """
+    Adds the created_at column used to page through payments.
+    Existing payments get the migration time.
+    """
+    conn.execute(text('ALTER TABLE payments ADD COLUMN created_at DATETIME'))
+    # bound as a DateTime, so it's stored in the format SQLAlchemy
+    # writes on every database and comparisons line up
+    conn.execute(
+        text('UPDATE payments SET created_at = :now')
+        .bindparams(bindparam('now', type_=db.DateTime)),
+        now=datetime.utcnow())
+    conn.execute(text(
+        'CREATE INDEX ix_payments_authy_id_created_at'
+        ' ON payments (authy_id, created_at, id)'))
+
+
+def _widen_password_hash(conn):
+    """
+    Makes room for hashes with longer salts or digests.
+    SQLite doesn't enforce VARCHAR lengths, so only other databases
+    need changing.
+    """
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text(
+            'ALTER TABLE users ALTER COLUMN password_hash TYPE VARCHAR(255)'))
+
+
+def _add_user_phone_parts(conn):
+    """
+    Stores each user's country code and national number alongside
+    their E.164 phone number, so requests don't have to parse it.
+    """
+    import phonenumbers
+    from payfriend.utils import parse_phone_number
+    conn.execute(text('ALTER TABLE users ADD COLUMN country_code INTEGER'))
+    conn.execute(text(
+        'ALTER TABLE users ADD COLUMN national_number VARCHAR(20)'))
+
+    users = conn.execute(text(
+        'SELECT id, phone_number FROM users'
+        ' WHERE phone_number IS NOT NULL')).fetchall()
+    for (user_id, phone_number) in users:
+        try:
+            (country_code, phone) = parse_phone_number(phone_number)
+        except phonenumbers.NumberParseException:
+            # left unset; parsed again whenever it's needed
+            continue
+        conn.execute(
+            text('UPDATE users SET country_code = :country_code,'
+                 ' national_number = :phone WHERE id = :id'),
+            country_code=country_code, phone=phone, id=user_id)
+
+
+def _add_verification_starts(conn):
+    """
+    Adds the table behind the database verification throttle.
+    """
+    conn.execute(text(
+        'CREATE TABLE verification_starts ('
+        ' phone VARCHAR(32) NOT NULL,'
+        ' tokens FLOAT NOT NULL,'
+        ' updated_at FLOAT NOT NULL,'
+        ' last_start FLOAT NOT NULL,'
+        ' PRIMARY KEY (phone))'))
+
+
+def _add_sessions(conn):
+    """
+    Adds the table behind the database session backend.
+    """
+    conn.execute(text(
+        'CREATE TABLE sessions ('
+        ' id VARCHAR(32) NOT NULL,'
+        ' data TEXT NOT NULL,'
+        ' expires_at FLOAT NOT NULL,'
+        ' PRIMARY KEY (id))'))
+
+
+def _add_payment_expires_at(conn):
+    """
+    Adds the expires_at column the expiry sweeper looks for overdue
+    payments by. Existing payments expire when their push request did,
+    20 minutes after they were created.
+    """
+    conn.execute(text('ALTER TABLE payments ADD COLUMN expires_at DATETIME'))
+    if conn.dialect.name == 'sqlite':
+        # datetime() drops the fraction, so add created_at's back to
+        # match the format SQLAlchemy writes and comparisons line up
+        conn.execute(text(
+            "UPDATE payments SET expires_at ="
+            " datetime(created_at, '+1200 seconds')"
+            " || substr(created_at, 20)"))
+    else:
+        conn.execute(text(
+            "UPDATE payments SET expires_at ="
+            " created_at + interval '1200 seconds'"))
+    conn.execute(text(
+        'CREATE INDEX ix_payments_status_expires_at'
+        ' ON payments (status, expires_at)'))
+
+
+def _add_payment_batch_id(conn):
+    """
+    Adds the batch_id column grouping payments sent in bulk.
+    """
+    conn.execute(text('ALTER TABLE payments ADD COLUMN batch_id VARCHAR(36)'))
+    conn.execute(text(
+        'CREATE INDEX ix_payments_batch_id'
+        ' ON payments (batch_id, authy_id, status)'))
+
+
+def _add_payment_aggregates(conn):
+    """
+    Adds per-user payment counts and totals by status, computed from
+    the existing payments.
+    """
+    conn.execute(text(
+        'CREATE TABLE payment_aggregates ('
+        ' authy_id INTEGER NOT NULL,'
+        ' status SMALLINT NOT NULL,'
+        ' payment_count INTEGER NOT NULL,'
+        ' amount_total BIGINT NOT NULL,'
+        ' PRIMARY KEY (authy_id, status))'))
+    conn.execute(text(
+        'INSERT INTO payment_aggregates'
+        ' (authy_id, status, payment_count, amount_total)'
+        ' SELECT authy_id, status, count(*), coalesce(sum(amount), 0)'
+        ' FROM payments WHERE authy_id IS NOT NULL'
+        ' GROUP BY authy_id, status'))
+
+
+def _add_outbox(conn):
+    """
+    Adds the outbox of Authy requests waiting to be sent.
+    """
+    conn.execute(text(
+        'CREATE TABLE outbox ('
+        ' id INTEGER NOT NULL PRIMARY KEY,'
+        ' kind VARCHAR(32) NOT NULL,'
+        ' payload TEXT NOT NULL,'
+        ' priority SMALLINT NOT NULL,'
+        ' attempts INTEGER NOT NULL,'
+        ' available_at FLOAT NOT NULL,'
+        ' claimed_by VARCHAR(32),'
+        ' claimed_until FLOAT,'
+        ' last_error VARCHAR(255))'))
+    conn.execute(text(
+        'CREATE INDEX ix_outbox_priority_id ON outbox (priority, id)'))
+
+
+# (version, migration) pairs, applied in order. Each migration takes a
+# connection inside the upgrade transaction. Append new ones at the end
+# and update the models to match: fresh databases are built from the
+# models and stamped with the latest version.
+MIGRATIONS = (
+    (1, _index_payment_lookups),
+    (2, _add_payment_created_at),
+    (3, _widen_password_hash),
+    (4, _add_user_phone_parts),
+    (5, _add_verification_starts),
+    (6, _add_sessions),
+    (7, _add_payment_expires_at),
+    (8, _add_payment_batch_id),
+    (9, _add_payment_aggregates),
+    (10, _add_outbox),
+)
+
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """
+    Returns the schema version of the database, or ``None`` if it has
+    no tables yet. Databases created before versioning are version 0.
+    """
+    tables = inspect(conn).get_table_names()
+    if 'schema_version' in tables:
+        return conn.execute(
+            text('SELECT version FROM schema_version')).scalar()
+    if 'payments' in tables:
+        return 0
+    return None
+
+
+def upgrade():
+    """
+    Brings the database schema up to date, creating it from the models
+    if it doesn't exist. Must be called inside an app context.
+
+    :returns: tuple (from_version, to_version)
+    """
+    with db.engine.begin() as conn:
+        version = current_version(conn)
+
+        if version is None:
+            db.metadata.create_all(bind=conn)
+            version = HEAD
+            _stamp(conn, None, version)
+            return (None, version)
+
+        start = version
+        for (number, migrate) in MIGRATIONS:
+            if number > version:
+                migrate(conn)
+                _stamp(conn, version, number)
+                version = number
+        return (start, version)
+
+
+def _stamp(conn, old, new):
+    if old is None or old == 0:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_version'
+            ' (version INTEGER NOT NULL)'))
+        conn.execute(text('DELETE FROM schema_version'))
+        conn.execute(
+            text('INSERT INTO schema_version (version) VALUES (:version)'),
+            version=new)
+    else:
+        conn.execute(
+            text('UPDATE schema_version SET version = :version'),
+            version=new)
+
+
+def _query_plan_checks():
+    """
+    The hot-path queries whose plans ``check_query_plans`` guards,
+    as (description, statement, index expected in the plan) tuples.
+    """
+    from payfriend.models import Payment
+    from payfriend.payment import (
+        batch_summary, get_user_payments, overdue_payments)
+    return (
+        ('payment by push_id',
+         Payment.query.filter_by(push_id='').statement,
+         'ix_payments_push_id'),
+        ('payments for user',
+         get_user_payments('', limit=50).statement,
+         'ix_payments_authy_id_created_at'),
+        ('next page of payments for user',
+         get_user_payments('', (datetime.utcnow(), ''), 50).statement,
+         'ix_payments_authy_id_created_at'),
+        ('overdue pending payments',
+         overdue_payments(datetime.utcnow(), 500).statement,
+         'ix_payments_status_expires_at'),
+        ('status counts for a batch',
+         batch_summary('', 0).statement,
+         'ix_payments_batch_id'),
+    )
+
+
+def check_query_plans():
+    """
+    Runs ``EXPLAIN QUERY PLAN`` on the hot-path payment queries and
+    reports any that no longer use their index. SQLite only.
+
+    :returns: list of problem descriptions, empty if all plans are fine
+    """
+    problems = []
+    with db.engine.connect() as conn:
+        for (name, statement, index) in _query_plan_checks():
+            compiled = statement.compile(
+                dialect=conn.dialect,
+                compile_kwargs={'literal_binds': True})
+            rows = conn.execute('EXPLAIN QUERY PLAN {}'.format(compiled))
+            plan = [row[-1] for row in rows]
+            if not any(index in step for step in plan):
+                problems.append('{}: expected {} in plan {}'.format(
+                    name, index, plan))
+            for step in plan:
+                if step.startswith('SCAN') and 'payments' in step \
+                        and 'INDEX' not in step:
+                    problems.append('{}: full scan {!r}'.format(name, step))
+                if 'TEMP B-TREE' in step:
+                    problems.append('{}: sorts rows {!r}'.format(name, step))
+    return problems
@@ -0,0 +1,248 @@
+import secrets
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from payfriend.cache import LRUCache
+
+
+class ServerSession(SessionMixin):
+    """
+    A session whose data is kept on the server, under the opaque ID
+    stored in the session cookie.
+
+    Nothing is loaded from the store until the session is first read
+    or written, so requests that never look at it cost nothing.
+    """
+    def __init__(self, load, sid=None):
+        self._load = load
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        # set by clear(): the session is saved under a new ID, so an ID
+        # handed out before logging in stops working after it
+        self.rotate = False
+        self._data = None
+
+    @property
+    def data(self):
+        self.accessed = True
+        if self._data is None:
+            data = None
+            if self.sid is not None:
+                data = self._load(self.sid)
+            if data is None:
+                # unknown or expired: never save under an ID the
+                # client picked
+                self.sid = None
+                self.new = True
+                data = {}
+            self._data = data
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.accessed = True
+        self._data = {}
+        self.modified = True
+        self.rotate = True
+
+    def __repr__(self):
+        return '<ServerSession %r>' % self.sid
+
+
+class MemorySessionStore:
+    """
+    Keeps sessions in this process, evicting the least recently used
+    beyond ``maxsize``. Sessions are lost on restart and not shared
+    between worker processes, so this is meant for tests and single
+    process deployments.
+    """
+    def __init__(self, lifetime, maxsize=10000):
+        self._sessions = LRUCache(maxsize=maxsize, ttl=lifetime)
+
+    def load(self, sid):
+        return self._sessions.get(sid)
+
+    def save(self, sid, data, new):
+        self._sessions.set(sid, data)
+
+    def delete(self, sid):
+        self._sessions.delete(sid)
+
+
+class DatabaseSessionStore:
+    """
+    Keeps sessions in the ``sessions`` table, shared by every process
+    using the database. Expired rows are purged every ``PURGE_EVERY``
+    new sessions.
+    """
+    PURGE_EVERY = 1000
+
+    def __init__(self, lifetime, maxsize=None):
+        self.lifetime = lifetime
+        self._inserts = 0
+
+    @property
+    def table(self):
+        from payfriend.models import SessionRecord
+        return SessionRecord.__table__
+
+    def load(self, sid):
+        from payfriend import db
+        table = self.table
+        return db.engine.execute(
+            table.select()
+                .with_only_columns([table.c.data])
+                .where(table.c.id == sid)
+                .where(table.c.expires_at > time.time())).scalar()
+
+    def save(self, sid, data, new):
+        from payfriend import db
+        table = self.table
+        expires_at = time.time() + self.lifetime
+        with db.engine.begin() as conn:
+            if not new:
+                result = conn.execute(
+                    table.update()
+                        .where(table.c.id == sid)
+                        .values(data=data, expires_at=expires_at))
+                if result.rowcount == 1:
+                    return
+            conn.execute(table.insert().values(
+                id=sid, data=data, expires_at=expires_at))
+
+        self._inserts += 1
+        if self._inserts % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, sid):
+        from payfriend import db
+        table = self.table
+        db.engine.execute(table.delete().where(table.c.id == sid))
+
+    def purge(self):
+        """
+        Deletes expired sessions.
+
+        :returns: the number deleted
+        """
+        from payfriend import db
+        table = self.table
+        return db.engine.execute(
+            table.delete().where(table.c.expires_at <= time.time())).rowcount
+
+
+STORES = {
+    'memory': MemorySessionStore,
+    'database': DatabaseSessionStore,
+}
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Stores sessions server side, with only a random ID in the cookie.
+
+    Unlike the signed cookie session, nothing is signed or re-sent on
+    each response: a session is written, and its cookie set, only when
+    it's modified. Sessions expire ``PERMANENT_SESSION_LIFETIME`` after
+    they were last written.
+
+    :param store: where sessions are kept, see ``STORES``
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name) or None
+        return ServerSession(self._load, sid)
+
+    def _load(self, sid):
+        data = self.store.load(sid)
+        if data is None:
+            return None
+        try:
+            return self.serializer.loads(data)
+        except ValueError:
+            return None
+
+    def save_session(self, app, session, response):
+        if not session.modified:
+            if session.accessed:
+                response.vary.add('Cookie')
+            return
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        old_sid = session.sid
+        if old_sid is not None and (session.rotate or not session):
+            self.store.delete(old_sid)
+            session.sid = None
+
+        if not session:
+            if old_sid is not None:
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        response.vary.add('Cookie')
+        new = session.sid is None
+        if new:
+            session.sid = secrets.token_urlsafe(16)
+        # stored as JSON text, so sessions loaded by two requests at
+        # once never share mutable values
+        self.store.save(session.sid, self.serializer.dumps(dict(session)),
+                        new)
+
+        # the cookie only changes with the ID, or to push back the
+        # expiry of a permanent session
+        if session.sid != old_sid or session.permanent:
+            response.set_cookie(
+                app.session_cookie_name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+
+
+class Sessions:
+    """
+    Replaces the app's signed cookie sessions with server-side ones,
+    unless ``SESSION_BACKEND`` is 'cookie'.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['SESSION_BACKEND']
+        if backend == 'cookie':
+            return
+        store = STORES[backend](
+            app.permanent_session_lifetime.total_seconds(),
+            maxsize=app.config['SESSION_CACHE_SIZE'])
+        app.session_interface = ServerSessionInterface(store)
+
+
+sessions = Sessions()
@@ -20,18 +20,43 @@ $(document).ready(function() {
     });
   };
 
+  // the server holds this request open until the status changes,
+  // so re-issue it straight away while the payment is still pending
   var checkForOneTouch = function(payment_id) {
+    $.get("/payments/status/wait?payment_id=" + payment_id, function(data) {
+      handleOneTouchStatus(data, function() {
+        checkForOneTouch(payment_id);
+      });
+    }).fail(function() {
+      setTimeout(function() {
+        pollForOneTouch(payment_id);
+      }, 3000);
+    });
+  };
+
+  // plain polling fallback if the long-poll endpoint is unavailable
+  var pollForOneTouch = function(payment_id) {
     $.get("/payments/status?payment_id=" + payment_id, function(data) {
-      if (data == "approved") {
-        redirectWithMessage('/payments/', 'Your payment has been approved!')
-      } else if (data == "denied") {
-        redirectWithMessage('/payments/send', 'Your payment request has been denied.');
-      } else {
-        setTimeout(checkForOneTouch(payment_id), 3000);
-      }
+      handleOneTouchStatus(data, function() {
+        setTimeout(function() {
+          pollForOneTouch(payment_id);
+        }, 3000);
+      });
     });
   };
 
+  var handleOneTouchStatus = function(data, retry) {
+    if (data == "approved") {
+      redirectWithMessage('/payments/', 'Your payment has been approved!')
+    } else if (data == "denied") {
+      redirectWithMessage('/payments/send', 'Your payment request has been denied.');
+    } else if (data == "expired") {
+      redirectWithMessage('/payments/send', 'Your payment request has expired.');
+    } else {
+      retry();
+    }
+  };
+
   var redirectWithMessage = function(location, message) {
     var form = $("#redirect_to");
     $("#flash_message").val(message);
@@ -0,0 +1,131 @@
+import threading
+import time
+from flask import current_app
+from payfriend.cache import LRUCache
+
+
+class MemoryThrottleStore:
+    """
+    Keeps throttle state in this process. Each worker process throttles
+    on its own, so with N workers a phone can get up to N codes.
+    """
+    def __init__(self, maxsize=10000):
+        self._state = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def update(self, key, decide):
+        with self._lock:
+            (allowed, state) = decide(self._state.get(key))
+            if allowed:
+                self._state.set(key, state)
+            return allowed
+
+
+class DatabaseThrottleStore:
+    """
+    Keeps throttle state in the ``verification_starts`` table, shared
+    by every process using the database.
+
+    Each update is a compare-and-set on the row's ``updated_at``, so of
+    two processes starting a verification at once only one succeeds.
+    """
+    def update(self, key, decide):
+        from sqlalchemy.exc import IntegrityError
+        from payfriend import db
+        from payfriend.models import VerificationStart
+
+        table = VerificationStart.__table__
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                table.select().where(table.c.phone == key)).first()
+            state = None
+            if row is not None:
+                state = (row.tokens, row.updated_at, row.last_start)
+            (allowed, new_state) = decide(state)
+            if not allowed:
+                return False
+
+            (tokens, updated_at, last_start) = new_state
+            values = dict(tokens=tokens, updated_at=updated_at,
+                          last_start=last_start)
+            if row is None:
+                try:
+                    conn.execute(table.insert().values(phone=key, **values))
+                except IntegrityError:
+                    return False
+                return True
+            result = conn.execute(
+                table.update()
+                    .where(table.c.phone == key)
+                    .where(table.c.updated_at == row.updated_at)
+                    .values(**values))
+            return result.rowcount == 1
+
+
+STORES = {
+    'memory': MemoryThrottleStore,
+    'database': DatabaseThrottleStore,
+}
+
+
+class VerificationThrottle:
+    """
+    Decides whether to send a phone another verification code.
+
+    A code is not sent if one went to the same phone less than
+    ``window`` seconds ago, while the last one is still valid. Beyond
+    that, each phone has a token bucket holding up to ``burst`` sends,
+    refilled at ``per_hour`` sends an hour.
+
+    :param store: where the per-phone state is kept, see ``STORES``
+    """
+    def __init__(self, store, window=600, burst=3, per_hour=4):
+        self.store = store
+        self.window = window
+        self.burst = burst
+        self.rate = per_hour / 3600.0
+
+    def allow(self, phone, now=None):
+        """
+        Records a verification start for ``phone`` if one is allowed.
+
+        :returns: True if a code should be sent
+        """
+        if now is None:
+            now = time.time()
+
+        def decide(state):
+            if state is None:
+                return (True, (self.burst - 1, now, now))
+            (tokens, updated_at, last_start) = state
+            if now - last_start < self.window:
+                return (False, state)
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens < 1:
+                return (False, state)
+            return (True, (tokens - 1, now, now))
+
+        return self.store.update(phone, decide)
+
+
+class Throttle:
+    """
+    Gives each app its ``VerificationThrottle``.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        store = STORES[app.config['VERIFICATION_THROTTLE_BACKEND']]()
+        app.extensions['verification_throttle'] = VerificationThrottle(
+            store,
+            window=app.config['VERIFICATION_DEDUP_WINDOW'],
+            burst=app.config['VERIFICATION_BURST'],
+            per_hour=app.config['VERIFICATION_PER_HOUR'])
+
+    def allow(self, phone):
+        return current_app.extensions['verification_throttle'].allow(phone)
+
+
+throttle = Throttle()
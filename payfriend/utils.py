@@ -1,9 +1,14 @@
-import phonenumbers
-from authy.api import AuthyApiClient
+from functools import lru_cache
 from flask import current_app as app
-from flask import flash, g, request, session
+from flask import Response, flash, g, request, session, stream_with_context
+from payfriend import dispatch
+from payfriend.clients import authy_clients
+from payfriend.metrics import metrics
+from payfriend.outbox import enqueue
+from payfriend.throttle import throttle
 
 
+@lru_cache(maxsize=1024)
 def parse_phone_number(full_phone):
     """
     Parses the phone number from E.164 format
@@ -11,35 +16,90 @@ def parse_phone_number(full_phone):
     :param full_phone: phone number in E.164 format
     :returns: tuple (country_code, phone)
     """
+    # phonenumbers is slow to import, so only load it when needed
+    import phonenumbers
     pn = phonenumbers.parse(full_phone)
-    return (pn.country_code, pn.national_number)
+    return (pn.country_code, str(pn.national_number))
+
+
+def user_phone(user):
+    """
+    Returns a user's phone number split up for the Authy API, as
+    stored at registration.
+
+    :param user: ``User`` or ``UserSnapshot``
+    :returns: tuple (country_code, phone)
+    """
+    if user.country_code is None:
+        return parse_phone_number(user.phone_number)
+    return (user.country_code, user.national_number)
+
+
+def stream_template(template_name, **context):
+    """
+    Like ``render_template``, but sends the page to the client as it
+    renders instead of building it in memory first.
+    """
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    return Response(stream_with_context(stream))
 
 
 def get_authy_client():
-    return AuthyApiClient(app.config['AUTHY_API_KEY'])
+    """
+    Returns the app's shared, connection-pooled Authy client.
+    """
+    return authy_clients.get()
 
 
 def start_verification(country_code, phone, channel='sms'):
     """
     Sends a verification code to the user's phone number 
-    via the specified channel
+    via the specified channel. The Authy request is queued in the
+    outbox in the session's transaction: the caller commits, then
+    calls ``outbox.notify()``, and the code is sent by the outbox
+    worker.
+
+    Nothing is sent if the phone was sent a code recently, see
+    ``VerificationThrottle``.
 
     :param country_code: country code for the phone number
     :param phone: national format phone number
     :param channel: either 'sms' or 'call'
+    :returns: True if the code was queued, False if throttled
+    """
+    if not throttle.allow('+{}{}'.format(country_code, phone)):
+        flash("We sent you a verification code recently. "
+              "Please enter it below.")
+        return False
+
+    enqueue('start_verification', {
+        'country_code': country_code,
+        'phone': phone,
+        'channel': channel,
+    })
+    flash("Sending a verification code via {}.".format(channel))
+    return True
+
+
+@metrics.timed('authy_call_seconds')
+def request_verification(country_code, phone, channel):
+    """
+    Outbox handler for ``start_verification``. Authy rejecting the
+    request is logged rather than retried, as it would only reject it
+    again.
     """
     api = get_authy_client()
-    try: 
-        verification = api.phones.verification_start(
-            phone, country_code, via=channel)
-        if verification.ok():
-            flash(verification.content['message'])
-        else:
-            flash(verification.errors()['message'])
-    except Exception as e:
-        flash("Error sending code: {}".format(e))
+    verification = api.phones.verification_start(
+        phone, country_code, via=channel)
+    if not verification.ok():
+        app.logger.warning('Error sending code: %s', verification.errors())
+    return verification
 
 
+@metrics.timed('authy_call_seconds')
 def check_verification(country_code, phone, code):
     """
     Validates a verification code
@@ -50,8 +110,8 @@ def check_verification(country_code, phone, code):
     """
     api = get_authy_client()
     try:
-        verification = api.phones.verification_check(
-            phone, country_code, code)
+        verification = dispatch.call(
+            api.phones.verification_check, phone, country_code, code)
         if verification.ok():
             flash(verification.content['message'])
             return True
@@ -63,6 +123,7 @@ def check_verification(country_code, phone, code):
     return False
 
 
+@metrics.timed('authy_call_seconds')
 def create_authy_user(email, country_code, phone):
     """
     Creates a user with the Authy API
@@ -74,7 +135,12 @@ def create_authy_user(email, country_code, phone):
     :returns: the generated Authy ID
     """
     api = get_authy_client()
-    authy_user = api.users.create(email, phone, country_code)
+    try:
+        authy_user = dispatch.call(api.users.create, email, phone, country_code)
+    except Exception as e:
+        flash("Error creating Authy user: {}".format(e))
+        return None
+
     if authy_user.ok():
         return authy_user.id
     else:
@@ -82,6 +148,7 @@ def create_authy_user(email, country_code, phone):
         return None
 
 
+@metrics.timed('authy_call_seconds')
 def send_sms_auth(payment):
     """
     Sends an SMS one time password (OTP) to the user's phone_number
@@ -100,7 +167,12 @@ def send_sms_auth(payment):
             payment.send_to,
             payment.amount)
     }
-    resp = api.users.request_sms(payment.authy_id, options)
+    try:
+        resp = dispatch.call(api.users.request_sms, payment.authy_id, options)
+    except Exception as e:
+        flash("Error sending SMS: {}".format(e))
+        return False
+
     if resp.ok():
         flash(resp.content['message'])
         return True
@@ -109,6 +181,7 @@ def send_sms_auth(payment):
         return False
 
 
+@metrics.timed('authy_call_seconds')
 def check_sms_auth(authy_id, action, code):
     """
     Validates an one time password (OTP)
@@ -119,7 +192,7 @@ def check_sms_auth(authy_id, action, code):
             'force': True,
             'action': action,
         }
-        resp = api.tokens.verify(authy_id, code, options)
+        resp = dispatch.call(api.tokens.verify, authy_id, code, options)
         if resp.ok():
             return True
         else:
@@ -130,30 +203,56 @@ def check_sms_auth(authy_id, action, code):
     return False
 
 
-def send_push_auth(authy_id_str, send_to, amount):
+def push_hidden_details():
+    """
+    Collects the request details attached to a push authorization.
+    Must be called from the request thread.
     """
-    Sends a push authorization with payment details to the user's Authy app
+    return {
+        "user_ip_address": request.environ.get('REMOTE_ADDR', request.remote_addr),
+        "requester_user_id": str(g.user.id)
+    }
 
-    :returns (push_id, errors): tuple of push_id (if successful)
-                                and errors dict (if unsuccessful)
+
+PUSH_SECONDS_TO_EXPIRE = 1200
+PUSH_LOGOS = [dict(res = 'default', url = 'https://emojipedia-us.s3.dualstack.us-west-1.amazonaws.com/thumbs/120/apple/155/money-bag_1f4b0.png')]
+# Authy truncates longer strings in push requests
+PUSH_MAX_STRING = 200
+
+
+def push_request(send_to, amount):
+    """
+    Builds the parts of a payment's push authorization shown in the
+    Authy app.
+
+    :returns: tuple (message, details, logos)
     """
+    message = "Please authorize payment to {}".format(send_to)
     details = {
         "Sending to": send_to,
         "Transaction amount": str('${:,.2f}'.format(amount))
     }
+    details = {k: v[:PUSH_MAX_STRING] for (k, v) in details.items()}
+    return (message[:PUSH_MAX_STRING], details, PUSH_LOGOS)
 
-    hidden_details = {
-        "user_ip_address": request.environ.get('REMOTE_ADDR', request.remote_addr),
-        "requester_user_id": str(g.user.id)
-    }
 
-    logos = [dict(res = 'default', url = 'https://emojipedia-us.s3.dualstack.us-west-1.amazonaws.com/thumbs/120/apple/155/money-bag_1f4b0.png')]
+@metrics.timed('authy_call_seconds')
+def send_push_auth(authy_id_str, send_to, amount, hidden_details):
+    """
+    Sends a push authorization with payment details to the user's Authy app.
+    Safe to call from an outbox handler.
+
+    :param hidden_details: see ``push_hidden_details``
+    :returns (push_id, errors): tuple of push_id (if successful)
+                                and errors dict (if unsuccessful)
+    """
+    (message, details, logos) = push_request(send_to, amount)
 
     api = get_authy_client()
     resp = api.one_touch.send_request(
         user_id=int(authy_id_str),
-        message="Please authorize payment to {}".format(send_to),
-        seconds_to_expire=1200,
+        message=message,
+        seconds_to_expire=PUSH_SECONDS_TO_EXPIRE,
         details=details,
         hidden_details=hidden_details,
         logos=logos
@@ -163,5 +262,4 @@ def send_push_auth(authy_id_str, send_to, amount):
         push_id = resp.content['approval_request']['uuid']
         return (push_id, {})
     else:
-        flash(resp.errors()['message'])
         return (None, resp.errors())
\ No newline at end of file
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+# before the app is imported, so TestingConfig is used
+os.environ['FLASK_ENV'] = 'testing'
+
+from payfriend import create_app, db
+from payfriend.models import User
+
+
+@pytest.fixture
+def config():
+    """Settings for the app under test; override to change them."""
+    return {}
+
+
+@pytest.fixture
+def app(config):
+    """
+    An app on a fresh in-memory database, upgraded to the latest
+    schema, with an app context pushed for the test.
+    """
+    app = create_app(config)
+    with app.app_context():
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def user(app):
+    """A registered user with an Authy ID."""
+    user = User('user@example.com', 'password', '+15105550100', 1,
+                '5105550100')
+    user.authy_id = 1234
+    db.session.add(user)
+    db.session.commit()
+    return user
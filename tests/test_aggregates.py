@@ -0,0 +1,32 @@
+from payfriend import aggregates, db
+from payfriend.models import Payment
+from payfriend.payment import change_statuses, create_payment
+
+
+def test_new_payments_count_as_pending(app, user):
+    create_payment(user.authy_id, 'friend@example.com', 10)
+    create_payment(user.authy_id, 'friend@example.com', 15)
+
+    summary = aggregates.user_summary(user.authy_id)
+    assert summary['pending'] == {'count': 2, 'total': 25}
+
+
+def test_status_changes_move_the_aggregates(app, user):
+    payment = create_payment(user.authy_id, 'friend@example.com', 25)
+    change_statuses(Payment.__table__.c.id, {payment.id: 'denied'})
+    db.session.commit()
+
+    summary = aggregates.user_summary(user.authy_id)
+    assert summary['pending'] == {'count': 0, 'total': 0}
+    assert summary['denied'] == {'count': 1, 'total': 25}
+
+
+def test_rebuild_matches_the_payments(app, user):
+    payment = create_payment(user.authy_id, 'friend@example.com', 25)
+    create_payment(user.authy_id, 'friend@example.com', 5)
+    change_statuses(Payment.__table__.c.id, {payment.id: 'approved'})
+    db.session.commit()
+    before = aggregates.user_summary(user.authy_id)
+
+    aggregates.rebuild()
+    assert aggregates.user_summary(user.authy_id) == before
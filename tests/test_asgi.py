@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+import pytest
+
+from payfriend.asgi import AsyncPayments, WSGIBridge
+from payfriend.models import OutboxMessage, Payment
+from payfriend.utils import get_authy_client
+
+
+def call(asgi, method, path, body=b'', headers=()):
+    """
+    Runs one request through ``asgi``.
+
+    :returns: (status, body)
+    """
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                    for (name, value) in headers],
+        'client': ('127.0.0.1', 1234),
+        'server': ('localhost', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi(scope, receive, send))
+    status = messages[0]['status']
+    return (status, b''.join(m.get('body', b'') for m in messages[1:]))
+
+
+@pytest.fixture
+def cookie(app, user):
+    """The session cookie of the logged in ``user``."""
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'user@example.com',
+                                     'password': 'password'})
+    cookie = next(c for c in client.cookie_jar
+                  if c.name == app.session_cookie_name)
+    return '{}={}'.format(cookie.name, cookie.value)
+
+
+def test_send_queues_the_push_in_the_outbox(app, cookie):
+    fake = get_authy_client()
+    (status, body) = call(
+        AsyncPayments(app), 'POST', '/payments/send',
+        b'send_to=friend%40example.com&amount=10',
+        [('cookie', cookie),
+         ('content-type', 'application/x-www-form-urlencoded')])
+
+    assert status == 200
+    assert b'"success": true' in body
+    assert [m.kind for m in OutboxMessage.query] == ['push_auth']
+    assert not [c for c in fake.calls if c[0] == 'one_touch.send_request']
+
+    app.extensions['outbox_worker'].drain()
+    assert Payment.query.one().push_id
+    assert [c for c in fake.calls if c[0] == 'one_touch.send_request']
+
+
+def test_bridge_produces_only_as_fast_as_the_client_reads(app):
+    produced = []
+    reading = threading.Event()
+
+    @app.route('/stream')
+    def stream():
+        def chunks():
+            for i in range(WSGIBridge.BUFFER * 4):
+                produced.append(i)
+                yield 'x'
+        return app.response_class(chunks())
+
+    bridge = WSGIBridge(app, 1)
+    ahead = []
+
+    async def send(message):
+        if message['type'] == 'http.response.body' and not reading.is_set():
+            # a slow client: let the Flask thread run ahead, then look
+            await asyncio.sleep(0.2)
+            ahead.append(len(produced))
+            reading.set()
+
+    class Request:
+        method = 'GET'
+        path = '/stream'
+        body = b''
+        headers = {}
+        scope = {'query_string': b''}
+
+    asyncio.run(bridge(Request(), send))
+    assert ahead[0] <= WSGIBridge.BUFFER + 2
+    assert len(produced) == WSGIBridge.BUFFER * 4
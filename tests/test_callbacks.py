@@ -0,0 +1,77 @@
+import pytest
+
+from payfriend import db, payment
+from payfriend.callbacks import CallbackBatcher, CallbackQueueFull, callbacks
+from payfriend.models import Payment
+
+
+@pytest.fixture
+def batcher(app, monkeypatch):
+    """
+    The app's callback batcher, applied only by ``callbacks.flush``:
+    the in-memory database can't be shared with its thread.
+    """
+    batcher = app.extensions['callback_batcher']
+    monkeypatch.setattr(batcher, '_ensure_started', lambda: None)
+    return batcher
+
+
+@pytest.fixture
+def pending(user):
+    """The ID of a pending payment with push_id 'push-1'."""
+    pending = payment.create_payment(user.authy_id, 'friend@example.com', 10)
+    pending.push_id = 'push-1'
+    db.session.commit()
+    return pending.id
+
+
+def status(payment_id):
+    return db.session.query(Payment.status) \
+        .filter(Payment.id == payment_id).scalar()
+
+
+def test_duplicate_deliveries_are_dropped(batcher, pending):
+    assert batcher.submit('push-1', 'approved')
+    assert not batcher.submit('push-1', 'approved')
+
+    callbacks.flush()
+    assert status(pending) == 'approved'
+
+
+def test_first_delivery_wins(batcher, pending):
+    batcher.submit('push-1', 'approved')
+    batcher.submit('push-1', 'denied')
+
+    callbacks.flush()
+    assert status(pending) == 'approved'
+
+
+def test_failed_batches_are_retried(batcher, pending, monkeypatch):
+    retries = []
+    monkeypatch.setattr(batcher, '_retry',
+                        lambda *item: retries.append(item))
+
+    def locked(updates):
+        raise Exception('database is locked')
+
+    monkeypatch.setattr(payment, 'apply_push_statuses', locked)
+    batcher.submit('push-1', 'approved')
+    callbacks.flush()
+
+    assert retries == [('push-1', 'approved', 1)]
+    assert status(pending) == 'pending'
+    # forgotten, so Authy's redelivery isn't dropped as a duplicate
+    assert batcher.submit('push-1', 'approved')
+
+
+def test_full_queue_lets_the_redelivery_through(app, monkeypatch):
+    batcher = CallbackBatcher(app, batch_size=10, flush_interval=0,
+                              queue_size=1, dedup_size=10)
+    monkeypatch.setattr(batcher, '_ensure_started', lambda: None)
+    batcher.submit('push-1', 'approved')
+
+    with pytest.raises(CallbackQueueFull):
+        batcher.submit('push-2', 'approved')
+    # not remembered, so Authy's retry is queued once there's room
+    batcher._take(block=False)
+    assert batcher.submit('push-2', 'approved')
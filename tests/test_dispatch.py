@@ -0,0 +1,51 @@
+import pytest
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from payfriend import dispatch
+
+
+@pytest.fixture
+def config():
+    return {'AUTHY_RETRIES': 2, 'AUTHY_RETRY_BACKOFF': 0,
+            'AUTHY_TIMEOUT': 10}
+
+
+def failing(*errors):
+    """A call that raises ``errors`` in turn, then succeeds."""
+    calls = []
+
+    def fn():
+        calls.append(True)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return (fn, calls)
+
+
+def test_connection_errors_are_retried(app):
+    (fn, calls) = failing(ConnectionError(), ConnectionError())
+    assert dispatch.call(fn) == 'ok'
+    assert len(calls) == 3
+
+
+def test_retries_are_limited(app):
+    (fn, calls) = failing(*[ConnectionError()] * 3)
+    with pytest.raises(ConnectionError):
+        dispatch.call(fn)
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('error', [ReadTimeout(), ValueError()])
+def test_requests_that_may_have_been_sent_arent_retried(app, error):
+    (fn, calls) = failing(error)
+    with pytest.raises(type(error)):
+        dispatch.call(fn)
+    assert len(calls) == 1
+
+
+def test_no_retry_starts_after_the_timeout(app):
+    app.config.update(AUTHY_RETRY_BACKOFF=5, AUTHY_TIMEOUT=1)
+    (fn, calls) = failing(ConnectionError())
+    with pytest.raises(ConnectionError):
+        dispatch.call(fn)
+    assert len(calls) == 1
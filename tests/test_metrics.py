@@ -0,0 +1,48 @@
+import pytest
+
+from payfriend import create_app
+from payfriend.metrics import SamplingProfiler, metrics
+
+
+@pytest.fixture
+def config():
+    return {'METRICS_ENABLED': True, 'METRICS_TOKEN': 'secret'}
+
+
+def get(app, path, token=None):
+    headers = {}
+    if token is not None:
+        headers['Authorization'] = 'Bearer ' + token
+    return app.test_client().get(path, headers=headers)
+
+
+def test_metrics_need_the_token(app):
+    assert get(app, '/metrics').status_code == 401
+    assert get(app, '/metrics', 'wrong').status_code == 401
+    assert get(app, '/metrics', 'sécret').status_code == 401
+
+
+def test_requests_are_timed(app):
+    get(app, '/auth/login')
+    response = get(app, '/metrics', 'secret')
+    assert response.status_code == 200
+    assert b'request_seconds_count{endpoint="auth.login"} 1' in response.data
+
+
+def test_no_endpoints_without_a_token():
+    app = create_app({'METRICS_ENABLED': True})
+    assert get(app, '/metrics').status_code == 404
+
+
+def test_each_app_has_its_own_metrics(app):
+    other = create_app()
+    with other.app_context():
+        assert not metrics.enabled
+    assert metrics.enabled
+
+
+def test_profiler_stops():
+    profiler = SamplingProfiler(0.001)
+    profiler.start()
+    profiler.stop()
+    assert not profiler._thread.is_alive()
@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from payfriend.onetouch import (
+    DUPLICATE,
+    INVALID,
+    VALID,
+    OneTouchVerifier
+)
+
+API_KEY = 'test-api-key'
+URL = 'https://payfriend.example.com/payments/callback'
+PARAMS = {
+    'uuid': 'push-1',
+    'status': 'approved',
+    'approval_request': {
+        'transaction': {
+            'details': {'Amount': '10', 'To': 'friend@example.com'},
+            'hidden_details': {'requester_user_id': '1'},
+            'message': 'Request to send money',
+        },
+        'logos': None,
+    },
+    'signature': 'abc/def ghi',
+}
+
+
+@pytest.fixture
+def verifier():
+    return OneTouchVerifier(API_KEY, max_age=300)
+
+
+def signed(verifier, nonce=None, params=PARAMS):
+    nonce = nonce or str(time.time())
+    return (verifier.sign(nonce, 'POST', URL, params), nonce)
+
+
+def test_signature_matches_the_authy_library(verifier):
+    from authy.api import AuthyApiClient
+    (signature, nonce) = signed(verifier)
+    assert AuthyApiClient(API_KEY).one_touch.validate_one_touch_signature(
+        signature, nonce, 'POST', URL, PARAMS)
+
+
+def test_valid_signature(verifier):
+    (signature, nonce) = signed(verifier)
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == VALID
+
+
+def test_changed_params_are_rejected(verifier):
+    (signature, nonce) = signed(verifier)
+    params = dict(PARAMS, status='denied')
+    assert verifier.check(signature, nonce, 'POST', URL, params) == INVALID
+
+
+@pytest.mark.parametrize('signature', ['', 'not-base64', 'signé',
+                                       '☃' * 44])
+def test_bad_signatures_are_rejected(verifier, signature):
+    nonce = str(time.time())
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == INVALID
+
+
+@pytest.mark.parametrize('age', [301, -301])
+def test_nonces_outside_the_window_are_rejected(verifier, age):
+    (signature, nonce) = signed(verifier, str(time.time() - age))
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == INVALID
+
+
+@pytest.mark.parametrize('nonce', ['yesterday', 'nan', 'inf'])
+def test_nonces_that_arent_times_are_rejected(verifier, nonce):
+    (signature, nonce) = signed(verifier, nonce)
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == INVALID
+
+
+def test_repeats_are_duplicates(verifier):
+    (signature, nonce) = signed(verifier)
+    verifier.check(signature, nonce, 'POST', URL, PARAMS)
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == DUPLICATE
+
+
+def test_rejected_callbacks_arent_remembered(verifier):
+    (signature, nonce) = signed(verifier, str(time.time() - 301))
+    verifier.check(signature, nonce, 'POST', URL, PARAMS)
+    assert verifier.check(signature, nonce, 'POST', URL, PARAMS) == INVALID
+
+
+def test_without_an_api_key_everything_is_rejected():
+    (signature, nonce) = signed(OneTouchVerifier(API_KEY))
+    assert OneTouchVerifier(None).check(
+        signature, nonce, 'POST', URL, PARAMS) == INVALID
+
+
+class TestCallbackView:
+    @pytest.fixture
+    def config(self):
+        return {'AUTHY_BACKEND': 'authy', 'AUTHY_API_KEY': API_KEY,
+                'ONETOUCH_CALLBACK_URL': URL}
+
+    def post(self, app, signature, nonce):
+        return app.test_client().post('/payments/callback', json=PARAMS,
+                                      headers={
+                                          'X-Authy-Signature': signature,
+                                          'X-Authy-Signature-Nonce': nonce,
+                                      })
+
+    def test_valid_callback_is_accepted(self, app):
+        verifier = app.extensions['onetouch_verifier']
+        (signature, nonce) = signed(verifier)
+        assert self.post(app, signature, nonce).status_code == 200
+
+    def test_forged_callback_is_a_bad_request(self, app):
+        nonce = str(time.time())
+        assert self.post(app, 'forged', nonce).status_code == 400
+
+    def test_non_ascii_signature_is_a_bad_request(self, app):
+        nonce = str(time.time())
+        assert self.post(app, 'signé', nonce).status_code == 400
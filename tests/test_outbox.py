@@ -0,0 +1,132 @@
+import time
+
+import pytest
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from payfriend import db, outbox, payment, utils
+from payfriend.models import OutboxMessage, Payment
+from payfriend.outbox import OutboxWorker, enqueue
+
+ERRORS = {
+    'connect': ConnectionError('Authy is down'),
+    'timeout': ReadTimeout('Authy is slow'),
+}
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Replaces the outbox handlers with a 'test' kind, which records its
+    payloads and raises the error in ``ERRORS`` its payload names.
+    """
+    calls = {'send': [], 'give_up': []}
+
+    def send(fail=None, **payload):
+        calls['send'].append(payload)
+        if fail:
+            raise ERRORS[fail]
+
+    def give_up(fail=None, **payload):
+        calls['give_up'].append(payload)
+
+    monkeypatch.setattr(outbox, 'handlers', lambda: {'test': (send, give_up)})
+    return calls
+
+
+def worker(app, **kwargs):
+    settings = dict(batch_size=10, concurrency=1, poll_interval=0,
+                    lease=60, max_attempts=3, backoff=0)
+    settings.update(kwargs)
+    return OutboxWorker(app, **settings)
+
+
+def add(kind='test', **payload):
+    enqueue(kind, payload)
+    db.session.commit()
+
+
+def test_sent_messages_are_deleted(app, sent):
+    add(n=1)
+    add(n=2)
+
+    assert worker(app).drain() == 2
+    assert sent['send'] == [{'n': 1}, {'n': 2}]
+    assert OutboxMessage.query.count() == 0
+
+
+def test_claimed_messages_arent_claimed_again(app):
+    add(n=1)
+    first = worker(app)
+
+    (token, messages) = first._claim()
+    assert len(messages) == 1
+    assert worker(app)._claim()[1] == []
+
+
+def test_expired_claims_are_claimed_again(app):
+    add(n=1)
+    worker(app)._claim()
+
+    # the first worker died and its lease ran out
+    OutboxMessage.query.update({'claimed_until': time.time() - 1})
+    db.session.commit()
+
+    assert len(worker(app)._claim()[1]) == 1
+
+
+def test_unsent_messages_are_retried_then_given_up(app, sent):
+    add(fail='connect', n=1)
+    w = worker(app, max_attempts=2)
+
+    assert w.drain_once() == 1
+    message = OutboxMessage.query.one()
+    assert message.attempts == 1
+    assert message.claimed_by is None
+    assert 'Authy is down' in message.last_error
+    db.session.rollback()
+
+    assert w.drain_once() == 1
+    assert len(sent['send']) == 2
+    assert sent['give_up'] == [{'n': 1}]
+    assert OutboxMessage.query.count() == 0
+
+
+def test_messages_that_may_have_been_sent_arent_retried(app, sent):
+    add(fail='timeout', n=1)
+
+    assert worker(app).drain() == 1
+    assert len(sent['send']) == 1
+    assert sent['give_up'] == [{'n': 1}]
+    assert OutboxMessage.query.count() == 0
+
+
+def test_retries_wait_for_their_backoff(app, sent):
+    add(fail='connect', n=1)
+    w = worker(app, backoff=60)
+
+    assert w.drain() == 1
+    assert w.drain() == 0
+    assert len(sent['send']) == 1
+
+
+def test_unreadable_messages_are_dropped(app, sent):
+    add(kind='no-such-kind', n=1)
+
+    assert worker(app).drain() == 1
+    assert sent['send'] == []
+    assert OutboxMessage.query.count() == 0
+
+
+def test_push_that_may_have_been_sent_denies_the_payment(app, user,
+                                                         monkeypatch):
+    def timeout(*args):
+        raise ReadTimeout()
+
+    monkeypatch.setattr(utils, 'send_push_auth', timeout)
+    payment_id = payment.create_payment(
+        user.authy_id, 'friend@example.com', 10,
+        {'requester_user_id': str(user.id)}).id
+
+    assert worker(app).drain() == 1
+    assert Payment.query.get(payment_id).status == 'denied'
+    assert OutboxMessage.query.count() == 0
@@ -0,0 +1,69 @@
+import re
+
+import pytest
+
+from payfriend import db
+from payfriend.models import User
+
+TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+@pytest.fixture
+def config():
+    return {'WTF_CSRF_ENABLED': True}
+
+
+@pytest.fixture
+def registered(app):
+    db.session.add(User('user@example.com', 'password', '+15105550100', 1,
+                        '5105550100'))
+    db.session.commit()
+
+
+def csrf_token(response):
+    return TOKEN.search(response.get_data(as_text=True)).group(1)
+
+
+def test_anonymous_pages_are_cached(app):
+    app.test_client().get('/auth/login')
+    assert app.extensions['page_cache'].get(('view', '/auth/login'))
+
+
+def test_each_visitor_gets_their_own_token(app, registered):
+    first = app.test_client()
+    second = app.test_client()
+    first_token = csrf_token(first.get('/auth/login'))
+    # served from the cache
+    second_token = csrf_token(second.get('/auth/login'))
+    assert first_token != second_token
+
+    for (client, token) in ((first, first_token), (second, second_token)):
+        response = client.post('/auth/login', data={
+            'email': 'user@example.com',
+            'password': 'password',
+            'csrf_token': token,
+        })
+        assert response.status_code == 302
+        assert response.location.endswith('/payments/send')
+
+
+def test_logged_in_users_arent_served_cached_pages(app, registered):
+    client = app.test_client()
+    client.post('/auth/login', data={
+        'email': 'user@example.com',
+        'password': 'password',
+        'csrf_token': csrf_token(client.get('/auth/login')),
+    })
+
+    # the home page shows who is logged in
+    assert 'user@example.com' in client.get('/').get_data(as_text=True)
+    assert app.extensions['page_cache'].get(('view', '/')) is None
+
+
+def test_pages_with_flashed_messages_arent_cached(app):
+    client = app.test_client()
+    client.get('/auth/logout')
+
+    response = client.get('/auth/login')
+    assert 'You have been logged out.' in response.get_data(as_text=True)
+    assert app.extensions['page_cache'].get(('view', '/auth/login')) is None
@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import g
+from werkzeug.exceptions import NotFound
+
+from payfriend import db
+from payfriend.fake_authy import FAKE_CODE
+from payfriend.models import Payment, User
+from payfriend.payment import (
+    apply_push_statuses,
+    change_statuses,
+    check_sms_auth,
+    create_payment,
+    expire_payments,
+    payment_status,
+    update_payment_status
+)
+
+payments = Payment.__table__
+
+
+def new_payment(user, amount=10, push_id=None, expires_in=60):
+    payment = create_payment(user.authy_id, 'friend@example.com', amount)
+    payment.push_id = push_id
+    payment.expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
+    db.session.commit()
+    return payment
+
+
+def status(payment_id):
+    return db.session.query(Payment.status) \
+        .filter(Payment.id == payment_id).scalar()
+
+
+def test_pending_payment_can_be_approved_once(app, user):
+    payment = new_payment(user)
+
+    changed = change_statuses(payments.c.id, {payment.id: 'approved'})
+    db.session.commit()
+    assert [row.id for row in changed] == [payment.id]
+
+    # a later, conflicting change finds nothing to update
+    assert change_statuses(payments.c.id, {payment.id: 'denied'}) == []
+    db.session.commit()
+    assert status(payment.id) == 'approved'
+
+
+def test_only_overdue_payments_expire(app, user):
+    overdue = new_payment(user, expires_in=-1)
+    current = new_payment(user, expires_in=60)
+
+    assert expire_payments() == 1
+    assert status(overdue.id) == 'expired'
+    assert status(current.id) == 'pending'
+
+
+def test_overdue_payment_cant_be_approved_by_the_app(app, user):
+    payment = new_payment(user, expires_in=-1)
+
+    changed = change_statuses(payments.c.id, {payment.id: 'approved'},
+                              datetime.utcnow())
+    db.session.commit()
+    assert changed == []
+    assert status(payment.id) == 'pending'
+
+
+def test_push_statuses_apply_by_push_id(app, user):
+    payment = new_payment(user, push_id='push-1')
+
+    assert apply_push_statuses({'push-1': 'approved',
+                                'push-2': 'denied'}) == {'push-2'}
+    assert status(payment.id) == 'approved'
+
+
+@pytest.fixture
+def other(app):
+    """A second registered user, who doesn't own ``user``'s payments."""
+    other = User('other@example.com', 'password', '+15105550101', 1,
+                 '5105550101')
+    other.authy_id = 5678
+    db.session.add(other)
+    db.session.commit()
+    return other
+
+
+def test_payment_status_is_only_answered_for_the_owner(app, user, other):
+    payment = new_payment(user)
+
+    assert payment_status(payment.id, user.authy_id) == 'pending'
+    assert payment_status(payment.id, other.authy_id) is None
+
+
+def test_cached_final_status_is_only_answered_for_the_owner(app, user,
+                                                            other):
+    payment = new_payment(user)
+    with app.test_request_context():
+        update_payment_status(payment, 'approved')
+    assert app.extensions['status_cache'].get(payment.id) == \
+        (user.authy_id, 'approved')
+
+    assert payment_status(payment.id, other.authy_id) is None
+    assert payment_status(payment.id, user.authy_id) == 'approved'
+
+
+def test_status_endpoint_hides_other_users_payments(app, user, other):
+    payment = new_payment(user)
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'other@example.com',
+                                     'password': 'password'})
+
+    response = client.get('/payments/status',
+                          query_string={'payment_id': payment.id})
+    assert response.status_code == 404
+
+
+def test_sms_code_cant_approve_other_users_payments(app, user, other):
+    payment = new_payment(user)
+
+    with app.test_request_context():
+        g.user = other
+        with pytest.raises(NotFound):
+            check_sms_auth(other.authy_id, payment.id, 'approve', FAKE_CODE)
+    assert status(payment.id) == 'pending'
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from payfriend import create_app, db, schema
+from payfriend.models import Payment
+
+
+def test_hot_path_queries_use_their_indexes(app):
+    assert schema.check_query_plans() == []
+
+
+def test_every_check_names_an_index_in_the_schema(app):
+    indexes = {index.name
+               for table in db.metadata.tables.values()
+               for index in table.indexes}
+    for (name, statement, index) in schema._query_plan_checks():
+        assert index in indexes, name
+
+
+def test_check_indexes_command(app):
+    result = app.test_cli_runner().invoke(args=['check-indexes'])
+    assert result.exit_code == 0
+    assert 'All query plans use their indexes.' in result.output
+
+
+def test_migrations_upgrade_a_database_from_before_versioning(tmpdir):
+    path = tmpdir.join('old.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(path),
+                      'DATABASE_AUTO_UPGRADE': False})
+    with app.app_context():
+        with db.engine.begin() as conn:
+            # the tables as the app first created them
+            conn.execute(text(
+                'CREATE TABLE users (id INTEGER PRIMARY KEY,'
+                ' email VARCHAR(64), password_hash VARCHAR(128),'
+                ' phone_number VARCHAR(30) UNIQUE, authy_id INTEGER)'))
+            conn.execute(text(
+                'CREATE UNIQUE INDEX ix_users_email ON users (email)'))
+            conn.execute(text(
+                'CREATE TABLE payments (id VARCHAR(128) PRIMARY KEY,'
+                ' authy_id INTEGER, send_to VARCHAR(128), amount INTEGER,'
+                ' push_id VARCHAR(128), status VARCHAR(8))'))
+            conn.execute(text(
+                "INSERT INTO users VALUES (1, 'user@example.com', 'x',"
+                " '+15105550100', 1234)"))
+            conn.execute(text(
+                "INSERT INTO payments VALUES ('p1', 1234, 'friend', 10,"
+                " 'push-1', 'approved')"))
+
+        assert schema.upgrade() == (0, schema.HEAD)
+        payment = Payment.query.get('p1')
+        assert payment.status == 'approved'
+        assert abs(datetime.utcnow() - payment.created_at) < \
+            timedelta(minutes=1)
+        assert payment.expires_at - payment.created_at == \
+            timedelta(seconds=1200)
+        assert schema.check_query_plans() == []
+        db.session.remove()